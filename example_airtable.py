@@ -1,5 +1,5 @@
 from gmail_export.cli import ExportCLI
-from gmail_export.api import AirtableAPI
+from gmail_export.sync import AirtableSync
 
 
 def main():
@@ -11,10 +11,8 @@ def main():
     # print(f"\nSCRIPT EXPORTER THREADS: {exporter.threads}\n")
 
 
-    airtable=AirtableAPI(exporter)
-    airtable.labels=exporter.selected_labels
-    airtable.threads=exporter.threads
-    airtable.messages=exporter.messages
+    airtable=AirtableSync(exporter)
+    airtable.run(exporter.selected_labels, exporter.threads, exporter.messages)
 
 if __name__ == '__main__':
     main()
@@ -5,21 +5,12 @@
 """
 import os
 import json
-from os.path import expanduser
-from pathlib import Path
 import platform
+import importlib.util
+from pathlib import Path
 
+from gmail_export.__version__ import __version__
 
-try:
-    import airtable
-    AIRTABLE = True
-except ImportError: 
-    AIRTABLE = False
-try:
-    import dropbox
-    DROPBOX = True
-except ImportError: 
-    DROPBOX = False
 
 TIMEZONE='America/Toronto'
 
@@ -28,52 +19,22 @@ TOKEN_PATH = os.path.join(CFG_PATH, 'token.json')
 CREDENTIALS_PATH = os.path.join(CFG_PATH, 'credentials.json')
 # # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
+RAW_CACHE_PATH = os.path.join(CFG_PATH, 'raw_cache.sqlite')
+# compressed bytes kept before the least recently used messages are evicted
+RAW_CACHE_SIZE = 4 * 1024 ** 3
+AIRTABLE_IDMAP_PATH = os.path.join(CFG_PATH, 'airtable_ids.sqlite')
+# the gmail batch endpoint accepts up to 100 sub-requests
+BATCH_SIZE = 100
 IMAGE_LOAD_BLACKLIST = frozenset(['emltrk.com', 'trk.email', 'shim.gif'])
-
-
-
-
-
-AT_CONFIG = {}
-if AIRTABLE:
-    AIRTABLE_CFG = os.path.join(CFG_PATH, 'airtable.json')
-    with open(AIRTABLE_CFG, "r") as jsonfile:
-        AT_CONFIG = json.load(jsonfile)
-DB_CONFIG = {}
-if DROPBOX:
-    DROPBOX_CFG  = os.path.join(CFG_PATH, 'dropbox.json')
-    with open(DROPBOX_CFG, "r") as jsonfile:
-        DB_CONFIG = json.load(jsonfile)
-
-if platform.system() == "Windows":
-    appdata=os.path.join(os.getenv('APPDATA'),'Dropbox','info.json' )
-    localappdata=os.path.join(os.getenv('LOCALAPPDATA'),'Dropbox','info.json' )
-    if os.path.isfile(appdata):
-        with open(appdata, "r") as jsonfile:
-            _path = json.load(jsonfile)['personal']['path']
-            EXPORT_PATH = os.path.join(_path, "EmailBackup")
-    elif os.path.isfile(localappdata):
-        with open(localappdata, "r") as jsonfile:
-            _path = json.load(jsonfile)['personal']['path']
-            EXPORT_PATH = os.path.join(_path, "EmailBackup")
-    else:
-        EXPORT_PATH = os.path.join(CFG_PATH, 'export')
-        os.makedirs(EXPORT_PATH, exist_ok=True)
-else:
-    dbcfg=expanduser('~/.dropbox/info.json')
-    if os.path.isfile(dbcfg):
-        with open(dbcfg, "r") as jsonfile:
-            _path = json.load(jsonfile)['personal']['path']
-            EXPORT_PATH = os.path.join(_path, "EmailBackup")
-    else:
-        EXPORT_PATH = os.path.join(CFG_PATH, 'export')
-
-os.makedirs(EXPORT_PATH, exist_ok=True)
-
-print("EXPORT_PATH: ", EXPORT_PATH)
-
+IMAGE_CACHE_PATH = os.path.join(CFG_PATH, 'image_cache.json')
+# seconds a remote image check is trusted for
+IMAGE_CACHE_TTL = 7 * 24 * 60 * 60
 
 WKHTMLTOPDF_EXTERNAL_COMMAND = 'wkhtmltopdf'
+# html inputs per wkhtmltopdf command line, a longer book is split into numbered parts
+PDF_BOOK_BATCH = 1000
+# formats that need the message rendered to html
+RENDER_FORMATS = frozenset(['html', 'pdf', 'thread pdf', 'label pdf'])
 WKHTMLTOPDF_ERRORS_IGNORE = frozenset(
     [r'QFont::setPixelSize: Pixel size <= 0 \(0\)',
      r'Invalid SOS parameters for sequential JPEG',
@@ -92,3 +53,85 @@ class FatalException(Exception):
         return repr(self.value)
 
 
+def read_json(path, default=None):
+    if not os.path.isfile(path):
+        return default
+    with open(path, "r") as jsonfile:
+        return json.load(jsonfile)
+
+
+class Settings(object):
+    """
+    Configuration that touches the filesystem or optional packages, resolved
+    on first use instead of when gmail_export is imported.
+    """
+    def __init__(self, cfg_path=CFG_PATH):
+        self.cfg_path = cfg_path
+
+    def __repr__(self):
+        return f"Settings(cfg_path='{self.cfg_path}')"
+
+    @property
+    def airtable(self):
+        # find_spec checks the package is installed without importing it
+        if getattr(self, '_airtable', None) is None:
+            self._airtable = importlib.util.find_spec('airtable') is not None
+        return self._airtable
+
+    @property
+    def dropbox(self):
+        if getattr(self, '_dropbox', None) is None:
+            self._dropbox = importlib.util.find_spec('dropbox') is not None
+        return self._dropbox
+
+    @property
+    def at_config(self):
+        if getattr(self, '_at_config', None) is None:
+            self._at_config = read_json(os.path.join(self.cfg_path, 'airtable.json'), {})
+        return self._at_config
+
+    @property
+    def db_config(self):
+        if getattr(self, '_db_config', None) is None:
+            self._db_config = read_json(os.path.join(self.cfg_path, 'dropbox.json'), {})
+        return self._db_config
+
+    @property
+    def export_path(self):
+        if getattr(self, '_export_path', None) is None:
+            self._export_path = self.find_export_path()
+        return self._export_path
+
+    @export_path.setter
+    def export_path(self, path):
+        self._export_path = path
+
+    def find_export_path(self):
+        # EmailBackup in the dropbox folder when the desktop client is set up
+        if platform.system() == "Windows":
+            infos = [os.path.join(os.getenv(var, ''), 'Dropbox', 'info.json') for var in ['APPDATA', 'LOCALAPPDATA']]
+        else:
+            infos = [os.path.expanduser('~/.dropbox/info.json')]
+        for info in infos:
+            dbcfg = read_json(info)
+            if dbcfg is not None:
+                return os.path.join(dbcfg['personal']['path'], "EmailBackup")
+        return os.path.join(self.cfg_path, 'export')
+
+
+settings = Settings()
+
+# names that used to be computed at import
+LAZY_SETTINGS = {
+    'AIRTABLE': 'airtable',
+    'DROPBOX': 'dropbox',
+    'AT_CONFIG': 'at_config',
+    'DB_CONFIG': 'db_config',
+    'EXPORT_PATH': 'export_path'
+}
+
+
+def __getattr__(name):
+    if name in LAZY_SETTINGS:
+        return getattr(settings, LAZY_SETTINGS[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
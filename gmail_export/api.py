@@ -2,30 +2,31 @@
 from gmail_export.threads import GmailThread
 import html
 import os
+import threading
+import httplib2
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
-from ratelimit import limits, sleep_and_retry
 
 from email.utils import parseaddr
 
 
-from gmail_export import TOKEN_PATH, CREDENTIALS_PATH, SCOPES, DROPBOX, AIRTABLE, AT_CONFIG
+from gmail_export import TOKEN_PATH, CREDENTIALS_PATH, SCOPES, BATCH_SIZE, FatalException, settings
 from gmail_export.utils import html_escape
+from gmail_export.quota import QUOTA_UNITS, QuotaLimiter, get_units, get_stage, is_rate_limited
+from gmail_export.metrics import metrics
+from gmail_export.attachments import ATTACHMENT_CHUNK_SIZE, decode_base64url_stream
 from gmail_export.labels import GmailLabel
 from gmail_export.emails import Email
 
 
-if AIRTABLE:
-    import airtable
-if DROPBOX:
-    import dropbox
-    from dropbox.files import WriteMode
-    from dropbox.exceptions import ApiError, AuthError
-
-
 def sort_lists_by_list(sorter, sortee):
+    if not sorter:
+        return [], []
     zipped_lists = zip(sorter, sortee)
     sorted_pairs = sorted(zipped_lists)
     tuples = zip(*sorted_pairs)
@@ -33,80 +34,188 @@ def sort_lists_by_list(sorter, sortee):
     return sorter, sortee
 
 
-# 5 calls per second
-CALLS = 5
-RATE_LIMIT = 1
-
-@sleep_and_retry
-@limits(calls=CALLS, period=RATE_LIMIT)
-def check_limit():
-     ''' Empty function just to check for calls to API '''
-     return
+METADATA_HEADERS = ["Subject","From","To","Date","Cc","Bcc"]
+# rfc822msgid: terms searched for at once when filtering history by a query
+QUERY_FILTER_BATCH = 20
+MESSAGES_URL = 'https://gmail.googleapis.com/gmail/v1/users/me/messages'
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+# the largest page messages.list returns
+LIST_PAGE_SIZE = 500
 
 
 class GmailAPI(object):
-    def __init__(self, token_path=TOKEN_PATH, credentials_path=CREDENTIALS_PATH, scopes=SCOPES):
+    """
+    One authenticated client shared by every label, thread and message.
+    Each worker thread gets its own authorized httplib2 connection because
+    httplib2 isn't thread safe; the credentials are refreshed in one place and
+    every call is paced by one QuotaLimiter. With interactive False a missing
+    or unrefreshable token raises instead of opening the browser consent flow.
+    """
+    def __init__(self, token_path=TOKEN_PATH, credentials_path=CREDENTIALS_PATH, scopes=SCOPES, limiter=None, interactive=True):
         self.credentials = None
         self.token_path = token_path
         self.credentials_path = credentials_path
         self.scopes = scopes
+        self.interactive = interactive
+        self.limiter = limiter or QuotaLimiter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
         self.credentials = self.get_credentials()
         self.service = self.get_service()
 
     def get_credentials(self):
+        credentials = None
         if os.path.exists(self.token_path):
             credentials = Credentials.from_authorized_user_file(self.token_path, scopes=self.scopes)
         if not credentials or not credentials.valid:
             if credentials and credentials.expired and credentials.refresh_token:
-                credentials.refresh(Request())
+                try:
+                    credentials.refresh(Request())
+                except RefreshError as e:
+                    if self.interactive:
+                        raise
+                    raise FatalException(f"The token at {self.token_path} can't be refreshed ({e}), authorize this account again interactively")
+            elif not self.interactive:
+                raise FatalException(f"No usable token at {self.token_path}, authorize this account interactively first")
             else:
                 flow = InstalledAppFlow.from_client_secrets_file(self.credentials_path, self.scopes)
                 credentials = flow.run_local_server(port=0)
             # Save the credentials for the next run
-            with open(self.token_path, 'w') as token:
-                token.write(credentials.to_json())
+            self.save_credentials(credentials)
         return credentials
-    
+
+    def save_credentials(self, credentials=None):
+        credentials = credentials or self.credentials
+        with open(self.token_path, 'w') as token:
+            token.write(credentials.to_json())
+
+    def refresh_credentials(self):
+        # only one worker refreshes, the others wait and reuse the new token
+        with self._lock:
+            if not self.credentials.valid:
+                self.credentials.refresh(Request())
+                self.save_credentials()
+
     def get_service(self):
-        return build('gmail', 'v1', credentials=self.credentials)
-    
+        return build('gmail', 'v1', credentials=self.credentials, cache_discovery=False)
+
+    @property
+    def http(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+            self._local.http = http
+        return http
+
+    @property
+    def session(self):
+        # requests session for the calls that need a streamed response
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = AuthorizedSession(self.credentials)
+            self._local.session = session
+        return session
+
+    def execute(self, request, units=None):
+        if not self.credentials.valid:
+            self.refresh_credentials()
+        units = units or get_units(request)
+        return self.limiter.call(lambda: request.execute(http=self.http), units, get_stage(request))
+
     def get_labels(self, all=False):
         results = []
-        response = self.service.users().labels().list(userId='me').execute()
+        response = self.execute(self.service.users().labels().list(userId='me'))
         response_labels = response['labels']
         if all:
             labels = sorted([label for label in response_labels], key=lambda k: k['name'].lower())
         else:
             labels = sorted([label for label in response_labels if label['type']=="user"], key=lambda k: k['name'].lower())
         for label in labels:
-            new_label = GmailLabel(label['id'], label['name'])
+            new_label = GmailLabel(label['id'], label['name'], self)
             results.append(new_label)
         return results
 
-    def get_id_list_for_label(self, label, page_token=None):
-        messageIds = []
-        threadIds = []
-        response = self.service.users().messages().list(userId="me", labelIds=label.id, q=None, pageToken=page_token, maxResults=None, includeSpamTrash=None).execute()
-        if 'messages' in response:
-            messages = response['messages']
+    def get_id_list_for_label(self, label, query=None, page_token=None):
+        # the whole label at once, grouped by thread
+        messages = [message for page in self.iter_id_pages_for_label(label, query, page_token) for message in page]
+        print(f"    Fetched {len(messages)} messages.")
+        messageIds = [messageId for messageId, _ in messages]
+        threadIds = [threadId for _, threadId in messages]
+        threadIds, messageIds = sort_lists_by_list(threadIds, messageIds)
+        return messageIds, threadIds
+
+    def iter_id_pages_for_label(self, label, query=None, page_token=None):
+        """
+        Yields a list of (messageId, threadId) for each page of the listing as it
+        arrives, newest first, so messages can be fetched before the listing ends.
+        query is a gmail search string, see gmail_export.query.build_query
+        """
         print_msg = "  > Fetching message ids."
-        while 'nextPageToken' in response:
+        while True:
+            response = self.execute(self.service.users().messages().list(userId="me", labelIds=label.id, q=query, pageToken=page_token, maxResults=LIST_PAGE_SIZE, includeSpamTrash=None))
+            yield [(message['id'], message['threadId']) for message in response.get('messages', [])]
+            if not 'nextPageToken' in response:
+                break
+            page_token = response['nextPageToken']
             print_msg += "."
             print(print_msg, end='\r')
+        print(print_msg)
+
+    def get_profile(self):
+        return self.execute(self.service.users().getProfile(userId="me"))
+
+    def get_history_for_label(self, label, start_history_id):
+        """
+        Message ids added to and removed from a label since start_history_id.
+        Returns None when gmail no longer has that history and a full listing is needed.
+        """
+        added = {}
+        removed = {}
+        page_token = None
+        print_msg = "  > Fetching history."
+        while True:
+            try:
+                response = self.execute(self.service.users().history().list(userId="me", startHistoryId=start_history_id, labelId=label.id, historyTypes=HISTORY_TYPES, pageToken=page_token, maxResults=500))
+            except HttpError as e:
+                if e.resp.status == 404:
+                    print(f"  > History {start_history_id} expired, listing the whole label.")
+                    return None
+                raise
+            # records are in chronological order so later changes win
+            for record in response.get('history', []):
+                for item in record.get('messagesAdded', []):
+                    message = item['message']
+                    if label.id in message.get('labelIds', []):
+                        removed.pop(message['id'], None)
+                        added[message['id']] = message['threadId']
+                for item in record.get('labelsAdded', []):
+                    if label.id in item.get('labelIds', []):
+                        message = item['message']
+                        removed.pop(message['id'], None)
+                        added[message['id']] = message['threadId']
+                for item in record.get('messagesDeleted', []):
+                    message = item['message']
+                    added.pop(message['id'], None)
+                    removed[message['id']] = message['threadId']
+                for item in record.get('labelsRemoved', []):
+                    if label.id in item.get('labelIds', []):
+                        message = item['message']
+                        added.pop(message['id'], None)
+                        removed[message['id']] = message['threadId']
+            if not 'nextPageToken' in response:
+                break
             page_token = response['nextPageToken']
-            response = self.service.users().messages().list(userId="me", labelIds=label.id, q=None, pageToken=page_token, maxResults=None, includeSpamTrash=None).execute()
-            messages.extend(response['messages'])
+            print_msg += "."
+            print(print_msg, end='\r')
         print(print_msg)
-        print(f"    Fetched {len(messages)} messages.")
-        messageIds=[message['id'] for message in messages]
-        threadIds=[message['threadId'] for message in messages]
-        threadIds, messageIds = sort_lists_by_list(threadIds, messageIds)
-        return messageIds, threadIds
+        print(f"    {len(added)} messages added, {len(removed)} removed.")
+        threadIds, messageIds = sort_lists_by_list(list(added.values()), list(added.keys()))
+        return messageIds, threadIds, list(removed.keys())
 
     def get_messages_for_label(self, label, page_token=None):
         results = {}
         threads = {}
-        response = self.service.users().messages().list(userId="me", labelIds=label.id, q=None, pageToken=page_token, maxResults=None, includeSpamTrash=None).execute()
+        response = self.execute(self.service.users().messages().list(userId="me", labelIds=label.id, q=None, pageToken=page_token, maxResults=None, includeSpamTrash=None))
         if 'messages' in response:
             messages = response['messages']
         print_msg = "Fetching"
@@ -114,7 +223,7 @@ class GmailAPI(object):
             print_msg += "."
             print(print_msg, end='\r')
             page_token = response['nextPageToken']
-            response = self.service.users().messages().list(userId="me", labelIds=label.id, q=None, pageToken=page_token, maxResults=None, includeSpamTrash=None).execute()
+            response = self.execute(self.service.users().messages().list(userId="me", labelIds=label.id, q=None, pageToken=page_token, maxResults=None, includeSpamTrash=None))
             messages.extend(response['messages'])
         print(print_msg)
         j=1
@@ -123,18 +232,103 @@ class GmailAPI(object):
             print(print_msg, end='\r')
             j+=1
             threadId = message['threadId']
-            thread = label.add_thread(GmailThread(threadId))
-            results[message['id']] = GmailMessage(message['id'], label, thread)
+            thread = label.add_thread(GmailThread(threadId, self))
+            results[message['id']] = GmailMessage(message['id'], label, thread, api=self)
         return results
 
     def get_message_id(self, id):
-        return self.service.users().messages().get(userId="me", id=id, format="raw", metadataHeaders=None).execute()
+        response = self.execute(self.service.users().messages().get(userId="me", id=id, format="raw", metadataHeaders=None))
+        metrics.add('api messages.get', bytes=len(response.get('raw', '')))
+        return response
     
-    def get_message_meta(self, id):
-        return self.service.users().messages().get(userId="me", id=id, format="metadata", metadataHeaders=["Subject","From","To","Date","Cc","Bcc"]).execute()
+    def get_message_full(self, id):
+        return self.execute(self.service.users().messages().get(userId="me", id=id, format="full"))
+
+    def download_attachment(self, message_id, attachment_id, outfile):
+        """
+        Stream an attachment into outfile, decoding the base64url body a chunk
+        at a time so it's never held in memory. Returns the bytes written.
+        """
+        url = f'{MESSAGES_URL}/{message_id}/attachments/{attachment_id}'
+        def download():
+            if not self.credentials.valid:
+                self.refresh_credentials()
+            with self.session.get(url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                size = decode_base64url_stream(response.iter_content(ATTACHMENT_CHUNK_SIZE), outfile)
+            metrics.add('api messages.attachments.get', bytes=size)
+            return size
+        return self.limiter.call(download, QUOTA_UNITS['gmail.users.messages.attachments.get'], 'api messages.attachments.get')
+
+    def get_message_meta(self, id, headers=METADATA_HEADERS):
+        return self.execute(self.service.users().messages().get(userId="me", id=id, format="metadata", metadataHeaders=headers))
+
+    def get_messages_meta(self, ids, headers=METADATA_HEADERS):
+        """
+        Fetch metadata for many message ids through the batch endpoint.
+        Returns a dict of id: response; failed sub-requests are retried one by
+        one and messages deleted since they were listed are left out.
+        """
+        results = {}
+        failed = []
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            else:
+                failed.append(request_id)
+                if is_rate_limited(exception):
+                    rate_limited.append(request_id)
+        ids = list(dict.fromkeys(ids))
+        for i in range(0, len(ids), BATCH_SIZE):
+            rate_limited = []
+            batch = self.service.new_batch_http_request(callback=callback)
+            units = 0
+            for id in ids[i:i+BATCH_SIZE]:
+                request = self.service.users().messages().get(userId="me", id=id, format="metadata", metadataHeaders=headers)
+                units += get_units(request)
+                batch.add(request, request_id=id)
+            # every sub-request is charged against the quota
+            self.execute(batch, units)
+            if rate_limited:
+                self.limiter.slow_down()
+        for id in failed:
+            try:
+                results[id] = self.get_message_meta(id, headers)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                print(f"    > Message {id} no longer exists, skipping it.")
+        return results
+
+    def filter_by_query(self, label, ids, query):
+        """
+        The ids that match a gmail search query, looked up by their Message-ID
+        headers a batch at a time instead of listing everything the query
+        matches. Messages without a Message-ID are kept.
+        """
+        matching = set()
+        by_rfc822 = {}
+        for i in range(0, len(ids), BATCH_SIZE):
+            for id, response in self.get_messages_meta(ids[i:i+BATCH_SIZE], ["Message-ID"]).items():
+                headers = response.get('payload', {}).get('headers', [])
+                rfc822_id = next((header['value'].strip().strip('<>') for header in headers if header['name'].lower() == 'message-id'), None)
+                if rfc822_id:
+                    by_rfc822[rfc822_id] = id
+                else:
+                    matching.add(id)
+        rfc822_ids = list(by_rfc822)
+        for i in range(0, len(rfc822_ids), QUERY_FILTER_BATCH):
+            # braces are gmail's OR
+            terms = ' '.join(f'rfc822msgid:{rfc822_id}' for rfc822_id in rfc822_ids[i:i+QUERY_FILTER_BATCH])
+            for page in self.iter_id_pages_for_label(label, f'({query}) {{{terms}}}'):
+                matching.update(id for id, _ in page)
+        return matching
     
     def get_thread(self, id):
-        return self.service.users().threads().get(userId="me", id=id, format="full").execute()
+        return self.execute(self.service.users().threads().get(userId="me", id=id, format="full"))
+
+    def get_thread_meta(self, id):
+        return self.execute(self.service.users().threads().get(userId="me", id=id, format="metadata", metadataHeaders=["Subject"]))
 
 
 class DropboxAPI(GmailAPI):
@@ -147,8 +341,9 @@ class DropboxAPI(GmailAPI):
         self.attachments = self.get_table_api_pointer("Attachments")
 
 
-    def get_table_api_pointer(self, table_name, base_id=AT_CONFIG['base_id'], api_key=AT_CONFIG['api_key']):
-        return airtable.Airtable(base_id, table_name, api_key)
+    def get_table_api_pointer(self, table_name, base_id=None, api_key=None):
+        import airtable
+        return airtable.Airtable(base_id or settings.at_config['base_id'], table_name, api_key or settings.at_config['api_key'])
     
 
 class AirtableAPI(object):
@@ -160,8 +355,9 @@ class AirtableAPI(object):
         self.emails_query      = self.get_table_api_pointer("Emails")
         self.attachments_query = self.get_table_api_pointer("Attachments")
 
-    def get_table_api_pointer(self, table_name, base_id=AT_CONFIG['base_id'], api_key=AT_CONFIG['api_key']):
-        return airtable.Airtable(base_id, table_name, api_key)
+    def get_table_api_pointer(self, table_name, base_id=None, api_key=None):
+        import airtable
+        return airtable.Airtable(base_id or settings.at_config['base_id'], table_name, api_key or settings.at_config['api_key'])
     
     @property
     def labels(self):
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import time
+import queue
+import shutil
+import tarfile
+import tempfile
+import threading
+import zipfile
+
+
+ARCHIVE_FORMATS = {'zip': '.zip', 'tar.zst': '.tar.zst'}
+# entries waiting for the compression thread, put blocks once it falls behind
+ARCHIVE_BACKLOG = 64
+# bytes of an entry kept in memory before it spills to a temporary file
+ARCHIVE_SPOOL_SIZE = 1024 * 1024
+# bytes copied into the archive member at a time
+ARCHIVE_CHUNK_SIZE = 256 * 1024
+STOP = object()
+
+
+class ArchiveEntry(io.RawIOBase):
+    # a file spooled to disk past ARCHIVE_SPOOL_SIZE and handed to the archive when it's closed
+    def __init__(self, archive, arcname):
+        super().__init__()
+        self.archive = archive
+        self.arcname = arcname
+        self.spool = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE)
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def write(self, data):
+        return self.spool.write(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.spool.seek(offset, whence)
+
+    def tell(self):
+        return self.spool.tell()
+
+    def close(self):
+        if not self.closed:
+            self.archive.add(self.arcname, self.spool)
+        super().close()
+
+
+class ArchiveSink(object):
+    """
+    Writes a label's eml, html, pdf, thread and label pdf and attachment files
+    straight into one zip or tar.zst as they're produced, without the directory
+    tree. Mailboxes stay files in the label directory. Each file is
+    spooled, in memory up to ARCHIVE_SPOOL_SIZE and to a temporary file past
+    it, then queued to one background thread that copies it into its member a
+    chunk at a time, appending to the archive in a single sequential stream.
+
+    A full overwriting export replaces the archive. Otherwise a zip is
+    appended to, skipping names it already has, and a tar.zst gets a new part
+    named with the time, since tar.zst can't be appended to.
+    """
+    def __init__(self, path, root, format='zip', replace=True, backlog=ARCHIVE_BACKLOG):
+        if not format in ARCHIVE_FORMATS:
+            raise ValueError(f"archive must be one of {', '.join(ARCHIVE_FORMATS)}, not {format!r}")
+        self.format = format
+        self.root = root
+        self.path = path + ARCHIVE_FORMATS[format]
+        if format == 'tar.zst' and not replace and os.path.exists(self.path):
+            self.path = f"{path}-{time.strftime('%Y%m%d%H%M%S')}{ARCHIVE_FORMATS[format]}"
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.names = set()
+        self.errors = []
+        # names already in a zip that's appended to
+        self.existing = set()
+        self._queue = queue.Queue(maxsize=backlog)
+        self._pending = 0
+        self._pending_lock = threading.Condition()
+        self._archive = self.open(replace)
+        self._writer = threading.Thread(target=self.work, daemon=True)
+        self._writer.start()
+
+    def __repr__(self):
+        return f"ArchiveSink(path='{self.path}', entries={len(self.names)})"
+
+    def open(self, replace):
+        if self.format == 'zip':
+            archive = zipfile.ZipFile(self.path, 'w' if replace else 'a', compression=zipfile.ZIP_DEFLATED)
+            self.existing = set(archive.namelist())
+            return archive
+        # zstandard is only needed for tar.zst archives
+        import zstandard
+        self._file = open(self.path, 'wb')
+        self._stream = zstandard.ZstdCompressor(threads=-1).stream_writer(self._file)
+        return tarfile.open(fileobj=self._stream, mode='w|')
+
+    def arcname(self, write_path):
+        return os.path.relpath(write_path, self.root).replace(os.sep, '/')
+
+    def open_output(self, write_path, mode='wb'):
+        # stands in for open(write_path, mode) when writing a message's files
+        entry = ArchiveEntry(self, self.arcname(write_path))
+        if 'b' in mode:
+            return entry
+        return io.TextIOWrapper(entry)
+
+    def add(self, arcname, infile):
+        # the file object is copied and closed by the compression thread
+        self._queue.put((arcname, infile))
+
+    def add_file(self, arcname, path):
+        # the file is read and removed by the compression thread
+        self._queue.put((arcname, path))
+
+    def add_when_done(self, future, arcname, path):
+        # a file the pdf pool is still writing
+        with self._pending_lock:
+            self._pending += 1
+        def done(f):
+            if f.exception() is None:
+                self.add_file(arcname, path)
+            elif os.path.exists(path):
+                os.remove(path)
+            with self._pending_lock:
+                self._pending -= 1
+                self._pending_lock.notify_all()
+        future.add_done_callback(done)
+
+    def temp_path(self, write_path):
+        handle, path = tempfile.mkstemp(prefix='gmail_export_', suffix=os.path.splitext(write_path)[1])
+        os.close(handle)
+        return path
+
+    def work(self):
+        while True:
+            item = self._queue.get()
+            if item is STOP:
+                break
+            arcname, data = item
+            try:
+                self.write(arcname, data)
+            except Exception as e:
+                self.errors.append((arcname, e))
+                print(f"        ! Archive {arcname} failed: {e}")
+
+    def write(self, arcname, source):
+        # source is a path or a file object, copied into the member a chunk at a time
+        path = source if isinstance(source, str) else None
+        if arcname in self.existing or arcname in self.names:
+            # a message exported again, zip would get a second entry of the same name
+            if path is None:
+                source.close()
+            else:
+                os.remove(path)
+            return
+        infile = open(path, 'rb') if path is not None else source
+        try:
+            size = infile.seek(0, io.SEEK_END)
+            infile.seek(0)
+            if self.format == 'zip':
+                info = zipfile.ZipInfo(arcname, time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.file_size = size
+                with self._archive.open(info, 'w') as member:
+                    shutil.copyfileobj(infile, member, ARCHIVE_CHUNK_SIZE)
+            else:
+                info = tarfile.TarInfo(arcname)
+                info.size = size
+                info.mtime = time.time()
+                self._archive.addfile(info, infile)
+        finally:
+            infile.close()
+        self.names.add(arcname)
+        if path is not None:
+            os.remove(path)
+
+    def close(self):
+        with self._pending_lock:
+            while self._pending:
+                self._pending_lock.wait()
+        self._queue.put(STOP)
+        self._writer.join()
+        self._archive.close()
+        if self.format == 'tar.zst':
+            self._stream.close()
+            if not self._file.closed:
+                self._file.close()
+        print(f"  > Archive: {self.path} ({len(self.names)} files)")
+        return self.errors
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import re
+import base64
+
+
+# bytes read from the api per chunk when streaming an attachment
+ATTACHMENT_CHUNK_SIZE = 256 * 1024
+DATA_FIELD = re.compile(rb'"data"\s*:\s*"')
+
+
+def iter_payload_parts(payload):
+    """
+    Every part of a format=full message payload, depth first like Message.walk.
+    """
+    yield payload
+    for part in payload.get('parts', []):
+        yield from iter_payload_parts(part)
+
+
+def get_part_header(part, name):
+    name = name.lower()
+    for header in part.get('headers', []):
+        if header['name'].lower() == name:
+            return header['value']
+    return None
+
+
+def get_part_disposition(part):
+    content_disposition = get_part_header(part, 'Content-Disposition')
+    if content_disposition is None:
+        return None
+    return content_disposition.split(';')[0].strip().lower()
+
+
+def decode_base64url_stream(chunks, outfile):
+    """
+    Write the base64url "data" field of a streamed attachments.get json response
+    to outfile, decoding it as it arrives. Returns the number of bytes written.
+    """
+    written = 0
+    head = b''
+    tail = b''
+    in_data = False
+    for chunk in chunks:
+        if not in_data:
+            head += chunk
+            match = DATA_FIELD.search(head)
+            if match is None:
+                # keep enough to find a key split across chunks
+                head = head[-16:]
+                continue
+            in_data = True
+            chunk = head[match.end():]
+            head = b''
+        end = chunk.find(b'"')
+        if end != -1:
+            chunk = chunk[:end]
+        tail += chunk
+        if end != -1:
+            tail += b'=' * (-len(tail) % 4)
+            usable = len(tail)
+        else:
+            usable = len(tail) - len(tail) % 4
+        data = base64.urlsafe_b64decode(tail[:usable])
+        outfile.write(data)
+        written += len(data)
+        tail = tail[usable:]
+        if end != -1:
+            break
+    return written
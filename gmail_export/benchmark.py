@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+
+from gmail_export import WKHTMLTOPDF_EXTERNAL_COMMAND
+
+
+BENCHMARK_FORMATS = ['eml', 'html', 'pdf', 'thread pdf', 'label pdf', 'mbox', 'maildir', 'attachments', 'inline']
+PDF_FORMATS = frozenset(['pdf', 'thread pdf', 'label pdf'])
+
+
+def peak_rss():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+def run_format(format, mailbox_options, latency=0.0, options=None):
+    """
+    Export the synthetic mailbox in one format to a temporary directory and
+    return its timings. Runs in a fresh process so peak RSS is this format's.
+    """
+    from gmail_export.cli import ExportCLI
+    from gmail_export.fake import FakeGmailAPI, SyntheticMailbox
+    from gmail_export.metrics import metrics
+
+    mailbox = SyntheticMailbox(**mailbox_options)
+    export_path = tempfile.mkdtemp(prefix='gmail_export_benchmark_')
+    try:
+        answers = {'export_path': export_path, 'labels': [label['name'] for label in mailbox.labels], 'formats': [format]}
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            exporter = ExportCLI(answers=answers, gmail_api=FakeGmailAPI(mailbox, latency), cache=False, offline=True,
+                                 image_cache=os.path.join(export_path, '.image_cache.json'), **(options or {}))
+            summary = exporter.export_selected_labels()
+            seconds = time.perf_counter() - started
+        written = tree_size(export_path)
+    finally:
+        shutil.rmtree(export_path, ignore_errors=True)
+    messages = sum(label['messages'] for label in summary.values())
+    return {
+        'format': format,
+        'messages': messages,
+        'errors': sum(label['errors'] for label in summary.values()),
+        'seconds': round(seconds, 3),
+        'messages_per_second': round(messages / seconds, 1),
+        'bytes_fetched_per_second': round(mailbox.served / seconds),
+        'bytes_written_per_second': round(written / seconds),
+        'peak_rss': peak_rss(),
+        'metrics': metrics.report()
+    }
+
+
+def run_benchmark(formats, mailbox_options, latency=0.0, options=None):
+    results = []
+    for format in formats:
+        if format in PDF_FORMATS and shutil.which(WKHTMLTOPDF_EXTERNAL_COMMAND) is None:
+            print(f"  > Skipping {format}, {WKHTMLTOPDF_EXTERNAL_COMMAND} isn't installed.")
+            continue
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                result = executor.submit(run_format, format, mailbox_options, latency, options).result()
+            except Exception as e:
+                print(f"  ! {format} failed: {e.__class__.__name__}: {e}")
+                results.append({'format': format, 'error': f'{e.__class__.__name__}: {e}'})
+                continue
+        print(f"  > {format:12} {result['messages_per_second']:>8} msg/s {result['bytes_written_per_second'] / 1e6:>8.2f} MB/s written "
+              f"{result['peak_rss'] / 1e6:>8.1f} MB peak rss")
+        results.append(result)
+    return results
+
+
+@click.command()
+@click.option('--messages', default=500, help='Messages in the synthetic mailbox.')
+@click.option('--thread-depth', default=3, help='Messages per thread.')
+@click.option('--labels', default=1, help='Labels, every message is in all of them.')
+@click.option('--attachment', 'attachments', multiple=True, type=int, help='Size in bytes of an attachment on every message, repeatable.')
+@click.option('--inline-images', default=0, help='Inline images per message.')
+@click.option('--latency', default=0.0, help='Seconds added to every api round trip.')
+@click.option('--format', 'formats', multiple=True, type=click.Choice(BENCHMARK_FORMATS), help='Formats to run, all by default.')
+@click.option('--pipeline', is_flag=True, help='Use the concurrent export pipeline.')
+@click.option('--seed', default=0, help='Seed of the synthetic mailbox.')
+@click.option('--json', 'json_path', default=None, type=click.Path(dir_okay=False), help='Also write the results to this json file.')
+def main(messages, thread_depth, labels, attachments, inline_images, latency, formats, pipeline, seed, json_path):
+    """Export a synthetic mailbox offline and report throughput for each format."""
+    mailbox_options = {
+        'messages': messages,
+        'thread_depth': thread_depth,
+        'labels': [f'Benchmark {n}' for n in range(labels)],
+        'attachment_sizes': attachments,
+        'inline_images': inline_images,
+        'seed': seed
+    }
+    print(f"  > Benchmarking {messages} messages, {latency}s latency.")
+    results = run_benchmark(formats or BENCHMARK_FORMATS, mailbox_options, latency, {'pipeline': pipeline})
+    if json_path:
+        with open(json_path, 'w') as outfile:
+            json.dump({'mailbox': mailbox_options, 'latency': latency, 'results': results}, outfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from gmail_export import RAW_CACHE_PATH, RAW_CACHE_SIZE
+
+
+class RawMessageCache(object):
+    """
+    Raw RFC 822 bytes keyed by message id, zlib compressed in one sqlite file.
+    Gmail messages are immutable so entries never go stale; the least recently
+    used ones are evicted once the cache grows past max_size bytes.
+    """
+    def __init__(self, path=RAW_CACHE_PATH, max_size=RAW_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS messages (id TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS messages_accessed ON messages (accessed)')
+        self.size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM messages').fetchone()[0]
+
+    def __repr__(self):
+        return f"RawMessageCache(path='{self.path}', size={self.size}, max_size={self.max_size})"
+
+    def __contains__(self, id):
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM messages WHERE id=?', (id,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def get(self, id):
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM messages WHERE id=?', (id,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('UPDATE messages SET accessed=? WHERE id=?', (time.time(), id))
+        return zlib.decompress(row[0])
+
+    def put(self, id, raw):
+        data = zlib.compress(raw)
+        with self._lock:
+            row = self._conn.execute('SELECT size FROM messages WHERE id=?', (id,)).fetchone()
+            self._conn.execute('INSERT OR REPLACE INTO messages (id, data, size, accessed) VALUES (?, ?, ?, ?)',
+                               (id, sqlite3.Binary(data), len(data), time.time()))
+            self.size += len(data) - (row[0] if row else 0)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        # drop the least recently used entries until there's 10% headroom, caller holds the lock
+        target = self.max_size * 0.9
+        evicted = []
+        for id, size in self._conn.execute('SELECT id, size FROM messages ORDER BY accessed').fetchall():
+            if self.size <= target:
+                break
+            evicted.append((id,))
+            self.size -= size
+        self._conn.executemany('DELETE FROM messages WHERE id=?', evicted)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
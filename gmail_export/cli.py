@@ -1,22 +1,31 @@
 # -*- coding: utf-8 -*-
 import os
 import pendulum
-from PyInquirer import Token, ValidationError, Validator, print_json, prompt, style_from_dict
-from jinja2 import Template
 
-from gmail_export import EXPORT_PATH, DROPBOX, AIRTABLE, TIMEZONE
-import gmail_export.api as api
+from gmail_export import TIMEZONE, IMAGE_CACHE_PATH, settings
+from gmail_export.history import HistoryState
+from gmail_export.manifest import ExportManifest
+from gmail_export.dedupe import CanonicalStore
+from gmail_export.search import SearchIndex
+from gmail_export.query import QUERY_FILTERS, build_query
+from gmail_export.cache import RawMessageCache
+from gmail_export.pdf import PdfPool
+from gmail_export.images import ImageChecker
+from gmail_export.metrics import metrics
 
 
-STYLE = style_from_dict({
-    Token.QuestionMark: '#fac731 bold',
-    Token.Answer: '#4688f1 bold',
-    Token.Instruction: '',  # default
-    Token.Separator: '#cc5454',
-    Token.Selected: '#0abf5b',  # default
-    Token.Pointer: '#673ab7 bold',
-    Token.Question: '',
-})
+def get_style():
+    # PyInquirer is only loaded when there are questions to ask
+    from PyInquirer import Token, style_from_dict
+    return style_from_dict({
+        Token.QuestionMark: '#fac731 bold',
+        Token.Answer: '#4688f1 bold',
+        Token.Instruction: '',  # default
+        Token.Separator: '#cc5454',
+        Token.Selected: '#0abf5b',  # default
+        Token.Pointer: '#673ab7 bold',
+        Token.Question: '',
+    })
 
 
 REPR_TEMPLATE="""ExportCLI({
@@ -25,23 +34,66 @@ REPR_TEMPLATE="""ExportCLI({
       Labels: {% for label in labels %}{% if loop.first %}{{ label.name }}{% else %}
               {{ label.name }}{% endif %}{% endfor %}
      Formats: {{ formats }}
+       Query: {{ query }}
    Overwrite: {{ overwrite }}
+ Incremental: {{ incremental }}
 })
 """
 
 
 class ExportCLI(object):
-    def __init__(self, export_path=EXPORT_PATH):
-        self.api = api.GmailAPI()
-        self.labels = self.api.get_labels()
+    def __init__(self, export_path=None, pipeline=False, cache=False, pdf_workers=None, offline=False, image_cache=IMAGE_CACHE_PATH, stream_attachments=False, dedupe=None, archive=None, search=False, report=False, profile_message=None, answers=None, gmail_api=None):
+        # report: write each stage's call counts, latencies, bytes, quota units and worker
+        # utilization to export_metrics.json and export_metrics.prom in the export path
+        self.report = report
+        # profile_message: a message id to export under cProfile, written next to the report
+        metrics.reset(profile_message)
+        # export_path: the default export path, from settings when not given
+        self.default_export_path = export_path or settings.export_path
+        # pipeline: False for the serial export, True or a dict of ExportPipeline options
+        self.pipeline = pipeline
+        # cache: False to always download, True for the raw message cache in ~/.gmail_export or a RawMessageCache
+        # an empty cache has no length, so it's told from False by identity
+        self.cache = RawMessageCache() if cache is True else (None if cache is False or cache is None else cache)
+        self.pdf_pool = PdfPool(pdf_workers)
+        # offline: never check remote images over the network
+        # image_cache: where remote image checks are kept between runs, None to keep them for this run only
+        self.image_checker = ImageChecker(image_cache, offline=offline)
+        # stream_attachments: download attachments through the attachments api a chunk at a time
+        self.stream_attachments = stream_attachments
+        # dedupe: None to write a copy per label, or 'hardlink', 'symlink' or 'index' to write
+        # each message once to a canonical store and link it into every label
+        self.dedupe = dedupe
+        # archive: None to write files, or 'zip' or 'tar.zst' to stream each label's files into one archive
+        if archive and dedupe:
+            raise ValueError("Archived exports can't be deduplicated into a canonical store")
+        self.archive = archive
+        # search: index every exported message's headers and text for SearchIndex.search
+        self.search = search
+        # gmail_api: an already authenticated GmailAPI, eg. for another account's token
+        if gmail_api is None:
+            # googleapiclient takes most of the import time, it's only loaded to build a client
+            from gmail_export.api import GmailAPI
+            gmail_api = GmailAPI()
+        self.api = gmail_api
+        # answers: a dict of the question answers to run without prompting, labels given by name or id
+        self.labels = self.api.get_labels(all=answers is not None)
         self.messages = {}
         self.threads = {}
-        self.config = self.questions
+        if answers is None:
+            self.config = self.questions
+        else:
+            self._config = self.get_answers(answers)
         self.selected_labels = self.config['labels']
         self.export_path = self.config['export_path']
         self.path = self.export_path
+        self.history = HistoryState(self.export_path)
+        self.manifest = ExportManifest(self.export_path)
+        self.store = CanonicalStore(self.export_path, dedupe) if dedupe else None
+        self.search_index = SearchIndex(self.export_path) if search else None
 
     def __repr__(self):
+        from jinja2 import Template
         t = Template(REPR_TEMPLATE)
         return t.render(self.config)
 
@@ -53,9 +105,42 @@ class ExportCLI(object):
             label.populate(self)
     
     def export_selected_labels(self):
-        for label in self.selected_labels:
-            label.populate(self)
-            label.export(self)
+        # taken before listing so nothing that arrives during the export is missed next time
+        history_id = self.api.get_profile()['historyId']
+        summary = {}
+        try:
+            for label in self.selected_labels:
+                # the export starts on the first page of ids while the rest are listed
+                errors = label.export(self, label.iter_populate(self))
+                if not errors:
+                    self.history.set(label.id, history_id, label.query)
+                self.image_checker.save()
+                summary[label.name] = {'messages': len(label.messageIds), 'errors': len(errors)}
+        finally:
+            self.image_checker.close()
+        if self.report:
+            metrics.write(self.export_path)
+        return summary
+
+    def get_answers(self, answers):
+        config = {
+            'export_path': self.default_export_path,
+            'timezone': TIMEZONE,
+            'formats': ['eml'],
+            'overwrite': True,
+            'incremental': False
+        }
+        config.update(answers)
+        # after, before, from, has_attachment... answers are folded into the gmail search query
+        filters = {key: config.pop(key) for key in QUERY_FILTERS if key in config}
+        config['query'] = build_query(config.get('query'), **filters)
+        wanted = config.get('labels', [])
+        config['labels'] = [label for label in self.labels if label.name in wanted or label.id in wanted]
+        missing = set(wanted) - set(label.name for label in config['labels']) - set(label.id for label in config['labels'])
+        if missing:
+            raise ValueError(f"Unknown labels: {', '.join(sorted(missing))}")
+        os.makedirs(config['export_path'], exist_ok=True)
+        return config
 
     @property
     def labels(self, selected=False):
@@ -81,7 +166,9 @@ class ExportCLI(object):
         questions.append(self.timezone_question)
         questions.append(self.label_question)
         questions.append(self.formats_question)
+        questions.append(self.query_question)
         questions.append(self.overwrite_question)
+        questions.append(self.incremental_question)
         return questions
     
     @property
@@ -93,7 +180,8 @@ class ExportCLI(object):
 
     @config.setter
     def config(self, questions):
-        self._config = prompt(questions, style=STYLE)
+        from PyInquirer import prompt
+        self._config = prompt(questions, style=get_style())
 
     @property
     def label_question(self):
@@ -113,6 +201,10 @@ class ExportCLI(object):
             {'name': "eml", 'checked': True },
             {'name': "html" },
             {'name': "pdf" },
+            {'name': "thread pdf" },
+            {'name': "label pdf" },
+            {'name': "mbox" },
+            {'name': "maildir" },
             {'name': "attachments"},
             {'name': "inline"}
         ]
@@ -125,13 +217,25 @@ class ExportCLI(object):
         }
         return question
     
+    @property
+    def query_question(self):
+        question = {
+            'type': 'input',
+            'name': 'query',
+            'message': 'Gmail search filter, eg. after:2021/01/01 has:attachment larger:5M from:bank.com (blank for all):',
+            'default': '',
+            'filter': lambda answer: answer.strip() or None
+        }
+        return question
+
     @property
     def export_root_question(self):
+        os.makedirs(self.default_export_path, exist_ok=True)
         question = {
             'type': 'input',
             'name': 'export_path',
             'message': 'Export path:',
-            'default': EXPORT_PATH,
+            'default': self.default_export_path,
             'validate': lambda answer: 'Enter an existing path.' if not os.path.exists(answer) else True
         }
         return question
@@ -146,6 +250,16 @@ class ExportCLI(object):
         }
         return question
 
+    @property
+    def incremental_question(self):
+        question = {
+            'type': 'confirm',
+            'name': 'incremental',
+            'message': 'Only export changes since the last run',
+            'default': False
+        }
+        return question
+
     @property
     def timezone_question(self):
         question = {
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import threading
+from concurrent.futures import Future
+
+
+STORE_DIRNAME = '.messages'
+INDEX_FILENAME = 'messages.tsv'
+DEDUPE_MODES = ['hardlink', 'symlink', 'index']
+
+
+class CanonicalStore(object):
+    """
+    Each message's files are written once under <export root>/.messages/<id>
+    and every label it's exported under gets hardlinks or symlinks to them in
+    its thread directories, or with the 'index' mode a messages.tsv in the
+    label directory pointing at the stored files. Within a run a message
+    already in the store is never fetched, rendered or written again; what
+    was stored is only known in memory, so a later run relies on the
+    manifest to skip it.
+    """
+    def __init__(self, export_path, mode='hardlink'):
+        if not mode in DEDUPE_MODES:
+            raise ValueError(f"dedupe must be one of {', '.join(DEDUPE_MODES)}, not {mode!r}")
+        self.export_path = export_path
+        self.path = os.path.join(export_path, STORE_DIRNAME)
+        self.mode = mode
+        self.entries = {}
+        # the rows of each label's messages.tsv
+        self.indexed = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"CanonicalStore(path='{self.path}', mode='{self.mode}', messages={len(self.entries)})"
+
+    def __contains__(self, message_id):
+        entry = self.entries.get(message_id)
+        return entry is not None and entry.get('outputs') is not None
+
+    def message_path(self, message_id):
+        return os.path.join(self.path, message_id)
+
+    def export(self, exporter, label, message, path):
+        """
+        Write the message to the store the first time any label exports it,
+        then link its files into path. Returns the label's (format, path)
+        outputs, or None when the export failed, and the futures of files
+        still being written.
+        """
+        with self._lock:
+            entry = self.entries.setdefault(message.id, {'lock': threading.Lock()})
+        with entry['lock']:
+            # a message that failed is tried again by the next label
+            if entry.get('outputs') is None:
+                store_path = self.message_path(message.id)
+                os.makedirs(store_path, exist_ok=True)
+                entry['outputs'] = message.export(exporter, store_path)
+                # the pdf pool's futures are in the same order as the pdfs
+                pdfs = [write_path for format, write_path in entry['outputs'] or [] if format == 'pdf']
+                entry['pending'] = dict(zip(pdfs, message.pending))
+                entry['checksums'] = message.checksums
+        if entry['outputs'] is None:
+            return None, []
+        if self.mode == 'index':
+            self.write_index(label, message, path, entry['outputs'])
+            message.checksums.update(entry['checksums'])
+            return entry['outputs'], list(entry['pending'].values())
+        outputs = []
+        pending = []
+        for format, stored_path in entry['outputs']:
+            if stored_path is None:
+                outputs.append((format, None))
+                continue
+            link_path = os.path.join(path, os.path.basename(stored_path))
+            outputs.append((format, link_path))
+            # a link has the stored file's bytes
+            if stored_path in entry['checksums']:
+                message.checksums[link_path] = entry['checksums'][stored_path]
+            future = entry['pending'].get(stored_path)
+            if future is not None and self.mode == 'hardlink':
+                # a pdf can only be hardlinked once the pool has written it
+                pending.append(self.link_when_done(future, stored_path, link_path))
+            else:
+                self.link(stored_path, link_path)
+                if future is not None:
+                    pending.append(future)
+        return outputs, pending
+
+    def link_when_done(self, future, stored_path, link_path):
+        linked = Future()
+        def done(f):
+            if f.exception() is not None:
+                linked.set_exception(f.exception())
+                return
+            try:
+                self.link(stored_path, link_path)
+                linked.set_result(link_path)
+            except Exception as e:
+                linked.set_exception(e)
+        future.add_done_callback(done)
+        return linked
+
+    def link(self, stored_path, link_path):
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        if self.mode == 'symlink':
+            os.symlink(os.path.relpath(stored_path, os.path.dirname(link_path)), link_path)
+            return
+        try:
+            os.link(stored_path, link_path)
+        except OSError:
+            # no hardlinks across devices or on some filesystems
+            shutil.copy2(stored_path, link_path)
+
+    def write_index(self, label, message, path, outputs):
+        index_path = os.path.join(label.export_path, INDEX_FILENAME)
+        rows = [f"{message.id}\t{os.path.relpath(path, label.export_path)}\t{format}\t{os.path.relpath(stored_path, label.export_path)}\n"
+                for format, stored_path in outputs if stored_path is not None]
+        with self._lock:
+            # the rows already in the file are read once, so a run again doesn't repeat them
+            indexed = self.indexed.get(index_path)
+            if indexed is None:
+                indexed = self.indexed[index_path] = set()
+                if os.path.isfile(index_path):
+                    with open(index_path, 'r', encoding='utf-8') as infile:
+                        indexed.update(infile)
+            rows = [row for row in rows if not row in indexed]
+            indexed.update(rows)
+            if rows:
+                with open(index_path, 'a', encoding='utf-8') as outfile:
+                    outfile.writelines(rows)
+
+    def remove_index(self, label, message_ids):
+        # the label's rows for messages no longer in it
+        index_path = os.path.join(label.export_path, INDEX_FILENAME)
+        with self._lock:
+            if not os.path.isfile(index_path):
+                return
+            with open(index_path, 'r', encoding='utf-8') as infile:
+                rows = [row for row in infile if not row.split('\t', 1)[0] in message_ids]
+            with open(index_path, 'w', encoding='utf-8') as outfile:
+                outfile.writelines(rows)
+            self.indexed[index_path] = set(rows)
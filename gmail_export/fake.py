@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+import base64
+import email
+import random
+import re
+import threading
+import time
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import format_datetime
+from datetime import datetime, timezone
+
+from gmail_export.api import GmailAPI, METADATA_HEADERS
+from gmail_export.quota import QUOTA_UNITS, QuotaLimiter, get_units, get_stage
+from gmail_export.metrics import metrics
+
+
+# a 1x1 png, padded to the requested inline image size
+PNG_HEADER = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==')
+START_DATE = 1577836800000
+
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def random_bytes(rand, size):
+    return rand.getrandbits(8 * size).to_bytes(size, 'little') if size > 0 else b''
+
+
+class SyntheticMailbox(object):
+    """
+    A generated mailbox of messages threads deep, every message in every
+    label, with the given attachment sizes and inline image count. Messages
+    are built on demand from the seed so a large mailbox costs no memory,
+    and ids and thread ids follow gmail's, a thread's id is its first
+    message's id.
+    """
+    def __init__(self, messages=1000, thread_depth=3, labels=('Benchmark',), attachment_sizes=(), inline_images=0,
+                 inline_image_size=4096, body_size=2048, seed=0):
+        self.count = messages
+        self.thread_depth = max(1, thread_depth)
+        self.labels = [{'id': f'Label_{idx}', 'name': name, 'type': 'user'} for idx, name in enumerate(labels)]
+        self.attachment_sizes = list(attachment_sizes)
+        self.inline_images = inline_images
+        self.inline_image_size = inline_image_size
+        self.body_size = body_size
+        self.seed = seed
+        self.served = 0
+        self._lock = threading.Lock()
+        self._raw = {}
+        # history.list records of the messages added with append() and deleted with delete()
+        self.deleted = set()
+        self.history = []
+        # every search query messages.list was asked for
+        self.queries = []
+
+    def __repr__(self):
+        return f"SyntheticMailbox(messages={self.count}, thread_depth={self.thread_depth}, labels={len(self.labels)})"
+
+    def message_id(self, idx):
+        return f'{0x170000000000000 + idx:016x}'
+
+    def index(self, message_id):
+        return int(message_id, 16) - 0x170000000000000
+
+    def thread_id(self, idx):
+        return self.message_id(idx - idx % self.thread_depth)
+
+    def internal_date(self, idx):
+        return START_DATE + idx * 60000
+
+    def ids(self):
+        # newest first, like messages.list
+        return [(self.message_id(idx), self.thread_id(idx)) for idx in reversed(range(self.count)) if not self.message_id(idx) in self.deleted]
+
+    @property
+    def history_id(self):
+        return str(len(self.history) + 1)
+
+    def append(self, messages=1):
+        for idx in range(self.count, self.count + messages):
+            message = {'id': self.message_id(idx), 'threadId': self.thread_id(idx), 'labelIds': [label['id'] for label in self.labels]}
+            self.history.append({'id': str(len(self.history) + 2), 'messagesAdded': [{'message': message}]})
+        self.count += messages
+
+    def delete(self, message_id):
+        self.deleted.add(message_id)
+        message = {'id': message_id, 'threadId': self.thread_id(self.index(message_id))}
+        self.history.append({'id': str(len(self.history) + 2), 'messagesDeleted': [{'message': message}]})
+
+    def history_since(self, start_history_id):
+        return [record for record in self.history if int(record['id']) > int(start_history_id)]
+
+    def headers(self, idx):
+        root = idx - idx % self.thread_depth
+        subject = f'Synthetic thread {root}' if idx == root else f'Re: Synthetic thread {root}'
+        date = datetime.fromtimestamp(self.internal_date(idx) / 1000.0, tz=timezone.utc)
+        return [
+            {'name': 'Subject', 'value': subject},
+            {'name': 'From', 'value': f'Sender {idx % 7} <sender{idx % 7}@example.com>'},
+            {'name': 'To', 'value': 'Me <me@example.com>'},
+            {'name': 'Cc', 'value': f'Team {idx % 3} <team{idx % 3}@example.com>'},
+            {'name': 'Date', 'value': format_datetime(date)},
+            {'name': 'Message-ID', 'value': f'<{self.message_id(idx)}@synthetic>'}
+        ]
+
+    def build(self, idx):
+        rand = random.Random(self.seed * 1000003 + idx)
+        words = ' '.join(rand.choice(['invoice', 'meeting', 'report', 'lunch', 'project', 'update', 'receipt', 'schedule'])
+                         for _ in range(max(1, self.body_size // 8)))
+        images = ''.join(f'<img src="cid:image{n}@synthetic">' for n in range(self.inline_images))
+        html = MIMEMultipart('related')
+        html.attach(MIMEText(f'<html><body><p>{words}</p>{images}</body></html>', 'html'))
+        for n in range(self.inline_images):
+            image = MIMEImage(PNG_HEADER + random_bytes(rand, self.inline_image_size - len(PNG_HEADER)), 'png')
+            image.add_header('Content-ID', f'<image{n}@synthetic>')
+            image.add_header('Content-Disposition', 'inline', filename=f'image{n}.png')
+            html.attach(image)
+        msg = MIMEMultipart('mixed')
+        for header in self.headers(idx):
+            msg[header['name']] = header['value']
+        msg.attach(html)
+        for n, size in enumerate(self.attachment_sizes):
+            attachment = MIMEApplication(random_bytes(rand, size))
+            attachment.add_header('Content-Disposition', 'attachment', filename=f'attachment{n}.bin')
+            msg.attach(attachment)
+        return msg.as_bytes()
+
+    def raw(self, message_id):
+        with self._lock:
+            raw = self._raw.get(message_id)
+        if raw is None:
+            raw = self.build(self.index(message_id))
+            with self._lock:
+                # only the last few are kept, exports ask for each message once
+                if len(self._raw) > 256:
+                    self._raw.clear()
+                self._raw[message_id] = raw
+        return raw
+
+    def count_served(self, size):
+        with self._lock:
+            self.served += size
+
+    def meta(self, message_id, headers=None):
+        idx = self.index(message_id)
+        wanted = set(headers or METADATA_HEADERS)
+        return {
+            'id': message_id,
+            'threadId': self.thread_id(idx),
+            'labelIds': [label['id'] for label in self.labels],
+            'internalDate': str(self.internal_date(idx)),
+            'payload': {'headers': [header for header in self.headers(idx) if header['name'] in wanted]}
+        }
+
+    def full(self, message_id):
+        # the format=full structure, attachment bodies are served separately
+        message = self.meta(message_id)
+        attachments = {}
+        def part(msg, part_id):
+            headers = [{'name': name, 'value': value} for name, value in msg.items()]
+            payload = {'partId': part_id, 'mimeType': msg.get_content_type(), 'filename': msg.get_filename() or '', 'headers': headers}
+            if msg.is_multipart():
+                payload['body'] = {'size': 0}
+                payload['parts'] = [part(child, f'{part_id}.{n}' if part_id else str(n)) for n, child in enumerate(msg.get_payload())]
+            else:
+                data = msg.get_payload(decode=True) or b''
+                if payload['filename']:
+                    attachment_id = f'{message_id}-{part_id}'
+                    attachments[attachment_id] = data
+                    payload['body'] = {'size': len(data), 'attachmentId': attachment_id}
+                else:
+                    payload['body'] = {'size': len(data), 'data': encode(data)}
+            return payload
+        message['payload'] = part(email.message_from_bytes(self.raw(message_id)), '')
+        return message, attachments
+
+    def attachment(self, message_id, attachment_id):
+        return self.full(message_id)[1][attachment_id]
+
+    def thread(self, thread_id, headers=None):
+        root = self.index(thread_id)
+        ids = [self.message_id(idx) for idx in range(root, min(root + self.thread_depth, self.count))]
+        return {'id': thread_id, 'messages': [self.meta(message_id, headers) for message_id in ids]}
+
+
+class FakeRequest(object):
+    # stands in for a googleapiclient HttpRequest
+    def __init__(self, service, methodId, fn):
+        self.service = service
+        self.methodId = methodId
+        self.fn = fn
+
+    def execute(self, http=None, num_retries=0):
+        if self.service.latency:
+            time.sleep(self.service.latency)
+        return self.fn()
+
+
+class FakeBatch(object):
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        # one round trip for the whole batch
+        if self.service.latency:
+            time.sleep(self.service.latency)
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.fn(), None)
+            except Exception as e:
+                self.callback(request_id, None, e)
+
+
+class FakeResource(object):
+    def __init__(self, service, name):
+        self.service = service
+        self.name = name
+
+    def labels(self):
+        return FakeResource(self.service, 'labels')
+
+    def messages(self):
+        return FakeResource(self.service, 'messages')
+
+    def threads(self):
+        return FakeResource(self.service, 'threads')
+
+    def history(self):
+        return FakeResource(self.service, 'history')
+
+    def getProfile(self, userId='me'):
+        return FakeRequest(self.service, 'gmail.users.getProfile',
+                           lambda: {'emailAddress': 'me@example.com', 'messagesTotal': self.service.mailbox.count, 'historyId': self.service.mailbox.history_id})
+
+    def list(self, userId='me', labelIds=None, pageToken=None, maxResults=None, startHistoryId=None, **kwargs):
+        mailbox = self.service.mailbox
+        if self.name == 'labels':
+            return FakeRequest(self.service, 'gmail.users.labels.list', lambda: {'labels': mailbox.labels})
+        if self.name == 'history':
+            return FakeRequest(self.service, 'gmail.users.history.list', lambda: {'history': mailbox.history_since(startHistoryId), 'historyId': mailbox.history_id})
+        query = kwargs.get('q')
+        def page():
+            ids = mailbox.ids()
+            if query:
+                mailbox.queries.append(query)
+                # only rfc822msgid: terms are understood, the rest of a query matches everything
+                wanted = set(re.findall(r'rfc822msgid:<?([^\s}>]+)', query))
+                if wanted:
+                    ids = [(message_id, thread_id) for message_id, thread_id in ids if f'{message_id}@synthetic' in wanted]
+            start = int(pageToken or 0)
+            end = start + min(maxResults or 100, 500)
+            response = {'messages': [{'id': message_id, 'threadId': thread_id} for message_id, thread_id in ids[start:end]],
+                        'resultSizeEstimate': len(ids)}
+            if end < len(ids):
+                response['nextPageToken'] = str(end)
+            return response
+        return FakeRequest(self.service, f'gmail.users.{self.name}.list', page)
+
+    def get(self, userId='me', id=None, format='full', metadataHeaders=None):
+        mailbox = self.service.mailbox
+        if self.name == 'threads':
+            return FakeRequest(self.service, 'gmail.users.threads.get', lambda: mailbox.thread(id, metadataHeaders))
+        def message():
+            if format == 'raw':
+                raw = mailbox.raw(id)
+                mailbox.count_served(len(raw))
+                return dict(mailbox.meta(id, []), raw=encode(raw))
+            if format == 'metadata':
+                return mailbox.meta(id, metadataHeaders)
+            return mailbox.full(id)[0]
+        return FakeRequest(self.service, 'gmail.users.messages.get', message)
+
+
+class FakeService(object):
+    """
+    The parts of the gmail v1 discovery service the exporter calls, answered
+    from a SyntheticMailbox with latency seconds added to every round trip.
+    """
+    def __init__(self, mailbox, latency=0.0):
+        self.mailbox = mailbox
+        self.latency = latency
+
+    def users(self):
+        return FakeResource(self, 'users')
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+
+class FakeGmailAPI(GmailAPI):
+    """
+    A GmailAPI served by a FakeService, fully offline and without credentials.
+    Quota is unlimited unless a ceiling is given.
+    """
+    def __init__(self, mailbox, latency=0.0, ceiling=None):
+        self.mailbox = mailbox
+        self.credentials = None
+        self.token_path = None
+        self.credentials_path = None
+        self.scopes = []
+        self.limiter = QuotaLimiter(ceiling=ceiling or 10 ** 9)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.service = FakeService(mailbox, latency)
+
+    def __repr__(self):
+        return f"FakeGmailAPI(mailbox={self.mailbox!r}, latency={self.service.latency})"
+
+    def execute(self, request, units=None):
+        units = units or get_units(request)
+        return self.limiter.call(lambda: request.execute(), units, get_stage(request))
+
+    def download_attachment(self, message_id, attachment_id, outfile):
+        def download():
+            if self.service.latency:
+                time.sleep(self.service.latency)
+            data = self.mailbox.attachment(message_id, attachment_id)
+            self.mailbox.count_served(len(data))
+            outfile.write(data)
+            metrics.add('api messages.attachments.get', bytes=len(data))
+            return len(data)
+        return self.limiter.call(download, QUOTA_UNITS['gmail.users.messages.attachments.get'], 'api messages.attachments.get')
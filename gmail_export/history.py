@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import threading
+
+
+HISTORY_FILENAME = '.gmail_export_history.json'
+
+
+class HistoryState(object):
+    """
+    The mailbox historyId each label was last exported at, stored as json
+    at the export root so the next run only asks gmail for what changed.
+    A label exported with a search query is kept apart from the same label
+    with another query, so changing the query lists the label again.
+    """
+    def __init__(self, export_path):
+        self.path = os.path.join(export_path, HISTORY_FILENAME)
+        self._lock = threading.Lock()
+        self.history_ids = self.load()
+
+    def __repr__(self):
+        return f"HistoryState(path='{self.path}', labels={len(self.history_ids)})"
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as jsonfile:
+                return json.load(jsonfile)
+        except ValueError:
+            return {}
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as jsonfile:
+            json.dump(self.history_ids, jsonfile, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def key(self, label_id, query=None):
+        return f'{label_id} {query}' if query else label_id
+
+    def get(self, label_id, query=None):
+        return self.history_ids.get(self.key(label_id, query))
+
+    def set(self, label_id, history_id, query=None):
+        with self._lock:
+            self.history_ids[self.key(label_id, query)] = str(history_id)
+            self.save()
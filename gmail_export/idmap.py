@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import sqlite3
+import threading
+import time
+
+from gmail_export import AIRTABLE_IDMAP_PATH
+
+
+class AirtableIdMap(object):
+    """
+    Local sqlite map of labelId/threadId/messageId/Address to Airtable record
+    ids, with the fields last written for each record, so a sync only talks
+    to Airtable about keys it hasn't seen and records that changed.
+    """
+    def __init__(self, path=AIRTABLE_IDMAP_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS ids (tbl TEXT NOT NULL, key TEXT NOT NULL, atId TEXT NOT NULL, fields TEXT, PRIMARY KEY (tbl, key))')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+
+    def __repr__(self):
+        return f"AirtableIdMap(path='{self.path}')"
+
+    def get_many(self, table):
+        """
+        Returns a dict of key: (atId, fields) for one table.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT key, atId, fields FROM ids WHERE tbl=?', (table,)).fetchall()
+        return {key: (atId, json.loads(fields) if fields else {}) for key, atId, fields in rows}
+
+    def set_many(self, table, rows):
+        # rows of (key, atId, fields)
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO ids (tbl, key, atId, fields) VALUES (?, ?, ?, ?)',
+                                   [(table, key, atId, json.dumps(fields, sort_keys=True)) for key, atId, fields in rows])
+
+    def reconcile(self, table, records):
+        """
+        Replace the map for one table with Airtable's {key: (atId, fields)}.
+        """
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM ids WHERE tbl=?', (table,))
+            self._conn.executemany('INSERT INTO ids (tbl, key, atId, fields) VALUES (?, ?, ?, ?)',
+                                   [(table, key, atId, json.dumps(fields, sort_keys=True)) for key, (atId, fields) in records.items()])
+
+    @property
+    def reconciled(self):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE name='reconciled'").fetchone()
+        return float(row[0]) if row else 0.0
+
+    def mark_reconciled(self):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('reconciled', ?)", (str(time.time()),))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import threading
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+from gmail_export import IMAGE_CACHE_PATH, IMAGE_CACHE_TTL
+from gmail_export.metrics import metrics
+
+
+USER_AGENT = 'Mozilla/5.0 (compatible; gmail-export)'
+
+
+class ImageChecker(object):
+    """
+    Decides whether remote images in a message can be loaded. Urls are
+    deduplicated and checked in parallel with short HEAD requests on one pool
+    shared by every message, and once a host times out or refuses a connection
+    its other urls aren't requested. Results are cached per url and per
+    unreachable host and saved to `path` between runs for `ttl` seconds, path
+    None keeps them for this run only. In offline mode nothing goes over the
+    network, unknown urls are left as they are and the cache isn't saved.
+    """
+    def __init__(self, path=IMAGE_CACHE_PATH, ttl=IMAGE_CACHE_TTL, timeout=3, workers=16, offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        self.workers = workers
+        self.offline = offline
+        self._lock = threading.Lock()
+        self.urls = {}
+        self.hosts = {}
+        self._executor = None
+        self._changed = False
+        self.load()
+
+    def __repr__(self):
+        return f"ImageChecker(urls={len(self.urls)}, dead_hosts={len(self.hosts)}, offline={self.offline})"
+
+    def load(self):
+        urls, hosts = self.read()
+        with self._lock:
+            self.urls, self.hosts = urls, hosts
+
+    def read(self):
+        # the unexpired urls and dead hosts saved at path
+        if not self.path or not os.path.isfile(self.path):
+            return {}, {}
+        try:
+            with open(self.path, 'r') as jsonfile:
+                cached = json.load(jsonfile)
+        except ValueError:
+            return {}, {}
+        now = time.time()
+        urls = {url: value for url, value in cached.get('urls', {}).items() if now - value[1] < self.ttl}
+        hosts = {host: ts for host, ts in cached.get('hosts', {}).items() if now - ts < self.ttl}
+        return urls, hosts
+
+    def save(self):
+        # nothing to write when no url was checked since the last save
+        if not self.path or self.offline or not self._changed:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        # another process may have saved since this one loaded, the newest check of each url wins
+        urls, hosts = self.read()
+        with self._lock:
+            urls.update((url, value) for url, value in self.urls.items() if not url in urls or urls[url][1] <= value[1])
+            hosts.update((host, ts) for host, ts in self.hosts.items() if hosts.get(host, 0) <= ts)
+            self._changed = False
+        # a temporary file of its own so processes saving at once don't replace each other's
+        fd, tmp_path = tempfile.mkstemp(prefix=f'{os.path.basename(self.path)}.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as jsonfile:
+                json.dump({'urls': urls, 'hosts': hosts}, jsonfile)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def cached(self, url):
+        now = time.time()
+        with self._lock:
+            if url in self.urls and now - self.urls[url][1] < self.ttl:
+                return self.urls[url][0]
+            host = urlparse(url).netloc
+            if host in self.hosts and now - self.hosts[host] < self.ttl:
+                return False
+        return None
+
+    def check(self, urls):
+        """
+        Returns a dict of url: True when the image can be fetched.
+        """
+        results = {}
+        futures = {}
+        for url in dict.fromkeys(urls):
+            result = self.cached(url)
+            if result is not None:
+                results[url] = result
+            elif self.offline:
+                # not known to be broken, so the src stays
+                results[url] = True
+            else:
+                futures[url] = self.executor.submit(self.check_url, url)
+        for url, future in futures.items():
+            results[url] = future.result()
+        return results
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def check_url(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            dead = host in self.hosts
+        if dead:
+            return False
+        return self.fetch(url, host)
+
+    def fetch(self, url, host):
+        ok = False
+        host_alive = True
+        with metrics.timer('image check'):
+            try:
+                ok = self.request(url, 'HEAD')
+            except HTTPError as e:
+                # some servers refuse HEAD, ask for the first byte instead
+                if e.code in (403, 405, 501):
+                    try:
+                        ok = self.request(url, 'GET', {'Range': 'bytes=0-0'})
+                    except HTTPError:
+                        pass
+                    except (OSError, ValueError):
+                        host_alive = False
+            except ValueError:
+                pass
+            except OSError:
+                # URLError, timeouts and refused connections
+                host_alive = False
+        now = time.time()
+        with self._lock:
+            self.urls[url] = [ok, now]
+            self._changed = True
+            if not host_alive and host:
+                self.hosts[host] = now
+        return ok
+
+    def request(self, url, method, headers=None):
+        headers = dict(headers or {}, **{'User-Agent': USER_AGENT})
+        with urlopen(Request(url, method=method, headers=headers), timeout=self.timeout) as response:
+            return response.status < 400
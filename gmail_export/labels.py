@@ -1,16 +1,23 @@
 # -*- coding: utf-8 -*-
 import os
+import threading
 
 from .threads import GmailThread
 from .messages import GmailMessage
+from .pipeline import ExportPipeline
+from .pdf import PdfBook
+from .manifest import BOOK_FORMATS, APPENDED_FORMATS
+from .mailboxes import MAILBOX_FORMATS, MboxWriter, MaildirWriter, remove_mbox_messages
+from .archive import ArchiveSink
+from .utils import clean
+from .metrics import metrics
 
-from gmail_export import EXPORT_PATH
-import gmail_export.api as api
+from gmail_export import BATCH_SIZE
 
 
 class GmailLabel(object):
-    def __init__(self, id, name, selected=False):
-        self.api = api.GmailAPI()
+    def __init__(self, id, name, api, selected=False):
+        self.api = api
         self.id = id
         self.name = name
         self.selected = selected
@@ -25,47 +32,272 @@ class GmailLabel(object):
             return f"GmailLabel(id='{self.id}', name='{self.name}', atId={self.atId}, selected={self.selected})"
 
     def populate(self, exporter):
+        # list the whole label before exporting anything
+        for page in self.iter_populate(exporter):
+            pass
+
+    def iter_populate(self, exporter):
+        """
+        Returns a generator that lists the label a page at a time, yielding each
+        page's message ids once their messages and threads exist and their
+        metadata is filled in, so the export can start on the first page while
+        gmail lists the rest.
+        """
         print(f"\n> Label {self.id}: \"{self.name}\"")
         # labels don't have export path by default because we get that interactively
         # init the label path with the value of self.export_root retrieved from the CLI
         self.export_path = os.path.join(exporter.export_path, self.name)
-        # get the label messages for me
-        self.messageIds = self
-        for idx, messageId in enumerate(self.messageIds):
-            threadId = self.threadIds[idx]
+        # get the label messages for me, only the changes since the last run when incremental
+        self.removedIds = []
+        self._messageIds = []
+        self.threadIds = []
+        # gmail search filters are applied by the server when listing
+        self.query = exporter.config.get('query')
+        changes = None
+        start_history_id = exporter.history.get(self.id, self.query)
+        if exporter.config.get('incremental') and start_history_id:
+            changes = self.api.get_history_for_label(self, start_history_id)
+        if changes is None:
+            pages = self.api.iter_id_pages_for_label(self, self.query)
+        else:
+            messageIds, threadIds, self.removedIds = changes
+            if self.query and messageIds:
+                # the history api can't search, keep the changes that match the query
+                matching = self.api.filter_by_query(self, messageIds, self.query)
+                threadIds = [threadId for messageId, threadId in zip(messageIds, threadIds) if messageId in matching]
+                messageIds = [messageId for messageId in messageIds if messageId in matching]
+            pages = [list(zip(messageIds, threadIds))]
+        return self.iter_pages(exporter, pages)
+
+    def iter_pages(self, exporter, pages):
+        for page in pages:
+            yield self.add_page(exporter, page)
+        print(f"    Listed {len(self._messageIds)} messages.")
+
+    def add_page(self, exporter, page):
+        new_messages = []
+        for messageId, threadId in page:
+            self._messageIds.append(messageId)
+            self.threadIds.append(threadId)
             if not threadId in exporter.threads:
-                thread = GmailThread(threadId)
+                thread = GmailThread(threadId, self.api)
                 exporter.threads[threadId] = thread
             else:
                 thread = exporter.threads[threadId]
             if not messageId in exporter.messages:
-                exporter.messages[messageId] = GmailMessage(messageId, thread, self, exporter)
-                exporter.messages[messageId].meta = messageId
+                exporter.messages[messageId] = GmailMessage(messageId, thread, self, exporter, self.api)
+                thread.messages.append(exporter.messages[messageId])
+                new_messages.append(messageId)
             else:
                 exporter.messages[messageId].labels.append(self)
+        # fill message metadata a batch at a time instead of one request per message
+        gone = set(new_messages)
+        for i in range(0, len(new_messages), BATCH_SIZE):
+            metas = self.api.get_messages_meta(new_messages[i:i+BATCH_SIZE])
+            for messageId, response in metas.items():
+                exporter.messages[messageId].meta = response
+            gone.difference_update(metas)
+        # deleted between listing and the metadata fetch, there's nothing to export
+        for messageId in gone:
+            message = exporter.messages.pop(messageId)
+            message.thread.messages.remove(message)
+        if gone:
+            listed = [(messageId, threadId) for messageId, threadId in zip(self._messageIds, self.threadIds) if not messageId in gone]
+            self._messageIds = [messageId for messageId, _ in listed]
+            self.threadIds = [threadId for _, threadId in listed]
+        return [messageId for messageId, _ in page if not messageId in gone]
 
-    def export(self, exporter):
-        thread = None
-        os.makedirs(self.export_path,exist_ok=True)
+    def export(self, exporter, pages=None):
+        """
+        Export the label's messages, or the pages of ids from iter_populate as
+        they're listed. Returns a list of (messageId, exception) that failed.
+        """
+        if not getattr(exporter, 'archive', None):
+            os.makedirs(self.export_path,exist_ok=True)
         print(f"  > Path: {exporter.path}")
-        for idx, messageId in enumerate(self.messageIds):
-            # message = exporter.messages[messageId]
-            if not exporter.messages[messageId].thread is thread:
-                exporter.messages[messageId].thread.populate(exporter)
-                exporter.path = os.path.join(self.export_path, exporter.messages[messageId].thread.name)
-                os.makedirs(exporter.path,exist_ok=True)
-                print(f"      > Path: {exporter.path}")
-                exporter.messages[messageId].populate(exporter)
-                exporter.messages[messageId].export(exporter)
-            thread = getattr(exporter.messages[messageId], "thread", exporter.threads[self.threadIds[idx]])
+        self.books = {}
+        self.mailboxes = {}
+        self._books_lock = threading.Lock()
+        self._thread_locks = {}
+        self._thread_paths = {}
+        self.done = self.get_done_ids(exporter)
+        self.skipped = 0
+        # eml, html, pdf and attachments go straight into one archive for the label
+        self.archive = None
+        if getattr(exporter, 'archive', None):
+            # like the mbox, only a full export replaces the archive, anything else adds to it
+            replace = exporter.config.get('overwrite', True) and not exporter.config.get('incremental')
+            self.archive = ArchiveSink(os.path.join(exporter.export_path, clean(self.name)), self.export_path,
+                                       exporter.archive, replace)
+        messageIds = self.iter_pending(exporter, [self.messageIds] if pages is None else pages)
+        errors = []
+        if exporter.pipeline:
+            options = exporter.pipeline if isinstance(exporter.pipeline, dict) else {}
+            errors = ExportPipeline(exporter, **options).run(self, messageIds)
+        else:
+            for messageId in messageIds:
+                with metrics.profile(messageId):
+                    exporter.path = self.thread_path(exporter, exporter.messages[messageId].thread)
+                    exporter.messages[messageId].populate(exporter)
+                    self.write(exporter, exporter.messages[messageId], exporter.path)
+        if self.skipped:
+            print(f"  > Skipped {self.skipped} messages already exported")
+        for mailbox in self.mailboxes.values():
+            mailbox.close()
+        self.remove(exporter)
+        for book in self.books.values():
+            book.close(exporter.pdf_pool, self.archive)
+        errors = errors + exporter.pdf_pool.wait()
+        if getattr(exporter, 'search_index', None) is not None:
+            exporter.search_index.flush()
+        if self.archive is not None:
+            errors = errors + self.archive.close()
+        return errors
+
+    def remove(self, exporter):
+        """
+        Drop what was exported for the messages that left the label since the
+        last incremental run: the label's files, manifest rows, mbox and Maildir
+        entries and search index label. Files already in an archive stay there.
+        """
+        removed = set(getattr(self, 'removedIds', []))
+        if not removed:
+            return
+        manifest = getattr(exporter, 'manifest', None)
+        files = manifest.remove(self.id, removed) if manifest is not None else []
+        # only this label's own files, never the canonical store's
+        label_path = os.path.abspath(self.export_path)
+        for format, path in files:
+            if format in APPENDED_FORMATS or path is None or not os.path.abspath(path).startswith(os.path.join(label_path, '')):
+                continue
+            if os.path.lexists(path):
+                os.remove(path)
+            directory = os.path.dirname(os.path.abspath(path))
+            if directory != label_path and os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+        mbox_path = os.path.join(self.export_path, f'{clean(self.name)}.mbox')
+        if os.path.isfile(mbox_path):
+            remove_mbox_messages(mbox_path, removed)
+        maildir_path = os.path.join(self.export_path, 'Maildir')
+        if os.path.isdir(maildir_path):
+            MaildirWriter(maildir_path).remove(removed)
+        store = getattr(exporter, 'store', None)
+        if store is not None and store.mode == 'index':
+            store.remove_index(self, removed)
+        if getattr(exporter, 'search_index', None) is not None:
+            exporter.search_index.remove(removed, self.name, self.export_path)
+        print(f"  > Removed {len(removed)} messages no longer in the label")
+
+    def iter_pending(self, exporter, pages):
+        # messages already written are still rendered when they belong in a thread or label pdf
+        books = BOOK_FORMATS.intersection(exporter.config['formats'])
+        for page in pages:
+            for messageId in page:
+                if messageId in self.done:
+                    self.skipped += 1
+                    if not books:
+                        continue
+                yield messageId
+
+    def thread_path(self, exporter, thread):
+        # each thread is named and gets its directory once, whichever worker sees it first,
+        # so messages of a thread don't need to be listed together
+        formats = set(exporter.config['formats'])
+        if not (formats - BOOK_FORMATS - MAILBOX_FORMATS or 'thread pdf' in formats):
+            # mailboxes and label pdfs don't need thread names or directories
+            return self.export_path
+        with self._books_lock:
+            lock = self._thread_locks.setdefault(thread.id, threading.Lock())
+        with lock:
+            if not thread.id in self._thread_paths:
+                thread.populate(exporter)
+                path = os.path.join(self.export_path, thread.name)
+                # an archive or a messages.tsv index has no files under the thread's directory
+                store = getattr(exporter, 'store', None)
+                if self.archive is None and not (store is not None and store.mode == 'index'):
+                    os.makedirs(path, exist_ok=True)
+                print(f"      > Path: {path}")
+                self._thread_paths[thread.id] = path
+        return self._thread_paths[thread.id]
+
+    def get_done_ids(self, exporter):
+        # with overwrite off everything in the manifest is left as it is
+        manifest = getattr(exporter, 'manifest', None)
+        if manifest is None or exporter.config.get('overwrite', True):
+            return set()
+        return manifest.done_ids(self.id, exporter.config['formats'])
+
+    def write(self, exporter, message, path):
+        if not message.id in self.done:
+            store = getattr(exporter, 'store', None)
+            if store is None:
+                outputs, pending = message.export(exporter, path, self.archive), message.pending
+            else:
+                outputs, pending = store.export(exporter, self, message, path)
+            if outputs is not None:
+                outputs = outputs + self.add_to_mailboxes(exporter, message)
+            manifest = getattr(exporter, 'manifest', None)
+            if manifest is not None:
+                with metrics.timer('manifest'):
+                    manifest.record(self.id, message.id, outputs, pending, message.checksums)
+            search_index = getattr(exporter, 'search_index', None)
+            if search_index is not None and outputs is not None:
+                with metrics.timer('search index'):
+                    # a message that wasn't fetched, because it was stored or its attachments
+                    # were streamed, is indexed by the headers of its metadata
+                    search_index.add(message.id, [self.name], [path for _, path in outputs if path is not None], int(message.internalDate), message.get_search_fields())
+        self.add_to_books(exporter, message)
+        message.release()
+
+    def add_to_mailboxes(self, exporter, message):
+        # one mbox and/or maildir per label, returns the (format, path) written
+        outputs = []
+        for format in MAILBOX_FORMATS.intersection(exporter.config['formats']):
+            mailbox = self.get_mailbox(exporter, format)
+            with metrics.timer(f'write {format}', bytes=len(message.raw)):
+                write_path = mailbox.add(message.id, message.raw, message.internalDate)
+            outputs.append((format, mailbox.path if format == 'mbox' else write_path))
+            print(f"        > Saved {format}: {message.id}")
+        return outputs
+
+    def get_mailbox(self, exporter, format):
+        with self._books_lock:
+            if not format in self.mailboxes:
+                # not there yet when the rest of the label goes into an archive
+                os.makedirs(self.export_path, exist_ok=True)
+                if format == 'mbox':
+                    # a full export starts the mbox again when overwriting, anything else appends
+                    truncate = exporter.config.get('overwrite', True) and not exporter.config.get('incremental')
+                    self.mailboxes[format] = MboxWriter(os.path.join(self.export_path, f'{clean(self.name)}.mbox'), truncate)
+                else:
+                    self.mailboxes[format] = MaildirWriter(os.path.join(self.export_path, 'Maildir'))
+            return self.mailboxes[format]
+
+    def add_to_books(self, exporter, message):
+        # one pdf per thread and/or label, built from every exported message
+        formats = exporter.config['formats']
+        if not ('thread pdf' in formats or 'label pdf' in formats):
+            return
+        output = message.render().encode('utf-8')
+        sort_key = int(message.internalDate)
+        if 'thread pdf' in formats:
+            write_path = os.path.join(self.export_path, f'{message.thread.name}.pdf')
+            self.get_book(message.thread.id, write_path).add(output, sort_key)
+        if 'label pdf' in formats:
+            write_path = os.path.join(self.export_path, f'{clean(self.name)}.pdf')
+            self.get_book(self.id, write_path).add(output, sort_key)
+
+    def get_book(self, key, write_path):
+        with self._books_lock:
+            if not key in self.books:
+                if self.archive is None:
+                    os.makedirs(self.export_path, exist_ok=True)
+                self.books[key] = PdfBook(write_path)
+            return self.books[key]
 
     @property
     def messageIds(self):
-        return getattr(self, '_messageIds', {})
-
-    @messageIds.setter
-    def messageIds(self, label):
-        self._messageIds, self.threadIds = self.api.get_id_list_for_label(label)
+        return getattr(self, '_messageIds', [])
 
     # @property
     # def threads(self):
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import socket
+import threading
+import time
+
+
+# formats written to one mailbox per label instead of files per thread
+MAILBOX_FORMATS = frozenset(['mbox', 'maildir'])
+MBOX_BUFFER_SIZE = 1024 * 1024
+# mboxrd quoting, any line that looks like a From_ line gets one more >
+FROM_LINE = re.compile(rb'^(>*From )', re.MULTILINE)
+
+
+def read_mbox_index(index_path):
+    index = {}
+    if os.path.isfile(index_path):
+        with open(index_path, 'r') as infile:
+            for line in infile:
+                message_id, offset, length = line.rstrip('\n').split('\t')
+                index[message_id] = (int(offset), int(length))
+    return index
+
+
+def read_mbox_message(mbox_path, message_id):
+    """
+    One message's raw bytes from an exported mbox, found through its .index.
+    """
+    offset, length = read_mbox_index(f'{mbox_path}.index')[message_id]
+    with open(mbox_path, 'rb') as infile:
+        infile.seek(offset)
+        entry = infile.read(length)
+    # drop the From_ line and the blank line after the message
+    body = entry.split(b'\n', 1)[1][:-1]
+    return re.sub(rb'^>(>*From )', rb'\1', body, flags=re.MULTILINE)
+
+
+def remove_mbox_messages(mbox_path, message_ids):
+    """
+    Rewrite an exported mbox and its .index without the given messages.
+    Returns how many were removed.
+    """
+    index_path = f'{mbox_path}.index'
+    index = read_mbox_index(index_path)
+    removed = set(message_ids).intersection(index)
+    if not removed:
+        return 0
+    keep = sorted((offset, length, message_id) for message_id, (offset, length) in index.items() if not message_id in removed)
+    with open(mbox_path, 'rb') as infile, open(f'{mbox_path}.tmp', 'wb') as outfile, open(f'{index_path}.tmp', 'w') as index_file:
+        for old_offset, length, message_id in keep:
+            index_file.write(f'{message_id}\t{outfile.tell()}\t{length}\n')
+            infile.seek(old_offset)
+            outfile.write(infile.read(length))
+    os.replace(f'{mbox_path}.tmp', mbox_path)
+    os.replace(f'{index_path}.tmp', index_path)
+    return len(removed)
+
+
+class MboxWriter(object):
+    """
+    Appends every message of a label to one mboxrd file through one buffered
+    handle, with <name>.mbox.index holding each message id's byte offset and
+    length. Messages already in the index are left as they are, so an
+    interrupted or repeated run only adds what's missing. Each message is
+    flushed to the mbox before its index line and both before the manifest
+    records it, and an index left pointing past the end of a killed run's
+    mbox is cut back to the messages that made it.
+    """
+    def __init__(self, path, truncate=False):
+        self.path = path
+        self.index_path = f'{path}.index'
+        if truncate:
+            for stale in [self.path, self.index_path]:
+                if os.path.exists(stale):
+                    os.remove(stale)
+        self.index = read_mbox_index(self.index_path)
+        self.repair()
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab', buffering=MBOX_BUFFER_SIZE)
+        self._index_file = open(self.index_path, 'a', buffering=MBOX_BUFFER_SIZE)
+        self.offset = self._file.tell()
+
+    def __repr__(self):
+        return f"MboxWriter(path='{self.path}', messages={len(self.index)})"
+
+    def __contains__(self, message_id):
+        return message_id in self.index
+
+    def repair(self):
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        valid = {message_id: entry for message_id, entry in self.index.items() if entry[0] + entry[1] <= size}
+        end = max([offset + length for offset, length in valid.values()] or [0])
+        if len(valid) == len(self.index) and end == size:
+            return
+        # anything after the last whole indexed message is half written, it's added again
+        with open(self.path, 'ab') as outfile:
+            outfile.truncate(end)
+        with open(self.index_path, 'w') as index_file:
+            for message_id, (offset, length) in sorted(valid.items(), key=lambda item: item[1]):
+                index_file.write(f'{message_id}\t{offset}\t{length}\n')
+        self.index = valid
+
+    def add(self, message_id, raw, internalDate):
+        raw = raw.replace(b'\r\n', b'\n')
+        if not raw.endswith(b'\n'):
+            raw += b'\n'
+        from_line = f"From MAILER-DAEMON {time.asctime(time.gmtime(int(internalDate) / 1000.0))}\n".encode('ascii')
+        entry = from_line + FROM_LINE.sub(rb'>\1', raw) + b'\n'
+        with self._lock:
+            if message_id in self.index:
+                return self.index[message_id]
+            offset = self.offset
+            self._file.write(entry)
+            self._file.flush()
+            self.offset += len(entry)
+            self.index[message_id] = (offset, len(entry))
+            self._index_file.write(f'{message_id}\t{offset}\t{len(entry)}\n')
+            self._index_file.flush()
+        return offset, len(entry)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._index_file.close()
+
+
+class MaildirWriter(object):
+    """
+    A Maildir per label, each message written to tmp/ and renamed into new/
+    so readers never see a partial file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.hostname = socket.gethostname().replace('/', '\\057').replace(':', '\\072')
+        for subdir in ['tmp', 'new', 'cur']:
+            os.makedirs(os.path.join(path, subdir), exist_ok=True)
+
+    def __repr__(self):
+        return f"MaildirWriter(path='{self.path}')"
+
+    def add(self, message_id, raw, internalDate):
+        # named from the message id so a message exported again replaces itself
+        name = f'{int(internalDate) // 1000}.{message_id}.{self.hostname}'
+        tmp_path = os.path.join(self.path, 'tmp', name)
+        write_path = os.path.join(self.path, 'new', name)
+        with open(tmp_path, 'wb') as outfile:
+            outfile.write(raw)
+        os.replace(tmp_path, write_path)
+        return write_path
+
+    def remove(self, message_ids):
+        # a mail reader may have moved the message to cur/ and added flags to its name
+        removed = 0
+        for subdir in ['new', 'cur']:
+            for name in os.listdir(os.path.join(self.path, subdir)):
+                parts = name.split('.')
+                if len(parts) > 2 and parts[1] in message_ids:
+                    os.remove(os.path.join(self.path, subdir, name))
+                    removed += 1
+        return removed
+
+    def close(self):
+        pass
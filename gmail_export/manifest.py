@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+MANIFEST_FILENAME = '.gmail_export_manifest.sqlite'
+# formats built from many messages, these are never recorded per message
+BOOK_FORMATS = frozenset(['thread pdf', 'label pdf'])
+# formats appended to one file per label, recorded without a size or checksum
+APPENDED_FORMATS = frozenset(['mbox'])
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ChecksumWriter(io.RawIOBase):
+    """
+    A file being written that hashes the bytes on their way to outfile, so
+    the manifest doesn't read the file back. done(size, sha256) is called
+    once it's closed.
+    """
+    def __init__(self, outfile, done):
+        self._file = outfile
+        self._done = done
+        self._sha = hashlib.sha256()
+        self._size = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        # only so a TextIOWrapper can tell()
+        return True
+
+    def write(self, data):
+        written = self._file.write(data)
+        self._sha.update(memoryview(data)[:written])
+        self._size += written
+        return written
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if offset != 0 or whence != io.SEEK_CUR:
+            raise io.UnsupportedOperation("a checksummed file is only written forwards")
+        return self.tell()
+
+    def tell(self):
+        return self._size
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            self._done(self._size, self._sha.hexdigest())
+        super().close()
+
+
+class ExportManifest(object):
+    """
+    Every message written for each label under an export root, with the
+    formats written and each output's path, size and sha256, in one sqlite file at the root. A
+    message is recorded once all of its files are on disk, so a run that
+    doesn't overwrite skips everything recorded and an interrupted run
+    picks up at the first message it hadn't finished.
+    """
+    def __init__(self, export_path):
+        self.path = os.path.join(export_path, MANIFEST_FILENAME)
+        os.makedirs(export_path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS formats (labelId TEXT NOT NULL, messageId TEXT NOT NULL, format TEXT NOT NULL, written REAL NOT NULL, PRIMARY KEY (labelId, messageId, format))')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files (labelId TEXT NOT NULL, messageId TEXT NOT NULL, format TEXT NOT NULL, path TEXT NOT NULL, size INTEGER, sha256 TEXT, PRIMARY KEY (labelId, messageId, format, path))')
+
+    def __repr__(self):
+        return f"ExportManifest(path='{self.path}')"
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(DISTINCT messageId) FROM formats').fetchone()[0]
+
+    def done_ids(self, label_id, formats):
+        """
+        Ids of the label's messages already written in every one of formats
+        whose files are all still on disk.
+        """
+        formats = sorted(set(formats) - BOOK_FORMATS)
+        if not formats:
+            return set()
+        marks = ','.join('?' * len(formats))
+        with self._lock:
+            done = set(row[0] for row in self._conn.execute(
+                f'SELECT messageId FROM formats WHERE labelId=? AND format IN ({marks}) GROUP BY messageId HAVING COUNT(*)=?',
+                [label_id] + formats + [len(formats)]))
+            files = self._conn.execute(f'SELECT messageId, path FROM files WHERE labelId=? AND format IN ({marks})', [label_id] + formats).fetchall()
+        done.difference_update(messageId for messageId, path in files if messageId in done and not os.path.isfile(path))
+        return done
+
+    def record(self, label_id, message_id, outputs, pending=None, checksums=None):
+        """
+        outputs is a list of (format, path) written for one message, with
+        path None for a format that had nothing to write, or None when the
+        export failed. When some files are still being written by pending futures
+        the message is recorded after the last one finishes, and not at all
+        if any of them fail. checksums maps the paths written through a
+        ChecksumWriter to their (size, sha256), only the others are read back.
+        """
+        if outputs is None:
+            return
+        pending = list(pending or [])
+        if not pending:
+            self.write(label_id, message_id, outputs, checksums)
+            return
+        remaining = [len(pending)]
+        lock = threading.Lock()
+        def finished(future):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last and all(f.exception() is None for f in pending):
+                self.write(label_id, message_id, outputs, checksums)
+        for future in pending:
+            future.add_done_callback(finished)
+
+    def write(self, label_id, message_id, outputs, checksums=None):
+        now = time.time()
+        checksums = checksums or {}
+        files = []
+        for format, path in outputs:
+            if format in APPENDED_FORMATS:
+                files.append((label_id, message_id, format, path, None, None))
+            elif path is not None and os.path.isfile(path):
+                # pdfs come from wkhtmltopdf, they're the files still read back
+                size, sha256 = checksums.get(path) or (os.path.getsize(path), file_checksum(path))
+                files.append((label_id, message_id, format, path, size, sha256))
+        formats = set(format for format, _ in outputs)
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('DELETE FROM files WHERE labelId=? AND messageId=? AND format=?', [(label_id, message_id, format) for format in formats])
+            self._conn.executemany('INSERT OR REPLACE INTO formats (labelId, messageId, format, written) VALUES (?, ?, ?, ?)',
+                                   [(label_id, message_id, format, now) for format in formats])
+            self._conn.executemany('INSERT OR REPLACE INTO files (labelId, messageId, format, path, size, sha256) VALUES (?, ?, ?, ?, ?, ?)', files)
+            self._conn.execute('COMMIT')
+
+    def remove(self, label_id, message_ids):
+        """
+        Forget the label's messages, returns the (format, path) of their files.
+        """
+        files = []
+        with self._lock:
+            self._conn.execute('BEGIN')
+            for message_id in message_ids:
+                files.extend(self._conn.execute('SELECT format, path FROM files WHERE labelId=? AND messageId=?', (label_id, message_id)).fetchall())
+                self._conn.execute('DELETE FROM files WHERE labelId=? AND messageId=?', (label_id, message_id))
+                self._conn.execute('DELETE FROM formats WHERE labelId=? AND messageId=?', (label_id, message_id))
+            self._conn.execute('COMMIT')
+        return files
+
+    def files(self, message_id):
+        with self._lock:
+            return self._conn.execute('SELECT labelId, format, path, size, sha256 FROM files WHERE messageId=?', (message_id,)).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,35 +1,88 @@
 # -*- coding: utf-8 -*-
+import io
 import os
 import re
 import functools
 import base64
 import html
 import email
+import threading
 from email.utils import parseaddr
-import magic
 import pendulum
-from subprocess import Popen, PIPE
-from jinja2 import Environment, PackageLoader, select_autoescape
-from bs4 import BeautifulSoup, NavigableString, Tag
-from rfc6266_parser import parse_headers, build_header
 
-from gmail_export import WKHTMLTOPDF_EXTERNAL_COMMAND, WKHTMLTOPDF_ERRORS_IGNORE, IMAGE_LOAD_BLACKLIST, FatalException
+from gmail_export import IMAGE_LOAD_BLACKLIST, FatalException
 from gmail_export.utils import clean, html_escape, can_url_fetch
-import gmail_export.api as api
+from gmail_export.pdf import wkhtmltopdf
+from gmail_export.attachments import iter_payload_parts, get_part_disposition
+from gmail_export.manifest import BOOK_FORMATS, ChecksumWriter
+from gmail_export.mailboxes import MAILBOX_FORMATS
+from gmail_export.metrics import metrics
+
+# bs4, html5lib, jinja2, libmagic and rfc6266 are imported by the formats that need them,
+# an eml only export never loads them
+_env = None
+
+
+def get_env():
+    global _env
+    if _env is None:
+        from jinja2 import Environment, PackageLoader, select_autoescape
+        _env = Environment(
+            loader=PackageLoader('gmail_export','templates'),
+            autoescape=select_autoescape([ 'xml'])
+        )
+    return _env
+
+# libmagic only looks at the start of a buffer
+MAGIC_SNIFF_BYTES = 8192
+_magic_lock = threading.Lock()
+_magic_handle = None
+
+
+def get_magic_handle():
+    # pylint: disable=no-member
+    global _magic_handle
+    with _magic_lock:
+        if _magic_handle is None:
+            import magic
+            if hasattr(magic, 'Magic'):
+                _magic_handle = magic.Magic(mime=True).from_buffer
+            else:
+                m_handle = magic.open(magic.MAGIC_MIME_TYPE)
+                m_handle.load()
+                _magic_handle = m_handle.buffer
+    return _magic_handle
+
+
+@functools.lru_cache(maxsize=1024)
+def sniff_mime_type(buffer_data):
+    from_buffer = get_magic_handle()
+    with _magic_lock:
+        mime_type = from_buffer(buffer_data)
+    if type(mime_type) is not str:
+        # Older versions of python-magic seem to output bytes for the
+        # mime_type name. As of Python 3.6+, it seems to be outputting
+        # strings directly.
+        mime_type = str(mime_type, 'utf-8')
+    return mime_type
+
+# formats that can be written from the api's message structure without the raw message
+STREAMED_FORMATS = frozenset(['attachments', 'inline'])
 
-env = Environment(
-    loader=PackageLoader('gmail_export','templates'),
-    autoescape=select_autoescape([ 'xml'])
-)
 
 class GmailMessage(object):
-    def __init__(self, id, thread, label, exporter=None):
-        self.api = api.GmailAPI()
+    def __init__(self, id, thread, label, exporter=None, api=None):
+        self.api = api if api is not None else exporter.api
         self.id = id
         self.labels = [label]
         self.thread = thread
         self.threadId = thread.id
         self.exporter = exporter
+        self._rendered = None
+        self._render_lock = threading.Lock()
+        self.pending = []
+        # (size, sha256) of each file written, for the manifest
+        self.checksums = {}
 
         # self.msg_dt, self.subject = self.get_name_parts()
 
@@ -53,9 +106,10 @@ class GmailMessage(object):
         return getattr(self,'_meta',{})
 
     @meta.setter
-    def meta(self, id):
+    def meta(self, value):
+        # accepts a message id to fetch or an already fetched metadata response
         _meta = {}
-        response = self.api.get_message_meta(id)
+        response = value if isinstance(value, dict) else self.api.get_message_meta(value)
         headers = response['payload']['headers']
         subject = [header['value'] for header in headers if header['name']=="Subject"]
         if subject == []:
@@ -73,6 +127,14 @@ class GmailMessage(object):
     def msg(self):
         return getattr(self, '_msg', None)
 
+    @property
+    def raw(self):
+        # the message bytes as gmail sent them, for the mailbox formats
+        raw = getattr(self, '_raw', None)
+        if raw is None and self.msg is not None:
+            raw = self.msg.as_bytes()
+        return raw
+
     @property
     def msg_dt(self):
         return self.exporter.get_datetime(self.internalDate).format('YYYY-MM-DD-THHmmss')
@@ -124,35 +186,121 @@ class GmailMessage(object):
         return output
 
     def populate(self, exporter):
-        self.get_mime_msg()
+        if self.is_stored(exporter):
+            print(f"        Message {self.id}: {self.name} (stored)")
+            return
+        if not (getattr(exporter, 'stream_attachments', False) and STREAMED_FORMATS.issuperset(exporter.config['formats'])):
+            self.get_mime_msg()
         print(f"        Message {self.id}: {self.name}")
 
-    def export(self, exporter):
+    def is_stored(self, exporter):
+        # written for another label already and only to be linked, unless a thread or label pdf needs
+        # the render or a label mailbox needs the raw message
+        store = getattr(exporter, 'store', None)
+        return store is not None and self.id in store and not (BOOK_FORMATS | MAILBOX_FORMATS).intersection(exporter.config['formats'])
+
+    def export(self, exporter, path=None, archive=None):
+        """
+        Returns a list of (format, path) written, None for a format with nothing
+        to write, or None if a file couldn't be written. Pdfs still being written
+        by the pdf pool are in self.pending. With an ArchiveSink the files go
+        into the archive instead of under path.
+        """
+        path = path or exporter.path
+        outputs = []
+        self.pending = []
+        self.archive = archive
         if 'eml' in exporter.config['formats']:
             eml_name = f'{self.msg_dt}-Eml-{clean(self.subject)[:128]}.eml'
-            self.export_eml(exporter.path, eml_name)
+            outputs.append(('eml', self.export_eml(path, eml_name)))
+            if outputs[-1][1] is None:
+                return None
         if 'html' in exporter.config['formats']:
             html_name = f'{self.msg_dt}-Eml-{clean(self.subject)[:128]}.html'
-            self.export_html(exporter.path, html_name)
+            outputs.append(('html', self.export_html(path, html_name)))
         if 'pdf' in exporter.config['formats']:
             pdf_name = f'{self.msg_dt}-Eml-{clean(self.subject)[:128]}.pdf'
-            self.export_pdf(exporter.path, pdf_name)
+            outputs.append(('pdf', self.export_pdf(path, pdf_name)))
         if 'attachments' in exporter.config['formats']:
             att_name = f'{self.msg_dt}-EmlAtt'
-            self.export_content(exporter.path, att_name, False)
+            outputs.extend(('attachments', write_path) for write_path in self.export_content(path, att_name, False) or [None])
         if 'inline' in exporter.config['formats']:
             inl_name = f'{self.msg_dt}-Inline'
-            self.export_content(exporter.path, inl_name, True)
+            outputs.extend(('inline', write_path) for write_path in self.export_content(path, inl_name, True) or [None])
+        return outputs
+
+    def open_output(self, write_path, mode='wb'):
+        if getattr(self, 'archive', None) is not None:
+            return self.archive.open_output(write_path, mode)
+        def written(size, sha256):
+            self.checksums[write_path] = (size, sha256)
+        outfile = ChecksumWriter(open(write_path, 'wb'), written)
+        if 'b' in mode:
+            return outfile
+        return io.TextIOWrapper(outfile)
+
+    def release(self):
+        # drop the parsed mime message and render once everything is written
+        self.archive = None
+        # a manifest record still waiting on pdfs keeps the old checksums
+        self.checksums = {}
+        self._msg = None
+        self._raw = None
+        self._text = None
+        self._parts = None
+        self._dispositions = None
+        self._cid_uris = {}
+        self._payload = None
+        self._rendered = None
 
     def get_mime_msg(self):
         print(f"        Fetching mime msg", end="\r")
-        # get entire message in RFC2822 formatted base64url encoded string to convert to .eml
-        msg_raw = self.api.get_message_id(self.id)
-        msg_bytes = base64.urlsafe_b64decode(msg_raw['raw'])
-        mime_msg = email.message_from_bytes(msg_bytes)
+        # messages never change so a cached copy is always good
+        cache = getattr(self.exporter, 'cache', None)
+        msg_bytes = cache.get(self.id) if cache is not None else None
+        if msg_bytes is None:
+            # get entire message in RFC2822 formatted base64url encoded string to convert to .eml
+            msg_raw = self.api.get_message_id(self.id)
+            msg_bytes = base64.urlsafe_b64decode(msg_raw['raw'])
+            if cache is not None:
+                cache.put(self.id, msg_bytes)
+        with metrics.timer('parse mime', bytes=len(msg_bytes)):
+            mime_msg = email.message_from_bytes(msg_bytes)
+        self._raw = msg_bytes
         self._msg = mime_msg
+        self._parts = None
+        self._dispositions = None
+        self._cid_uris = {}
         return mime_msg
 
+    def get_text(self):
+        # the body as plain text, from the render when there was one
+        text = getattr(self, '_text', None)
+        if text is not None or self.msg is None:
+            return text
+        part = self.get_part_by_content_type("text/plain")
+        if part is not None:
+            charset = part.get_content_charset() or 'utf-8'
+            text = str(part.get_payload(decode=True) or b'', charset, errors='replace')
+        else:
+            part = self.get_part_by_content_type("text/html")
+            if part is None:
+                return ''
+            from bs4 import BeautifulSoup
+            charset = part.get_content_charset() or 'utf-8'
+            text = BeautifulSoup(str(part.get_payload(decode=True) or b'', charset, errors='replace'), "html5lib").get_text(' ', strip=True)
+        self._text = text
+        return text
+
+    def get_search_fields(self):
+        headers = self.headers
+        return {
+            'subject': self.subject,
+            'sender': ' '.join(headers['From'] or []),
+            'recipients': ' '.join((headers['To'] or []) + (headers['Cc'] or [])),
+            'body': self.get_text()
+        }
+
     def get_message_body(self):
         part = self.get_part_by_content_type("text/html")
         if not part is None:
@@ -162,49 +310,66 @@ class GmailMessage(object):
             return self.handle_plain_message_body(part)
         raise FatalException("Email message has no body")
 
+    def render(self):
+        # html and pdf share a single render of the message
+        with self._render_lock:
+            if self._rendered is None:
+                with metrics.timer('render'):
+                    self._rendered = self.convert()
+            return self._rendered
+
     def convert(self):
-        self.meta = self.id
+        if not self.meta:
+            self.meta = self.id
         try:
             body = self.get_message_body()
         except:
             body = ""
-        body = self.clean_soup(body)
+        with metrics.timer('clean soup'):
+            body = self.clean_soup(body)
         self.attachments = self.find_attachments()
+        from rfc6266_parser import parse_headers
         content_disposition_list = [parse_headers(att[0]) for att in self.attachments]
         att_list = []
         for cd in content_disposition_list:
             att_list.append({'filename': cd.filename_unsafe})
-        template = env.get_template('email.html')
+        template = get_env().get_template('email.html')
         rendered = template.render(headers=self.headers, body=body, attachments=att_list)
         return rendered
 
     def clean_soup(self, payload):
+        from bs4 import BeautifulSoup, Tag
         soup = BeautifulSoup(payload, "html5lib")
         soup.html.hidden = True
         soup.body.hidden = True
         soup.head.hidden = True
-        images = soup.findAll('img')
+        images = [img for img in soup.findAll('img') if img.has_attr('src')]
+        remote_images = []
         for img in images:
-            if img.has_attr('src'):
-                src = img['src']
-                lower_src = src.lower()
-                if lower_src == 'broken':
+            src = img['src']
+            lower_src = src.lower()
+            if lower_src == 'broken':
+                del img['src']
+            elif not lower_src.startswith('data'):
+                found_blacklist = False
+                for image_load_blacklist_item in IMAGE_LOAD_BLACKLIST:
+                    if image_load_blacklist_item in lower_src:
+                        found_blacklist = True
+                if not found_blacklist:
+                    remote_images.append(img)
+                else:
                     del img['src']
-                elif not lower_src.startswith('data'):
-                    found_blacklist = False
-                    for image_load_blacklist_item in IMAGE_LOAD_BLACKLIST:
-                        if image_load_blacklist_item in lower_src:
-                            found_blacklist = True
-                    if not found_blacklist:
-                        if not can_url_fetch(src):
-                            del img['src']
-                    else:
-                        del img['src']
+        fetchable = self.check_urls([img['src'] for img in remote_images])
+        for img in remote_images:
+            if not fetchable[img['src']]:
+                del img['src']
         for br in soup.findAll("br"):
             while isinstance(br.next_sibling, Tag) and br.next_sibling.name == 'br':
                 br.next_sibling.extract()
         for meta in soup.findAll("meta"):
             meta.extract()
+        # the text is kept for the search index
+        self._text = soup.get_text(' ', strip=True)
         for font in soup.findAll('font'):
             if font.has_attr('face'):
                 face = font['face']
@@ -219,40 +384,54 @@ class GmailMessage(object):
         return str(soup.prettify('utf-8').decode('utf-8'))
 
 
+    def check_urls(self, urls):
+        # all the remote images of a message are checked together
+        image_checker = getattr(self.exporter, 'image_checker', None)
+        if image_checker is not None:
+            return image_checker.check(urls)
+        results = {}
+        for url in dict.fromkeys(urls):
+            with metrics.timer('image check'):
+                results[url] = can_url_fetch(url)
+        return results
+
+    @property
+    def parts(self):
+        # one walk of the mime tree serves every part lookup
+        if getattr(self, '_parts', None) is None and self.msg is not None:
+            self._parts = self.index_parts(self.msg)
+        return self._parts
+
+    def index_parts(self, msg):
+        index = {
+            'content_type': {},
+            'content_id': {},
+            'name': {},
+            'disposition': []
+        }
+        for part in msg.walk():
+            index['content_type'].setdefault(part.get_content_type(), part)
+            if part['Content-ID'] is not None:
+                index['content_id'].setdefault(part['Content-ID'], part)
+            name = part.get_param('name', header="Content-Type")
+            if name is not None:
+                index['name'].setdefault(name, part)
+            if 'content-disposition' in part:
+                index['disposition'].append(part)
+        return index
+
     def get_part_by_content_type(self, content_type):
-        for part in self.msg.walk():
-            if part.get_content_type() == content_type:
-                return part
-        return None
+        return self.parts['content_type'].get(content_type)
     
     def get_part_by_content_id(self, content_id):
-        for part in self.msg.walk():
-            if part['Content-ID'] in (content_id, '<' + content_id + '>'):
-                return part
-        return None
+        content_ids = self.parts['content_id']
+        return content_ids.get(content_id, content_ids.get('<' + content_id + '>'))
 
     def get_part_by_content_type_name(self, content_type_name):
-        for part in self.msg.walk():
-            part_content_type = part.get_param('name', header="Content-Type")
-            if part_content_type == content_type_name:
-                return part
-        return None
+        return self.parts['name'].get(content_type_name)
 
     def get_mime_type(self, buffer_data):
-        # pylint: disable=no-member
-        if 'from_buffer' in dir(magic):
-            mime_type = magic.from_buffer(buffer_data, mime=True)
-            if type(mime_type) is not str:
-                # Older versions of python-magic seem to output bytes for the
-                # mime_type name. As of Python 3.6+, it seems to be outputting
-                # strings directly.
-                mime_type = str(
-                    magic.from_buffer(buffer_data, mime=True), 'utf-8')
-        else:
-            m_handle = magic.open(magic.MAGIC_MIME_TYPE)
-            m_handle.load()
-            mime_type = m_handle.buffer(buffer_data)
-        return mime_type
+        return sniff_mime_type(bytes(buffer_data[:MAGIC_SNIFF_BYTES]))
 
     def handle_html_message_body(self, part):
         payload = part.get_payload(decode=True)
@@ -289,6 +468,12 @@ class GmailMessage(object):
 
     def replace_cid(self, matchobj):
         cid = matchobj.group(1)
+        # the same inline image is often referenced more than once
+        if not cid in self._cid_uris:
+            self._cid_uris[cid] = self.get_cid_uri(cid)
+        return self._cid_uris[cid]
+
+    def get_cid_uri(self, cid):
         image_part = self.get_part_by_content_id(cid)
 
         if image_part is None:
@@ -309,84 +494,110 @@ class GmailMessage(object):
     def export_eml(self, export_path, eml_name):
         write_path = os.path.join(export_path, eml_name)
         try:
-            with open(write_path, 'w') as outfile:
+            with metrics.timer('write eml') as timing, self.open_output(write_path, 'w') as outfile:
                 gen = email.generator.Generator(outfile)
                 gen.flatten(self.msg)
+                timing.bytes = outfile.tell()
             print(f"        > Saved eml:  {eml_name}")
             return write_path
         except:
             return None
 
     def export_html(self, export_path, html_name):
-        output = self.convert().encode('utf-8')
+        output = self.render().encode('utf-8')
         write_path = os.path.join(export_path, html_name)
-        with open(write_path, 'wb') as outfile:
+        with metrics.timer('write html', bytes=len(output)), self.open_output(write_path, 'wb') as outfile:
             outfile.write(output)
             print(f"        > Saved html: {html_name}")
         return write_path
 
     def export_pdf(self, export_path, pdf_name):
-        output = self.convert().encode('utf-8')
+        output = self.render().encode('utf-8')
         write_path = os.path.join(export_path, pdf_name)
-        wkh2p_process = Popen([WKHTMLTOPDF_EXTERNAL_COMMAND, '-q',
-                               '--load-error-handling', 'ignore',
-                               '--load-media-error-handling', 'ignore',
-                               '--encoding', 'utf-8', '-s', 'Letter',
-                               '-', write_path],
-                              stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        output, error = wkh2p_process.communicate(input=output)
-        ret_code = wkh2p_process.returncode
-        assert output == b''
-        self.process_errors(ret_code, error)
-        print(f"        > Saved pdf:  {pdf_name}")
+        archive = getattr(self, 'archive', None)
+        # wkhtmltopdf needs a real file, it's moved into the archive once written
+        pdf_path = write_path if archive is None else archive.temp_path(write_path)
+        pdf_pool = getattr(self.exporter, 'pdf_pool', None)
+        if pdf_pool is None:
+            wkhtmltopdf(['-'], pdf_path, output)
+            if archive is not None:
+                archive.add_file(archive.arcname(write_path), pdf_path)
+            print(f"        > Saved pdf:  {pdf_name}")
+            return write_path
+        future = pdf_pool.submit(output, pdf_path)
+        if archive is not None:
+            archive.add_when_done(future, archive.arcname(write_path), pdf_path)
+        self.pending.append(future)
+        future.add_done_callback(lambda f: f.exception() is None and print(f"        > Saved pdf:  {pdf_name}"))
         return write_path
 
-    def process_errors(self, ret_code, error):
-        stripped_error = str(error, 'utf-8')
-        # suppress certain errors
-        for error_pattern in WKHTMLTOPDF_ERRORS_IGNORE:
-            (stripped_error, _) = re.subn(error_pattern, '', stripped_error)
-
-        original_error = str(error, 'utf-8').rstrip()
-        stripped_error = stripped_error.rstrip()
-
-        if ret_code > 0 and original_error == '':
-            raise FatalException("wkhtmltopdf failed with exit code " +
-                                 str(ret_code) +
-                                 ", no error output.")
-        elif ret_code > 0 and stripped_error != '':
-            raise FatalException("wkhtmltopdf failed with exit code " +
-                                 str(ret_code) +
-                                 ", stripped error: " + stripped_error)
-        elif stripped_error != '':
-            print("wkhtmltopdf exited with rc = 0 but produced \
-                    unknown stripped error output " + stripped_error)
-
     def export_content(self, export_path, name, inline=False):
+        # when the raw message was fetched for another format its parts are already here
+        if getattr(self.exporter, 'stream_attachments', False) and self.msg is None:
+            return self.stream_content(export_path, name, inline)
         attachments = self.find_attachments(inline)
+        from rfc6266_parser import parse_headers
+        written = []
         for content_disposition, part in attachments:
             filename = parse_headers(content_disposition).filename_unsafe
             nm, ex = os.path.splitext(filename)
             content_name = f'{name}-{nm[:128]}{ex}'
             write_path = os.path.join(export_path, content_name)
-            with open(write_path, 'wb') as outfile:
+            with metrics.timer('write inline' if inline else 'write attachments') as timing, self.open_output(write_path, 'wb') as outfile:
                 data = part.get_payload(decode=True)
                 outfile.write(data)
+                timing.bytes = len(data)
+            written.append(write_path)
             str_inline="inline " if inline else ""
             print(f"          > Saved {str_inline}content: {content_name}")
-        return True
+        return written
+
+    def stream_content(self, export_path, name, inline=False):
+        # large parts go from the attachments api straight to disk instead of through the raw message
+        wanted = 'inline' if inline else 'attachment'
+        written = []
+        if getattr(self, '_payload', None) is None:
+            self._payload = self.api.get_message_full(self.id)['payload']
+        for part in iter_payload_parts(self._payload):
+            if not part.get('filename') or get_part_disposition(part) != wanted:
+                continue
+            nm, ex = os.path.splitext(part['filename'])
+            content_name = f'{name}-{nm[:128]}{ex}'
+            write_path = os.path.join(export_path, content_name)
+            # includes the download, its share is under 'api messages.attachments.get'
+            with metrics.timer('write inline' if inline else 'write attachments') as timing, self.open_output(write_path, 'wb') as outfile:
+                body = part.get('body', {})
+                if 'attachmentId' in body:
+                    self.api.download_attachment(self.id, body['attachmentId'], outfile)
+                else:
+                    outfile.write(base64.urlsafe_b64decode(body.get('data', '')))
+                timing.bytes = outfile.tell()
+            written.append(write_path)
+            str_inline="inline " if inline else ""
+            print(f"          > Saved {str_inline}content: {content_name}")
+        return written
 
     def find_attachments(self, inline=False):
         """
         Return a tuple of parsed content-disposition dict, message object for each attachment found
         """
-        attachments = []
-        for part in self.msg.walk():
-            if 'content-disposition' not in part: continue
+        wanted = 'inline' if inline else 'attachment'
+        return [(parsed, part) for disposition, parsed, part in self.dispositions if disposition == wanted]
+
+    @property
+    def dispositions(self):
+        # the content-disposition of every part is parsed once, whichever formats ask for it
+        if getattr(self, '_dispositions', None) is None:
+            self._dispositions = self.parse_dispositions()
+        return self._dispositions
+
+    def parse_dispositions(self):
+        from rfc6266_parser import parse_headers, build_header
+        dispositions = []
+        for part in self.parts['disposition']:
             cd_part="".join(part['content-disposition'].splitlines())
             cd_part=cd_part.replace('\t','')
             cd_part_list = re.split(''';(?=(?:[^'"]|'[^']*'|"[^"]*")*$)''', cd_part)
-            prefixes = ['attach','inline','filenam']
             cd_part_list = [i.strip() for i in cd_part_list]
             cd_part = ";".join(cd_part_list)
             try:
@@ -396,14 +607,7 @@ class GmailMessage(object):
             disposition = content_disposition.disposition
             if not disposition in ['attachment', 'inline']:
                 continue
-            if not inline:
-                if disposition == 'attachment':
-                    try: parsed = build_header(content_disposition.filename_unsafe)
-                    except TypeError: continue
-                    attachments.append((parsed, part))
-            elif inline:
-                if disposition == 'inline':
-                    try: parsed = build_header(content_disposition.filename_unsafe)
-                    except TypeError: continue
-                    attachments.append((parsed, part))
-        return attachments
+            try: parsed = build_header(content_disposition.filename_unsafe)
+            except TypeError: continue
+            dispositions.append((disposition, parsed, part))
+        return dispositions
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import json
+import time
+import bisect
+import pstats
+import cProfile
+import threading
+import contextlib
+
+
+METRICS_FILENAME = 'export_metrics'
+# seconds, the prometheus default buckets stretched for wkhtmltopdf
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PROFILE_LINES = 40
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def __repr__(self):
+        return f"Histogram(count={self.count}, sum={self.sum:.3f})"
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        # (upper bound, observations at or under it) with '+Inf' last, like prometheus
+        total = 0
+        result = []
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        # the upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return None
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return bound
+
+
+class Stage(object):
+    def __init__(self):
+        self.histogram = Histogram()
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.units = 0
+
+    def __repr__(self):
+        return f"Stage(calls={self.histogram.count}, seconds={self.histogram.sum:.3f})"
+
+    def report(self):
+        calls = self.histogram.count
+        return {
+            'calls': calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'seconds': round(self.histogram.sum, 6),
+            'mean': round(self.histogram.sum / calls, 6) if calls else None,
+            'p50': self.histogram.quantile(0.5),
+            'p95': self.histogram.quantile(0.95),
+            'bytes': self.bytes,
+            'quota_units': self.units,
+            'buckets': {str(bound): total for bound, total in self.histogram.cumulative()}
+        }
+
+
+class Timing(object):
+    # set bytes or units inside a timer block once they're known
+    def __init__(self, bytes=0, units=0):
+        self.bytes = bytes
+        self.units = units
+
+
+class Metrics(object):
+    """
+    Call counts, latency histograms, bytes, quota units, errors and retries
+    for each stage of an export, and busy against available time for each
+    pool of workers. Stages nest, eg. 'clean soup' includes 'image check'.
+
+    One instance, gmail_export.metrics.metrics, is shared by the api, the
+    quota limiter, the pipeline and the messages. ExportCLI resets it and,
+    with report=True, writes it to export_metrics.json and export_metrics.prom.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __repr__(self):
+        return f"Metrics(stages={len(self.stages)}, pools={len(self.pools)})"
+
+    def reset(self, profile_id=None):
+        with self._lock:
+            self.started = time.perf_counter()
+            self.stages = {}
+            self.pools = {}
+            # profile_id: a message id whose fetch, render and write run under cProfile
+            self.profile_id = profile_id
+            self._profile = None
+
+    def stage(self, name):
+        # caller holds the lock
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage()
+        return stage
+
+    def observe(self, name, seconds, bytes=0, units=0, error=False):
+        with self._lock:
+            stage = self.stage(name)
+            stage.histogram.observe(seconds)
+            stage.bytes += bytes
+            stage.units += units
+            if error:
+                stage.errors += 1
+
+    def add(self, name, bytes=0, units=0, retries=0):
+        # counted against a stage without another call
+        with self._lock:
+            stage = self.stage(name)
+            stage.bytes += bytes
+            stage.units += units
+            stage.retries += retries
+
+    @contextlib.contextmanager
+    def timer(self, name, bytes=0, units=0):
+        timing = Timing(bytes, units)
+        started = time.perf_counter()
+        try:
+            yield timing
+        except BaseException:
+            self.observe(name, time.perf_counter() - started, timing.bytes, timing.units, error=True)
+            raise
+        self.observe(name, time.perf_counter() - started, timing.bytes, timing.units)
+
+    def busy(self, pool, seconds):
+        with self._lock:
+            self.pools.setdefault(pool, [0.0, 0.0])[0] += seconds
+
+    def available(self, pool, seconds):
+        # worker seconds the pool could have spent busy
+        with self._lock:
+            self.pools.setdefault(pool, [0.0, 0.0])[1] += seconds
+
+    @contextlib.contextmanager
+    def profile(self, message_id):
+        if message_id is None or message_id != self.profile_id:
+            yield
+            return
+        with self._lock:
+            if self._profile is None:
+                self._profile = cProfile.Profile()
+            profile = self._profile
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def report(self):
+        with self._lock:
+            seconds = time.perf_counter() - self.started
+            return {
+                'seconds': round(seconds, 3),
+                'stages': {name: stage.report() for name, stage in sorted(self.stages.items())},
+                'workers': {pool: {
+                    'busy_seconds': round(busy, 3),
+                    'worker_seconds': round(available, 3),
+                    'utilization': round(busy / available, 3) if available else None
+                } for pool, (busy, available) in sorted(self.pools.items())}
+            }
+
+    def prometheus(self, report=None):
+        report = report or self.report()
+        lines = ['# HELP gmail_export_run_seconds Seconds since the export started.',
+                 '# TYPE gmail_export_run_seconds gauge',
+                 f"gmail_export_run_seconds {report['seconds']}",
+                 '# HELP gmail_export_stage_seconds Time spent in each export stage.',
+                 '# TYPE gmail_export_stage_seconds histogram']
+        for name, stage in report['stages'].items():
+            for bound, total in stage['buckets'].items():
+                lines.append(f'gmail_export_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {total}')
+            lines.append(f'gmail_export_stage_seconds_sum{{stage="{name}"}} {stage["seconds"]}')
+            lines.append(f'gmail_export_stage_seconds_count{{stage="{name}"}} {stage["calls"]}')
+        for key, metric, help in [('errors', 'gmail_export_stage_errors_total', 'Calls that raised.'),
+                                  ('retries', 'gmail_export_stage_retries_total', 'Calls retried after a rate limit.'),
+                                  ('bytes', 'gmail_export_stage_bytes_total', 'Bytes fetched or written.'),
+                                  ('quota_units', 'gmail_export_stage_quota_units_total', 'Gmail quota units spent.')]:
+            lines.append(f'# HELP {metric} {help}')
+            lines.append(f'# TYPE {metric} counter')
+            for name, stage in report['stages'].items():
+                lines.append(f'{metric}{{stage="{name}"}} {stage[key]}')
+        for key, metric, type, help in [('busy_seconds', 'gmail_export_worker_busy_seconds_total', 'counter', 'Seconds workers spent working.'),
+                                        ('worker_seconds', 'gmail_export_worker_seconds_total', 'counter', 'Seconds workers were available.'),
+                                        ('utilization', 'gmail_export_worker_utilization', 'gauge', 'Busy over available seconds.')]:
+            lines.append(f'# HELP {metric} {help}')
+            lines.append(f'# TYPE {metric} {type}')
+            for pool, workers in report['workers'].items():
+                if workers[key] is not None:
+                    lines.append(f'{metric}{{pool="{pool}"}} {workers[key]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, export_path, name=METRICS_FILENAME):
+        """
+        Write the report as json and prometheus text, and the profile when a
+        message was profiled. Returns the json report.
+        """
+        report = self.report()
+        base_path = os.path.join(export_path, name)
+        if self._profile is not None:
+            profile_path = f'{base_path}-{self.profile_id}.prof'
+            self._profile.dump_stats(profile_path)
+            stream = io.StringIO()
+            pstats.Stats(self._profile, stream=stream).sort_stats('cumulative').print_stats(PROFILE_LINES)
+            with open(f'{base_path}-{self.profile_id}.txt', 'w') as outfile:
+                outfile.write(stream.getvalue())
+            report['profile'] = profile_path
+        with open(f'{base_path}.json', 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+        with open(f'{base_path}.prom', 'w') as outfile:
+            outfile.write(self.prometheus(report))
+        print(f"  > Metrics: {base_path}.json")
+        return report
+
+
+metrics = Metrics()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import click
+import pendulum
+
+from gmail_export import CFG_PATH, settings
+from gmail_export.query import QUERY_FILTERS
+
+
+ACCOUNT_OPTIONS = ['pipeline', 'pdf_workers', 'offline', 'stream_attachments', 'dedupe', 'archive', 'search', 'report', 'profile_message']
+ANSWER_KEYS = ['export_path', 'timezone', 'labels', 'formats', 'overwrite', 'incremental', 'query'] + QUERY_FILTERS
+
+
+def get_gmail_api(account):
+    # no browser in a worker process, an account without a usable token fails straight away
+    from gmail_export.api import GmailAPI
+    from gmail_export.quota import QuotaLimiter
+    return GmailAPI(token_path=account['token_path'],
+                    credentials_path=account['credentials_path'],
+                    limiter=QuotaLimiter(ceiling=account['quota']),
+                    interactive=False)
+
+
+def export_account(account, api_factory=get_gmail_api):
+    """
+    Export one account, runs in its own worker process with its own token,
+    image cache, raw message cache when it sets "cache": true, and quota
+    budget. Returns the account's summary.
+    """
+    from gmail_export.cache import RawMessageCache
+    from gmail_export.cli import ExportCLI
+
+    started = time.time()
+    summary = {'account': account['name'], 'export_path': account['export_path']}
+    try:
+        gmail_api = api_factory(account)
+        options = {key: account[key] for key in ACCOUNT_OPTIONS if key in account}
+        answers = {key: account[key] for key in ANSWER_KEYS if key in account}
+        cache = RawMessageCache(os.path.join(account['cfg_path'], 'raw_cache.sqlite')) if account.get('cache') else False
+        exporter = ExportCLI(answers=answers, gmail_api=gmail_api, cache=cache,
+                             image_cache=os.path.join(account['cfg_path'], 'image_cache.json'),
+                             **options)
+        summary['labels'] = exporter.export_selected_labels()
+        failed = sum(label['errors'] for label in summary['labels'].values())
+        summary['status'] = 'ok' if not failed else 'errors'
+    except Exception as e:
+        summary['status'] = 'failed'
+        summary['error'] = f'{e.__class__.__name__}: {e}'
+        summary['traceback'] = traceback.format_exc()
+    summary['seconds'] = round(time.time() - started, 1)
+    return summary
+
+
+class ExportOrchestrator(object):
+    """
+    Headless export of many accounts from a json config file, each account
+    in its own process so the total time is about that of the largest mailbox.
+
+    {
+        "export_path": "/backups/mail",
+        "processes": 8,
+        "defaults": {"formats": ["eml", "pdf"], "incremental": true},
+        "accounts": [
+            {"name": "me@example.com", "labels": ["Receipts", "INBOX"]},
+            {"name": "work", "token_path": "...", "credentials_path": "...", "quota": 200, "cache": true}
+        ]
+    }
+
+    Tokens default to ~/.gmail_export/<name>/token.json and each account
+    exports to <export_path>/<name> unless it sets its own export_path. A
+    token has to be authorized interactively once, an account without a
+    usable one fails. api_factory builds each account's GmailAPI in its
+    worker process and has to be picklable.
+    """
+    def __init__(self, config_path, api_factory=get_gmail_api):
+        self.config_path = config_path
+        self.api_factory = api_factory
+        with open(config_path, 'r') as jsonfile:
+            self.config = json.load(jsonfile)
+        self.export_path = self.config.get('export_path') or settings.export_path
+        self.accounts = [self.get_account(account) for account in self.config['accounts']]
+        self.processes = self.config.get('processes') or len(self.accounts)
+
+    def __repr__(self):
+        return f"ExportOrchestrator(config_path='{self.config_path}', accounts={len(self.accounts)}, processes={self.processes})"
+
+    def get_account(self, account):
+        settings = dict(self.config.get('defaults', {}))
+        settings.update(account)
+        name = settings['name']
+        cfg_path = os.path.join(CFG_PATH, name)
+        settings.setdefault('cfg_path', cfg_path)
+        settings.setdefault('token_path', os.path.join(cfg_path, 'token.json'))
+        settings.setdefault('credentials_path', os.path.join(CFG_PATH, 'credentials.json'))
+        settings.setdefault('export_path', os.path.join(self.export_path, name))
+        settings.setdefault('quota', 250)
+        os.makedirs(settings['cfg_path'], exist_ok=True)
+        return settings
+
+    def run(self):
+        started = time.time()
+        summaries = []
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            futures = [executor.submit(export_account, account, self.api_factory) for account in self.accounts]
+            for future in as_completed(futures):
+                summary = future.result()
+                summaries.append(summary)
+                print(f"> {summary['account']}: {summary['status']} in {summary['seconds']}s")
+        report = {
+            'started': pendulum.from_timestamp(started).to_iso8601_string(),
+            'seconds': round(time.time() - started, 1),
+            'accounts': sorted(summaries, key=lambda summary: summary['account'])
+        }
+        self.write_summary(report)
+        return report
+
+    def write_summary(self, report):
+        os.makedirs(self.export_path, exist_ok=True)
+        summary_path = os.path.join(self.export_path, 'export_summary.json')
+        with open(summary_path, 'w') as jsonfile:
+            json.dump(report, jsonfile, indent=2)
+        print(f"> Summary: {summary_path}")
+        return summary_path
+
+
+@click.command()
+@click.argument('config_path', type=click.Path(exists=True, dir_okay=False))
+def main(config_path):
+    """Export every account listed in CONFIG_PATH."""
+    report = ExportOrchestrator(config_path).run()
+    failed = [summary for summary in report['accounts'] if summary['status'] != 'ok']
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import shutil
+import time
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE
+
+from gmail_export import WKHTMLTOPDF_EXTERNAL_COMMAND, WKHTMLTOPDF_ERRORS_IGNORE, PDF_BOOK_BATCH, FatalException
+from gmail_export.metrics import metrics
+
+
+WKHTMLTOPDF_OPTIONS = ['-q',
+                       '--load-error-handling', 'ignore',
+                       '--load-media-error-handling', 'ignore',
+                       '--encoding', 'utf-8', '-s', 'Letter']
+
+
+def process_errors(ret_code, error):
+    stripped_error = str(error, 'utf-8')
+    # suppress certain errors
+    for error_pattern in WKHTMLTOPDF_ERRORS_IGNORE:
+        (stripped_error, _) = re.subn(error_pattern, '', stripped_error)
+
+    original_error = str(error, 'utf-8').rstrip()
+    stripped_error = stripped_error.rstrip()
+
+    if ret_code > 0 and original_error == '':
+        raise FatalException("wkhtmltopdf failed with exit code " +
+                             str(ret_code) +
+                             ", no error output.")
+    elif ret_code > 0 and stripped_error != '':
+        raise FatalException("wkhtmltopdf failed with exit code " +
+                             str(ret_code) +
+                             ", stripped error: " + stripped_error)
+    elif stripped_error != '':
+        print("wkhtmltopdf exited with rc = 0 but produced \
+                unknown stripped error output " + stripped_error)
+
+
+def wkhtmltopdf(inputs, write_path, html=None, cwd=None):
+    """
+    Run wkhtmltopdf once for one or more html inputs, '-' reads html from stdin.
+    """
+    with metrics.timer('wkhtmltopdf') as timing:
+        wkh2p_process = Popen([WKHTMLTOPDF_EXTERNAL_COMMAND] + WKHTMLTOPDF_OPTIONS + inputs + [write_path],
+                              stdin=PIPE, stdout=PIPE, stderr=PIPE, cwd=cwd)
+        output, error = wkh2p_process.communicate(input=html)
+        ret_code = wkh2p_process.returncode
+        assert output == b''
+        process_errors(ret_code, error)
+        timing.bytes = os.path.getsize(os.path.join(cwd or '', write_path))
+    return write_path
+
+
+class PdfPool(object):
+    """
+    A bounded number of concurrent wkhtmltopdf processes. Submitting blocks
+    once `backlog` conversions are waiting so callers can't run ahead.
+    """
+    def __init__(self, workers=None, backlog=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.backlog = backlog or 2 * self.workers
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='wkhtmltopdf')
+        self._slots = threading.BoundedSemaphore(self.backlog)
+        self._lock = threading.Lock()
+        self._futures = []
+        # worker time is counted from the first submit up to each wait
+        self._since = None
+
+    def __repr__(self):
+        return f"PdfPool(workers={self.workers}, backlog={self.backlog})"
+
+    def submit(self, html, write_path):
+        return self.run(['-'], write_path, html)
+
+    def submit_batch(self, paths, write_path, cwd=None):
+        return self.run(paths, write_path, cwd=cwd)
+
+    def run(self, inputs, write_path, html=None, cwd=None):
+        self._slots.acquire()
+        if self._since is None:
+            self._since = time.perf_counter()
+        future = self._executor.submit(self.convert, inputs, write_path, html, cwd)
+        future.write_path = write_path
+        future.add_done_callback(lambda f: self._slots.release())
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def convert(self, inputs, write_path, html=None, cwd=None):
+        started = time.perf_counter()
+        try:
+            return wkhtmltopdf(inputs, write_path, html, cwd)
+        finally:
+            metrics.busy('pdf', time.perf_counter() - started)
+
+    def wait(self):
+        """
+        Wait for everything submitted so far, returns a list of (write_path, exception).
+        """
+        with self._lock:
+            futures, self._futures = self._futures, []
+        errors = []
+        for future in futures:
+            error = future.exception()
+            if error is not None:
+                print(f"        ! Pdf {os.path.basename(future.write_path)} failed: {error}")
+                errors.append((future.write_path, error))
+        if self._since is not None:
+            now = time.perf_counter()
+            metrics.available('pdf', self.workers * (now - self._since))
+            self._since = now
+        return errors
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class PdfBook(object):
+    """
+    Collects the rendered html of many messages, ordered by date, and turns
+    them into one pdf with a single wkhtmltopdf invocation. Past `batch`
+    messages the command line would get too long, so the book is written as
+    name.pdf, name-2.pdf and so on, `batch` messages each.
+    """
+    def __init__(self, write_path, batch=PDF_BOOK_BATCH):
+        self.write_path = write_path
+        self.batch = batch
+        self._dir = tempfile.mkdtemp(prefix='gmail_export_')
+        self._documents = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"PdfBook(write_path='{self.write_path}', documents={len(self._documents)})"
+
+    def add(self, html, sort_key=0):
+        with self._lock:
+            name = f'{len(self._documents):06}.html'
+            self._documents.append((sort_key, name))
+        with open(os.path.join(self._dir, name), 'wb') as outfile:
+            outfile.write(html)
+
+    def part_path(self, part):
+        if part == 0:
+            return os.path.abspath(self.write_path)
+        base, ext = os.path.splitext(os.path.abspath(self.write_path))
+        return f'{base}-{part + 1}{ext}'
+
+    def close(self, pool, archive=None):
+        """
+        Submit the book to pool, returns the future of each part. With an
+        ArchiveSink each part goes into the archive once it's written.
+        """
+        # short relative names keep the command line small
+        names = [name for _, name in sorted(self._documents)]
+        batches = [names[i:i+self.batch] for i in range(0, len(names), self.batch)]
+        if not batches:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            return []
+        remaining = [len(batches)]
+        lock = threading.Lock()
+        def finished(future):
+            # the html is removed once every part is written
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                shutil.rmtree(self._dir, ignore_errors=True)
+        futures = []
+        for part, batch in enumerate(batches):
+            write_path = self.part_path(part)
+            pdf_path = write_path if archive is None else archive.temp_path(write_path)
+            futures.append(pool.submit_batch(batch, pdf_path, cwd=self._dir))
+            futures[-1].add_done_callback(finished)
+            if archive is not None:
+                archive.add_when_done(futures[-1], archive.arcname(write_path), pdf_path)
+        return futures
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import os
+import queue
+import time
+import threading
+
+from gmail_export import RENDER_FORMATS
+from gmail_export.metrics import metrics
+
+STOP = object()
+
+
+class ExportPipeline(object):
+    """
+    Export a label's messages through list -> fetch -> convert -> write stages,
+    the ids can be a generator that's still listing the label.
+    Each stage has its own pool of worker threads and the stages are joined by
+    bounded queues, so a slow stage blocks the one feeding it and memory stays flat.
+    """
+    def __init__(self, exporter, fetchers=8, converters=None, writers=2, queue_size=None):
+        self.exporter = exporter
+        self.fetchers = fetchers
+        self.converters = converters or os.cpu_count() or 1
+        self.writers = writers
+        self.queue_size = queue_size
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"ExportPipeline(fetchers={self.fetchers}, converters={self.converters}, writers={self.writers})"
+
+    def run(self, label, messageIds=None):
+        self.label = label
+        messageIds = label.messageIds if messageIds is None else messageIds
+        formats = self.exporter.config['formats']
+        stages = [(self.fetch, self.fetchers)]
+        if RENDER_FORMATS.intersection(formats):
+            stages.append((self.convert, self.converters))
+        stages.append((self.write, self.writers))
+
+        queues = [queue.Queue(maxsize=self.queue_size or 2 * count) for _, count in stages]
+        workers = []
+        for idx, (task, count) in enumerate(stages):
+            out_q = queues[idx + 1] if idx + 1 < len(queues) else None
+            workers.append([self.start_worker(task, queues[idx], out_q) for _ in range(count)])
+
+        # list stage, put blocks whenever the fetchers are behind
+        try:
+            for messageId in messageIds:
+                queues[0].put(self.exporter.messages[messageId])
+        finally:
+            # drain the stages in order, also when listing fails part way
+            for idx, stage_workers in enumerate(workers):
+                for _ in stage_workers:
+                    queues[idx].put(STOP)
+                for worker in stage_workers:
+                    worker.join()
+        if self.errors:
+            print(f"  > {len(self.errors)} messages failed to export")
+        return self.errors
+
+    def start_worker(self, task, in_q, out_q):
+        worker = threading.Thread(target=self.work, args=(task, in_q, out_q), daemon=True)
+        worker.start()
+        return worker
+
+    def work(self, task, in_q, out_q):
+        # time waiting on either queue counts against the stage's utilization
+        started = time.perf_counter()
+        while True:
+            item = in_q.get()
+            if item is STOP:
+                break
+            message = item[0] if isinstance(item, tuple) else item
+            busy = time.perf_counter()
+            try:
+                with metrics.timer(f'pipeline {task.__name__}'), metrics.profile(message.id):
+                    result = task(*item) if isinstance(item, tuple) else task(item)
+            except Exception as e:
+                with self._lock:
+                    self.errors.append((message.id, e))
+                print(f"        ! Message {message.id} failed: {e}")
+                # the write stage that would have released it never sees the message
+                message.release()
+                continue
+            finally:
+                metrics.busy(task.__name__, time.perf_counter() - busy)
+            if out_q is not None:
+                out_q.put(result)
+        metrics.available(task.__name__, time.perf_counter() - started)
+
+    def fetch(self, message):
+        path = self.label.thread_path(self.exporter, message.thread)
+        message.populate(self.exporter)
+        return message, path
+
+    def convert(self, message, path):
+        # a message already in the canonical store isn't fetched and is only linked
+        if message.msg is not None:
+            message.render()
+        return message, path
+
+    def write(self, message, path):
+        self.label.write(self.exporter, message, path)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+
+# answers that become gmail search operators, see https://support.google.com/mail/answer/7190
+QUERY_FILTERS = ['after', 'before', 'newer_than', 'older_than', 'from', 'to', 'larger', 'smaller', 'has_attachment']
+
+
+def format_date(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.strftime('%Y/%m/%d')
+    return str(value).replace('-', '/')
+
+
+def quote(value):
+    value = str(value)
+    return f'"{value}"' if ' ' in value else value
+
+
+def build_query(query=None, after=None, before=None, newer_than=None, older_than=None, larger=None, smaller=None, has_attachment=False, **filters):
+    """
+    Gmail search string for messages.list, so filtering happens on the server
+    before any ids, metadata or raw messages are fetched. Returns None when
+    there's nothing to filter on.
+
+    build_query(after='2021-03-01', has_attachment=True, larger='5M', **{'from': 'bank.com'})
+    'after:2021/03/01 larger:5M has:attachment from:bank.com'
+    """
+    terms = []
+    if after:
+        terms.append(f'after:{format_date(after)}')
+    if before:
+        terms.append(f'before:{format_date(before)}')
+    if newer_than:
+        terms.append(f'newer_than:{newer_than}')
+    if older_than:
+        terms.append(f'older_than:{older_than}')
+    if larger:
+        terms.append(f'larger:{larger}')
+    if smaller:
+        terms.append(f'smaller:{smaller}')
+    if has_attachment:
+        terms.append('has:attachment')
+    for operator in ['from', 'to']:
+        values = filters.get(operator) or []
+        values = [values] if isinstance(values, str) else values
+        if len(values) == 1:
+            terms.append(f'{operator}:{quote(values[0])}')
+        elif values:
+            terms.append(f'{operator}:({" OR ".join(quote(value) for value in values)})')
+    if query:
+        terms.append(query.strip())
+    return ' '.join(terms) or None
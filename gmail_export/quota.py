@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import random
+import threading
+import time
+
+from gmail_export.metrics import metrics
+
+
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.labels.list': 1,
+    'gmail.users.labels.get': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.attachments.get': 5,
+    'gmail.users.threads.list': 10,
+    'gmail.users.threads.get': 10,
+}
+DEFAULT_UNITS = 5
+# per user quota units per second
+QUOTA_PER_SECOND = 250
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def get_units(request):
+    return QUOTA_UNITS.get(getattr(request, 'methodId', None), DEFAULT_UNITS)
+
+
+def get_stage(request):
+    # the metrics stage of a request, batches have no methodId
+    method_id = getattr(request, 'methodId', None)
+    return f"api {method_id.replace('gmail.users.', '')}" if method_id else 'api batch'
+
+
+def is_rate_limited(error):
+    # googleapiclient errors carry .resp, requests errors carry .response
+    resp = getattr(error, 'resp', None) or getattr(error, 'response', None)
+    status = getattr(resp, 'status', None) or getattr(resp, 'status_code', None)
+    if status == 429:
+        return True
+    if status == 403:
+        content = getattr(error, 'content', None) or getattr(resp, 'content', None) or b''
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+        return any(reason in content for reason in RATE_LIMIT_REASONS)
+    return False
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(rate={self.rate}, capacity={self.capacity})"
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, units=1):
+        # requests bigger than the bucket are let through once it's full and paid back afterwards
+        needed = min(units, self.capacity)
+        while True:
+            with self._lock:
+                self.refill()
+                if self.tokens >= needed:
+                    self.tokens -= units
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class QuotaLimiter(TokenBucket):
+    """
+    Token bucket counting gmail quota units, shared by every worker thread.
+    The rate is halved when gmail answers with a rate limit error and climbs
+    back toward the per user ceiling with every successful call.
+    """
+    def __init__(self, ceiling=QUOTA_PER_SECOND, floor=10, increase=2, retries=8, max_delay=64):
+        super().__init__(ceiling)
+        self.ceiling = ceiling
+        self.floor = floor
+        self.increase = increase
+        self.retries = retries
+        self.max_delay = max_delay
+
+    def slow_down(self):
+        with self._lock:
+            self.refill()
+            self.rate = max(self.floor, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def speed_up(self):
+        with self._lock:
+            if self.rate < self.ceiling:
+                self.refill()
+                self.rate = min(self.ceiling, self.rate + self.increase)
+
+    def backoff(self, attempt):
+        self.slow_down()
+        # full jitter so the workers don't retry in lockstep
+        time.sleep(random.uniform(0, min(self.max_delay, 2 ** attempt)))
+
+    def call(self, fn, units=DEFAULT_UNITS, stage='api'):
+        attempt = 0
+        while True:
+            with metrics.timer('quota wait'):
+                self.acquire(units)
+            try:
+                # every attempt spends its units, also the rate limited ones
+                with metrics.timer(stage, units=units):
+                    result = fn()
+            except Exception as e:
+                if attempt < self.retries and is_rate_limited(e):
+                    metrics.add(stage, retries=1)
+                    self.backoff(attempt)
+                    attempt += 1
+                    continue
+                raise
+            self.speed_up()
+            return result
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import sqlite3
+import threading
+
+import click
+
+
+SEARCH_FILENAME = '.gmail_export_search.sqlite'
+# messages written per transaction
+SEARCH_BATCH_SIZE = 500
+
+
+class SearchIndex(object):
+    """
+    SQLite FTS5 index of subject, sender, recipients and body text at the
+    export root, keyed by message id so an incremental export updates messages
+    in place. docs maps each message id to the fts rowid and keeps the labels
+    and paths it was exported to; rows are written in batched transactions.
+
+    SearchIndex(export_path).search('sender:bank statement') returns the
+    matching messages, best first.
+    """
+    def __init__(self, export_path, batch_size=SEARCH_BATCH_SIZE):
+        self.path = os.path.join(export_path, SEARCH_FILENAME)
+        os.makedirs(export_path, exist_ok=True)
+        self.batch_size = batch_size
+        self.batch = []
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS docs (docid INTEGER PRIMARY KEY, messageId TEXT NOT NULL UNIQUE, date INTEGER, labels TEXT, paths TEXT)')
+        self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS fts USING fts5(subject, sender, recipients, body, tokenize='porter unicode61')")
+
+    def __repr__(self):
+        return f"SearchIndex(path='{self.path}')"
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+
+    def add(self, message_id, labels, paths, date=None, fields=None):
+        """
+        Queue a message for the next batch. fields is a dict of subject,
+        sender, recipients and body, or None to only add labels and paths to
+        a message that's already indexed. Fields with a body of None only
+        index the headers of a message that isn't indexed yet.
+        """
+        with self._lock:
+            self.batch.append((message_id, labels, paths, date, fields))
+            if len(self.batch) >= self.batch_size:
+                self.write_batch()
+
+    def flush(self):
+        with self._lock:
+            self.write_batch()
+
+    def write_batch(self):
+        # caller holds the lock
+        if not self.batch:
+            return
+        self._conn.execute('BEGIN')
+        for message_id, labels, paths, date, fields in self.batch:
+            row = self._conn.execute('SELECT docid, labels, paths FROM docs WHERE messageId=?', (message_id,)).fetchone()
+            if row is None:
+                docid = self._conn.execute('INSERT INTO docs (messageId, date, labels, paths) VALUES (?, ?, ?, ?)',
+                                           (message_id, date, json.dumps(sorted(set(labels))), json.dumps(sorted(set(paths))))).lastrowid
+            else:
+                docid = row[0]
+                labels = sorted(set(json.loads(row[1])) | set(labels))
+                paths = sorted(set(json.loads(row[2])) | set(paths))
+                self._conn.execute('UPDATE docs SET date=COALESCE(?, date), labels=?, paths=? WHERE docid=?',
+                                   (date, json.dumps(labels), json.dumps(paths), docid))
+            if fields is not None and fields.get('body') is None:
+                # headers only, never in place of a row that has the body
+                if self._conn.execute('SELECT 1 FROM fts WHERE rowid=?', (docid,)).fetchone() is not None:
+                    fields = None
+            if fields is not None:
+                self._conn.execute('DELETE FROM fts WHERE rowid=?', (docid,))
+                self._conn.execute('INSERT INTO fts (rowid, subject, sender, recipients, body) VALUES (?, ?, ?, ?, ?)',
+                                   (docid, fields.get('subject') or '', fields.get('sender') or '', fields.get('recipients') or '', fields.get('body') or ''))
+        self._conn.execute('COMMIT')
+        self.batch = []
+
+    def remove(self, message_ids, label=None, root=None):
+        """
+        Drop messages from the index, or with a label only drop that label
+        and the paths under root, and the message once it has no labels left.
+        """
+        with self._lock:
+            self.write_batch()
+            self._conn.execute('BEGIN')
+            for message_id in message_ids:
+                row = self._conn.execute('SELECT docid, labels, paths FROM docs WHERE messageId=?', (message_id,)).fetchone()
+                if row is None:
+                    continue
+                labels = [] if label is None else [name for name in json.loads(row[1]) if name != label]
+                if labels:
+                    paths = [path for path in json.loads(row[2]) if root is None or not path.startswith(os.path.join(root, ''))]
+                    self._conn.execute('UPDATE docs SET labels=?, paths=? WHERE docid=?', (json.dumps(labels), json.dumps(paths), row[0]))
+                else:
+                    self._conn.execute('DELETE FROM fts WHERE rowid=?', (row[0],))
+                    self._conn.execute('DELETE FROM docs WHERE docid=?', (row[0],))
+            self._conn.execute('COMMIT')
+
+    def search(self, query, limit=50, label=None):
+        """
+        FTS5 query syntax, columns can be named eg. 'sender:bank AND invoice'.
+        Returns a list of dicts of messageId, date, subject, labels, paths and
+        a snippet of the body, best match first.
+        """
+        sql = ("SELECT docs.messageId, docs.date, fts.subject, docs.labels, docs.paths, snippet(fts, 3, '[', ']', '...', 12) "
+               "FROM fts JOIN docs ON docs.docid=fts.rowid WHERE fts MATCH ?")
+        args = [query]
+        if label is not None:
+            sql += " AND EXISTS (SELECT 1 FROM json_each(docs.labels) WHERE json_each.value=?)"
+            args.append(label)
+        sql += " ORDER BY rank LIMIT ?"
+        args.append(limit)
+        with self._lock:
+            self.write_batch()
+            rows = self._conn.execute(sql, args).fetchall()
+        return [{
+            'messageId': message_id,
+            'date': date,
+            'subject': subject,
+            'labels': json.loads(labels),
+            'paths': json.loads(paths),
+            'snippet': snippet
+        } for message_id, date, subject, labels, paths, snippet in rows]
+
+    def close(self):
+        with self._lock:
+            self.write_batch()
+            self._conn.close()
+
+
+@click.command()
+@click.argument('export_path', type=click.Path(exists=True, file_okay=False))
+@click.argument('query')
+@click.option('--limit', default=50, help='Most messages to show.')
+@click.option('--label', default=None, help='Only messages exported under this label.')
+def main(export_path, query, limit, label):
+    """Search the messages exported to EXPORT_PATH."""
+    index = SearchIndex(export_path)
+    for result in index.search(query, limit, label):
+        print(f"{result['messageId']}  {result['subject']}")
+        print(f"    {result['snippet']}")
+        for path in result['paths']:
+            print(f"    {path}")
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
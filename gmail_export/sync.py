@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parseaddr
+
+from gmail_export import settings
+from gmail_export.emails import Email
+from gmail_export.idmap import AirtableIdMap
+from gmail_export.quota import TokenBucket
+
+
+# airtable takes at most 10 records per create/update and 5 requests per second per base
+AIRTABLE_BATCH_SIZE = 10
+AIRTABLE_REQUESTS_PER_SECOND = 5
+# keys looked up per filterByFormula request
+AIRTABLE_LOOKUP_SIZE = 50
+# seconds between full passes that check the local id map against airtable
+RECONCILE_INTERVAL = 7 * 24 * 60 * 60
+
+TABLE_KEYS = {
+    'Labels': 'labelId',
+    'Emails': 'Address',
+    'Threads': 'threadId',
+    'Messages': 'messageId'
+}
+
+
+class AirtableSync(object):
+    """
+    Upserts labels, email addresses, threads and messages into Airtable.
+    Record ids come from a local AirtableIdMap; Airtable is only asked about
+    keys the map doesn't know, and only records whose fields changed since
+    the last sync are written, 10 per request from a few workers paced to
+    Airtable's request limit.
+    """
+    def __init__(self, exporter, workers=4, base_id=None, api_key=None, idmap=None, reconcile=False):
+        self.exporter = exporter
+        self.workers = workers
+        self.base_id = base_id or settings.at_config['base_id']
+        self.api_key = api_key or settings.at_config['api_key']
+        self.limiter = TokenBucket(AIRTABLE_REQUESTS_PER_SECOND, capacity=1)
+        self.idmap = idmap or AirtableIdMap()
+        self.tables = {name: self.get_table_api_pointer(name) for name in TABLE_KEYS}
+        self.emails = {}
+        if reconcile or time.time() - self.idmap.reconciled > RECONCILE_INTERVAL:
+            self.reconcile()
+
+    def __repr__(self):
+        return f"AirtableSync(base_id='{self.base_id}', workers={self.workers})"
+
+    def get_table_api_pointer(self, table_name):
+        import airtable
+        return airtable.Airtable(self.base_id, table_name, self.api_key)
+
+    def run(self, labels=None, threads=None, messages=None):
+        labels = self.exporter.selected_labels if labels is None else labels
+        threads = self.exporter.threads if threads is None else threads
+        messages = self.exporter.messages if messages is None else messages
+        self.sync_labels(labels)
+        self.sync_emails(messages)
+        self.sync_threads(threads)
+        self.sync_messages(messages)
+
+    def reconcile(self):
+        """
+        Rebuild the local id map from a full read of each table, this is
+        the only time whole tables are read.
+        """
+        for name, key_field in TABLE_KEYS.items():
+            records = self.call(self.tables[name].get_all)
+            self.idmap.reconcile(name, {record['fields'][key_field]: (record['id'], record['fields']) for record in records if key_field in record['fields']})
+            print(f"  > Airtable {name.lower()}: {len(records)} reconciled")
+        self.idmap.mark_reconciled()
+
+    def call(self, fn, *args, **kwargs):
+        self.limiter.acquire()
+        return fn(*args, **kwargs)
+
+    def pipelined(self, fn, chunks):
+        # several requests in flight, the limiter keeps them under the rate limit
+        if not chunks:
+            return []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(fn, chunks))
+
+    def lookup(self, name, keys):
+        """
+        Ask airtable for records the id map doesn't know, returns {key: record}.
+        """
+        key_field = TABLE_KEYS[name]
+        chunks = [keys[i:i+AIRTABLE_LOOKUP_SIZE] for i in range(0, len(keys), AIRTABLE_LOOKUP_SIZE)]
+        def find(chunk):
+            values = ",".join("{%s}='%s'" % (key_field, str(key).replace("'", "\\'")) for key in chunk)
+            return self.call(self.tables[name].get_all, formula=f"OR({values})")
+        found = {}
+        for records in self.pipelined(find, chunks):
+            for record in records:
+                if key_field in record['fields']:
+                    found[record['fields'][key_field]] = record
+        return found
+
+    def upsert(self, name, objects, build_fields, merge=None):
+        """
+        objects is a dict of key: object, build_fields returns the airtable
+        fields for an object or None when it isn't ready to sync.
+        """
+        table = self.tables[name]
+        known = self.idmap.get_many(name)
+        found = self.lookup(name, [key for key in objects if not key in known])
+        creates = []
+        updates = []
+        synced = []
+        for key, obj in objects.items():
+            fields = build_fields(obj)
+            if fields is None:
+                continue
+            if key in known:
+                atId, stored = known[key]
+            elif key in found:
+                atId, stored = found[key]['id'], found[key]['fields']
+            else:
+                creates.append((key, obj, fields))
+                continue
+            obj.atId = atId
+            if merge is not None:
+                fields = merge(stored, fields)
+            changed = {field: value for field, value in fields.items() if stored.get(field) != value}
+            if changed:
+                updates.append({'id': atId, 'fields': changed})
+            if changed or not key in known:
+                synced.append((key, atId, dict(stored, **fields)))
+
+        def insert(chunk):
+            created = self.call(table.batch_insert, [fields for _, _, fields in chunk])
+            for (key, obj, fields), record in zip(chunk, created):
+                obj.atId = record['id']
+            return [(key, record['id'], fields) for (key, obj, fields), record in zip(chunk, created)]
+        for rows in self.pipelined(insert, [creates[i:i+AIRTABLE_BATCH_SIZE] for i in range(0, len(creates), AIRTABLE_BATCH_SIZE)]):
+            synced.extend(rows)
+        self.pipelined(lambda chunk: self.call(table.batch_update, chunk),
+                       [updates[i:i+AIRTABLE_BATCH_SIZE] for i in range(0, len(updates), AIRTABLE_BATCH_SIZE)])
+        self.idmap.set_many(name, synced)
+        print(f"  > Airtable {name.lower()}: {len(creates)} created, {len(updates)} updated")
+
+    def sync_labels(self, labels):
+        self.upsert('Labels', {label.id: label for label in labels},
+                    lambda label: {'labelId': label.id, 'Name': label.name})
+
+    def sync_emails(self, messages):
+        for message in messages.values():
+            for email_type in ['From', 'To', 'Cc']:
+                for email_str in message.headers[email_type] or []:
+                    name, address = parseaddr(email_str)
+                    if not address in self.emails:
+                        self.emails[address] = Email(email_str)
+                    elif name:
+                        self.emails[address].name = name
+        self.upsert('Emails', self.emails,
+                    lambda email: {'Address': email.address, 'Name': email.name})
+
+    def sync_threads(self, threads):
+        # threads this run didn't name, eg. mailbox only exports or messages the manifest skipped,
+        # get their subject from the first message's metadata or gmail
+        unnamed = [thread for thread in threads.values() if getattr(thread, 'subject', None) is None]
+        self.pipelined(lambda thread: thread.generate_name(self.exporter), unnamed)
+        def build_fields(thread):
+            if getattr(thread, 'subject', None) is None:
+                return None
+            return {
+                'threadId': thread.id,
+                'Name': thread.name,
+                'Subject': thread.subject,
+                'Date': str(thread.dt)
+            }
+        self.upsert('Threads', threads, build_fields)
+
+    def get_email_ids(self, message, email_type):
+        return [self.emails[parseaddr(email_str)[1]].atId for email_str in message.headers[email_type] or []]
+
+    def sync_messages(self, messages):
+        def build_fields(message):
+            if not getattr(message.thread, 'atId', None):
+                return None
+            return {
+                'messageId': message.id,
+                'Subject': message.subject,
+                'Name': message.name,
+                'Thread': [message.thread.atId],
+                'Date': str(message.dt),
+                'From': self.get_email_ids(message, 'From'),
+                'To': self.get_email_ids(message, 'To'),
+                'Cc': self.get_email_ids(message, 'Cc'),
+                'Labels': [label.atId for label in message.labels if getattr(label, 'atId', None)]
+            }
+        def merge(stored, fields):
+            # labels from other runs stay on the record
+            labels = list(stored.get('Labels', []))
+            labels.extend(label for label in fields['Labels'] if not label in labels)
+            return dict(fields, Labels=labels)
+        self.upsert('Messages', messages, build_fields, merge)
@@ -1,14 +1,14 @@
 # -*- coding: utf-8 -*-
 import os
 
-import gmail_export.api as api
 from gmail_export.utils import  clean
 
 
 class GmailThread(object):
-    def __init__(self, id):
-        self.api = api.GmailAPI()
+    def __init__(self, id, api):
+        self.api = api
         self.id = id
+        self.messages = []
     
     def __repr__(self):
         if not getattr(self, '_name', None) is None:
@@ -20,7 +20,9 @@ class GmailThread(object):
             return f"GmailThread(id='{self.id}')"
 
     def populate(self, export):
-        self.generate_name(export)
+        # a thread is named once per run, however many labels it's exported under
+        if getattr(self, '_name', None) is None:
+            self.generate_name(export)
         print(f"    > Thread {self.id}: \"{self.name}\"")
 
     @property
@@ -28,18 +30,26 @@ class GmailThread(object):
         return getattr(self, '_name', self.id)
 
     def generate_name(self, export):
-        response = self.api.get_thread(self.id)
-        if 'messages' in response:
+        # named after the thread's first message, whichever of its messages this run
+        # knows about. its id is the thread id, so its metadata is reused when the
+        # label has it and otherwise gmail is asked for the thread's headers
+        known = [message for message in self.messages if message.meta and message.id == self.id]
+        if known:
+            msg0 = known[0]
+            headers = msg0.meta['headers']
+            internalDate = msg0.internalDate
+        else:
+            response = self.api.get_thread_meta(self.id)
+            if not 'messages' in response:
+                self._name = self.id
+                return
             msg0 = response['messages'][0]
             headers = msg0["payload"]["headers"]
             internalDate = msg0["internalDate"]
-            self.dt = export.get_datetime(internalDate)
-            thread_dt = self.dt.format('YYYY-MM-DD_THHmmss')
-            subject = [header['value'] for header in headers if header["name"]=="Subject"]
-            if subject == []:
-                subject = ["(no subject)"]
-            self.subject = subject[0]
-            thread_name = f'{thread_dt}-{clean(self.subject)}'
-        else:
-            thread_name = thread_id
-        self._name = thread_name
+        self.dt = export.get_datetime(internalDate)
+        thread_dt = self.dt.format('YYYY-MM-DD_THHmmss')
+        subject = [header['value'] for header in headers if header["name"]=="Subject"]
+        if subject == []:
+            subject = ["(no subject)"]
+        self.subject = subject[0]
+        self._name = f'{thread_dt}-{clean(self.subject)}'
@@ -5,7 +5,6 @@ import shutil
 import string
 import pendulum
 from email.header import Header, decode_header, make_header
-from ratelimit import limits, sleep_and_retry
 
 
 from . import TIMEZONE
@@ -120,13 +119,3 @@ def html_escape(text):
     """Produce entities within text."""
     return "".join(html_escape_table.get(c,c) for c in text)
 
-
-# 30 calls per minute
-CALLS = 5
-RATE_LIMIT = 1
-
-@sleep_and_retry
-@limits(calls=CALLS, period=RATE_LIMIT)
-def check_limit():
-     ''' Empty function just to check for calls to API '''
-     return
\ No newline at end of file
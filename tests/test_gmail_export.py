@@ -3,3 +3,1023 @@ from gmail_export import __version__
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def test_quota_limiter_backs_off_on_rate_limit():
+    from gmail_export.quota import QuotaLimiter
+
+    class Resp(object):
+        status = 429
+
+    class RateLimited(Exception):
+        resp = Resp()
+        content = b''
+
+    calls = []
+    def fn():
+        calls.append(1)
+        if len(calls) < 3:
+            raise RateLimited()
+        return 'ok'
+
+    limiter = QuotaLimiter(ceiling=250, max_delay=0.01)
+    assert limiter.call(fn, 5) == 'ok'
+    assert len(calls) == 3
+    assert limiter.floor <= limiter.rate < limiter.ceiling
+
+
+def test_raw_cache_evicts_least_recently_used(tmp_path):
+    import os
+    from gmail_export.cache import RawMessageCache
+
+    cache = RawMessageCache(str(tmp_path / 'raw.sqlite'), max_size=3000)
+    cache.put('a', os.urandom(1000))
+    cache.put('b', os.urandom(1000))
+    assert cache.get('a') is not None
+    cache.put('c', os.urandom(1000))
+    assert 'a' in cache and 'c' in cache
+    assert 'b' not in cache
+    assert cache.get('missing') is None
+
+
+def test_raw_cache_hit_skips_the_download(tmp_path):
+    import zlib
+    from gmail_export.cache import RawMessageCache
+    from gmail_export.fake import SyntheticMailbox
+
+    mailbox = SyntheticMailbox(messages=4, thread_depth=1, labels=['A'])
+    ids = [mailbox.message_id(idx) for idx in range(4)]
+    cache = RawMessageCache(str(tmp_path / 'raw.sqlite'))
+    fake_export(tmp_path / 'one', mailbox, cache=cache)
+    served = mailbox.served
+    assert served and len(cache) == 4
+    fake_export(tmp_path / 'two', mailbox, cache=cache)
+    assert mailbox.served == served
+    # a cache too small for the label keeps the last used messages, the rest are downloaded again
+    size = max(len(zlib.compress(mailbox.raw(message_id))) for message_id in ids)
+    small = RawMessageCache(str(tmp_path / 'small.sqlite'), max_size=int(size * 2.5))
+    fake_export(tmp_path / 'three', mailbox, cache=small)
+    listed = [message_id for message_id, _ in mailbox.ids()]
+    kept = [message_id for message_id in listed if message_id in small]
+    assert 0 < len(kept) < 4 and kept == listed[-len(kept):]
+    served = mailbox.served
+    fake_export(tmp_path / 'four', mailbox, cache=small, query=f'rfc822msgid:{kept[0]}@synthetic')
+    assert mailbox.served == served
+    fake_export(tmp_path / 'five', mailbox, cache=small, query=f'rfc822msgid:{listed[0]}@synthetic')
+    assert mailbox.served - served == len(mailbox.raw(listed[0]))
+
+
+def test_decode_base64url_stream_across_chunks():
+    import base64
+    import io
+    from gmail_export.attachments import decode_base64url_stream
+
+    data = bytes(range(256)) * 40
+    encoded = base64.urlsafe_b64encode(data).rstrip(b'=')
+    response = b'{\n  "size": 10240,\n  "data": "' + encoded + b'"\n}\n'
+    chunks = [response[i:i+7] for i in range(0, len(response), 7)]
+    outfile = io.BytesIO()
+    assert decode_base64url_stream(chunks, outfile) == len(data)
+    assert outfile.getvalue() == data
+
+
+def test_airtable_id_map_round_trip(tmp_path):
+    from gmail_export.idmap import AirtableIdMap
+
+    idmap = AirtableIdMap(str(tmp_path / 'ids.sqlite'))
+    idmap.set_many('Labels', [('Label_1', 'rec1', {'labelId': 'Label_1', 'Name': 'Work'})])
+    assert idmap.get_many('Labels') == {'Label_1': ('rec1', {'labelId': 'Label_1', 'Name': 'Work'})}
+    idmap.reconcile('Labels', {'Label_2': ('rec2', {'labelId': 'Label_2'})})
+    assert list(idmap.get_many('Labels')) == ['Label_2']
+    assert idmap.reconciled == 0.0
+    idmap.mark_reconciled()
+    assert idmap.reconciled > 0
+
+
+def airtable_stub(monkeypatch):
+    # an in memory airtable module, every request is logged with its time
+    import sys
+    import time
+    import types
+
+    module = types.ModuleType('airtable')
+    module.requests = []
+    module.tables = {}
+    class Airtable(object):
+        def __init__(self, base_id, table_name, api_key):
+            self.name = table_name
+            self.records = module.tables.setdefault(table_name, {})
+        def log(self, method, count):
+            module.requests.append((time.monotonic(), self.name, method, count))
+        def get_all(self, formula=None):
+            self.log('get_all', 0)
+            return [dict(record) for record in self.records.values()]
+        def batch_insert(self, records):
+            self.log('batch_insert', len(records))
+            created = []
+            for fields in records:
+                record = {'id': f'rec{self.name}{len(self.records)}', 'fields': dict(fields)}
+                self.records[record['id']] = record
+                created.append(record)
+            return created
+        def batch_update(self, records):
+            self.log('batch_update', len(records))
+            for record in records:
+                self.records[record['id']]['fields'].update(record['fields'])
+    module.Airtable = Airtable
+    monkeypatch.setitem(sys.modules, 'airtable', module)
+    return module
+
+
+def test_airtable_sync_upserts_in_paced_chunks(tmp_path, monkeypatch):
+    from gmail_export.idmap import AirtableIdMap
+    from gmail_export.labels import GmailLabel
+    from gmail_export.sync import AirtableSync
+
+    airtable = airtable_stub(monkeypatch)
+    idmap = AirtableIdMap(str(tmp_path / 'ids.sqlite'))
+    # a fresh map is reconciled against the whole base first, that's skipped here
+    idmap.mark_reconciled()
+    sync = AirtableSync(None, base_id='app', api_key='key', idmap=idmap)
+    labels = {f'Label_{n}': GmailLabel(f'Label_{n}', f'Label {n}', None) for n in range(23)}
+    sync.sync_labels(labels.values())
+    inserts = [count for _, table, method, count in airtable.requests if method == 'batch_insert']
+    assert sorted(inserts) == [3, 10, 10] and len(airtable.tables['Labels']) == 23
+    assert all(getattr(label, 'atId', None) for label in labels.values())
+    # at most 5 requests a second
+    times = sorted(at for at, _, _, _ in airtable.requests)
+    assert all(later - earlier >= 0.19 for earlier, later in zip(times, times[1:]))
+    # nothing changed, nothing is sent; a renamed label is one update of its changed field
+    del airtable.requests[:]
+    sync.sync_labels(labels.values())
+    assert airtable.requests == []
+    labels['Label_4'].name = 'Renamed'
+    sync.sync_labels(labels.values())
+    assert [(method, count) for _, _, method, count in airtable.requests] == [('batch_update', 1)]
+    assert airtable.tables['Labels'][labels['Label_4'].atId]['fields']['Name'] == 'Renamed'
+
+
+def test_airtable_sync_names_threads_the_export_did_not(tmp_path, monkeypatch):
+    import pytest
+    pytest.importorskip('googleapiclient')
+    from gmail_export.cli import ExportCLI
+    from gmail_export.fake import FakeGmailAPI, SyntheticMailbox
+    from gmail_export.idmap import AirtableIdMap
+    from gmail_export.sync import AirtableSync
+
+    airtable = airtable_stub(monkeypatch)
+    mailbox = SyntheticMailbox(messages=6, thread_depth=3, labels=['A'])
+    exporter = ExportCLI(answers={'export_path': str(tmp_path), 'labels': ['A']}, gmail_api=FakeGmailAPI(mailbox), offline=True, image_cache=None)
+    # listed but never exported, so no thread was named
+    exporter.populate_selected_labels()
+    AirtableSync(exporter, base_id='app', api_key='key', idmap=AirtableIdMap(str(tmp_path / 'ids.sqlite'))).run()
+    assert sorted(record['fields']['Subject'] for record in airtable.tables['Threads'].values()) == ['Synthetic thread 0', 'Synthetic thread 3']
+    assert len(airtable.tables['Messages']) == 6
+
+
+def test_settings_resolve_lazily(tmp_path):
+    import json
+    from gmail_export import Settings
+
+    settings = Settings(cfg_path=str(tmp_path))
+    assert settings.at_config == {}
+    with open(tmp_path / 'dropbox.json', 'w') as jsonfile:
+        json.dump({'token': 'abc'}, jsonfile)
+    assert settings.db_config == {'token': 'abc'}
+    settings.export_path = str(tmp_path / 'export')
+    assert settings.export_path == str(tmp_path / 'export')
+    assert not (tmp_path / 'export').exists()
+
+
+def test_manifest_skips_recorded_messages(tmp_path):
+    from gmail_export.manifest import ExportManifest
+
+    manifest = ExportManifest(str(tmp_path))
+    eml = tmp_path / 'a.eml'
+    eml.write_bytes(b'Subject: a\r\n\r\nbody')
+    manifest.record('INBOX', 'a', [('eml', str(eml)), ('attachments', None)])
+    manifest.record('INBOX', 'b', None)
+    assert manifest.done_ids('INBOX', ['eml', 'attachments', 'label pdf']) == {'a'}
+    assert manifest.done_ids('INBOX', ['eml', 'pdf']) == set()
+    assert manifest.done_ids('SENT', ['eml']) == set()
+    assert manifest.files('a')[0][3] == len(b'Subject: a\r\n\r\nbody')
+    eml.unlink()
+    assert manifest.done_ids('INBOX', ['eml']) == set()
+
+
+def test_build_query():
+    import datetime
+    from gmail_export.query import build_query
+
+    assert build_query() is None
+    assert build_query(after='2021-03-01', has_attachment=True, larger='5M', **{'from': 'bank.com'}) == 'after:2021/03/01 larger:5M has:attachment from:bank.com'
+    assert build_query('is:unread', before=datetime.date(2021, 4, 1), to=['me@example.com', 'Jane Doe']) == 'before:2021/04/01 to:(me@example.com OR "Jane Doe") is:unread'
+
+
+def test_canonical_store_writes_once_and_links(tmp_path):
+    import os
+    from gmail_export.dedupe import CanonicalStore
+
+    class Message(object):
+        id = 'abc'
+        pending = []
+        checksums = {}
+        written = 0
+        def export(self, exporter, path):
+            self.written += 1
+            write_path = os.path.join(path, 'a.eml')
+            with open(write_path, 'w') as outfile:
+                outfile.write('Subject: a\n\nbody')
+            return [('eml', write_path), ('attachments', None)]
+
+    class Label(object):
+        def __init__(self, name):
+            self.export_path = str(tmp_path / name)
+            os.makedirs(os.path.join(self.export_path, 'thread'))
+
+    store = CanonicalStore(str(tmp_path), 'hardlink')
+    message = Message()
+    for name in ['INBOX', 'Receipts']:
+        label = Label(name)
+        outputs, pending = store.export(None, label, message, os.path.join(label.export_path, 'thread'))
+        assert outputs[0] == ('eml', os.path.join(label.export_path, 'thread', 'a.eml'))
+        assert os.stat(outputs[0][1]).st_ino == os.stat(store.message_path('abc') + '/a.eml').st_ino
+    assert message.written == 1
+    assert 'abc' in store
+
+
+def test_mbox_writer_index_round_trip(tmp_path):
+    import os
+    from gmail_export.mailboxes import MboxWriter, MaildirWriter, read_mbox_message
+
+    raw = b'Subject: a\r\n\r\nFrom here\r\n>From there\r\n'
+    path = str(tmp_path / 'INBOX.mbox')
+    mbox = MboxWriter(path)
+    mbox.add('a', raw, 1617235200000)
+    mbox.add('b', b'Subject: b\n\nbody\n', 1617235300000)
+    mbox.add('a', raw, 1617235200000)
+    mbox.close()
+    assert read_mbox_message(path, 'a') == raw.replace(b'\r\n', b'\n')
+    assert read_mbox_message(path, 'b') == b'Subject: b\n\nbody\n'
+    assert len(MboxWriter(path).index) == 2
+    assert open(path, 'rb').read().count(b'\nFrom MAILER-DAEMON') == 1
+
+    # a run killed part way through a message, its index line already written
+    size = os.path.getsize(path)
+    with open(path, 'ab') as outfile:
+        outfile.write(b'From MAILER-DAEMON Thu Apr  1 00:00:00 2021\nSubject: c\n')
+    with open(path + '.index', 'a') as index_file:
+        index_file.write(f'c\t{size}\t500\n')
+    mbox = MboxWriter(path)
+    assert sorted(mbox.index) == ['a', 'b'] and mbox.offset == size
+    mbox.add('c', b'Subject: c\n\nbody\n', 1617235400000)
+    mbox.close()
+    assert read_mbox_message(path, 'c') == b'Subject: c\n\nbody\n'
+    assert read_mbox_message(path, 'b') == b'Subject: b\n\nbody\n'
+
+    maildir = MaildirWriter(str(tmp_path / 'Maildir'))
+    write_path = maildir.add('a', raw, 1617235200000)
+    assert open(write_path, 'rb').read() == raw
+    assert os.listdir(str(tmp_path / 'Maildir' / 'tmp')) == []
+
+
+def test_archive_sink_streams_files_into_zip(tmp_path):
+    import os
+    import zipfile
+    from concurrent.futures import Future
+    from gmail_export.archive import ArchiveSink
+
+    root = str(tmp_path / 'INBOX')
+    archive = ArchiveSink(str(tmp_path / 'INBOX'), root, 'zip')
+    with archive.open_output(os.path.join(root, 'thread', 'a.eml'), 'w') as outfile:
+        outfile.write('Subject: a\n\nbody')
+    with archive.open_output(os.path.join(root, 'thread', 'a.html')) as outfile:
+        outfile.write(b'<p>body</p>')
+    pdf_path = archive.temp_path('a.pdf')
+    future = Future()
+    archive.add_when_done(future, 'thread/a.pdf', pdf_path)
+    with open(pdf_path, 'wb') as outfile:
+        outfile.write(b'%PDF')
+    future.set_result(pdf_path)
+    assert archive.close() == []
+    assert not os.path.exists(root) and not os.path.exists(pdf_path)
+    with zipfile.ZipFile(archive.path) as zf:
+        assert sorted(zf.namelist()) == ['thread/a.eml', 'thread/a.html', 'thread/a.pdf']
+        assert zf.read('thread/a.eml') == b'Subject: a\n\nbody'
+
+
+def test_archive_entries_spill_to_disk_and_stream_into_members(tmp_path, monkeypatch):
+    import os
+    import tarfile
+    import zipfile
+    import pytest
+    import gmail_export.archive as archive_module
+
+    monkeypatch.setattr(archive_module, 'ARCHIVE_SPOOL_SIZE', 1024)
+    root = str(tmp_path / 'INBOX')
+    data = os.urandom(10000)
+    for format in ['zip', 'tar.zst']:
+        if format == 'tar.zst':
+            zstandard = pytest.importorskip('zstandard')
+        archive = archive_module.ArchiveSink(str(tmp_path / 'INBOX'), root, format)
+        with archive.open_output(os.path.join(root, 'a.bin')) as outfile:
+            for i in range(0, len(data), 1000):
+                outfile.write(data[i:i+1000])
+            # past the spool size the entry is on disk, not in memory
+            assert outfile.spool._rolled
+        assert archive.close() == []
+        if format == 'zip':
+            with zipfile.ZipFile(archive.path) as zf:
+                assert zf.read('a.bin') == data
+        else:
+            with open(archive.path, 'rb') as infile, zstandard.ZstdDecompressor().stream_reader(infile) as reader:
+                with tarfile.open(fileobj=reader, mode='r|') as tf:
+                    member = tf.next()
+                    assert member.name == 'a.bin' and tf.extractfile(member).read() == data
+
+
+def test_search_index_upserts_by_message_id(tmp_path):
+    import pytest
+    pytest.importorskip('click')
+    from gmail_export.search import SearchIndex
+
+    index = SearchIndex(str(tmp_path), batch_size=2)
+    fields = {'subject': 'Your statement', 'sender': 'Bank <alerts@bank.com>', 'recipients': 'me@example.com', 'body': 'The March statement is ready'}
+    index.add('a', ['INBOX'], ['/x/INBOX/a.eml'], 1617235200000, fields)
+    index.add('b', ['INBOX'], ['/x/INBOX/b.eml'], 1617235300000, dict(fields, subject='Lunch', body='tacos'))
+    index.add('a', ['Receipts'], ['/x/Receipts/a.eml'])
+    results = index.search('sender:bank AND statement')
+    assert [result['messageId'] for result in results] == ['a']
+    assert results[0]['labels'] == ['INBOX', 'Receipts']
+    assert results[0]['paths'] == ['/x/INBOX/a.eml', '/x/Receipts/a.eml']
+    index.add('b', ['INBOX'], [], None, dict(fields, subject='Dinner', body='ramen'))
+    assert index.search('tacos') == []
+    assert [result['messageId'] for result in index.search('ramen', label='INBOX')] == ['b']
+    assert len(index) == 2
+    index.close()
+
+
+def test_image_checker_caches_checks_and_dead_hosts(tmp_path, monkeypatch):
+    import os
+    from urllib.error import HTTPError, URLError
+    import gmail_export.images as images
+
+    requested = []
+    class Response(object):
+        status = 200
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            pass
+
+    def urlopen(request, timeout=None):
+        requested.append((request.get_method(), request.full_url))
+        if 'dead' in request.full_url:
+            raise URLError('timed out')
+        if 'nohead' in request.full_url and request.get_method() == 'HEAD':
+            raise HTTPError(request.full_url, 405, 'Method Not Allowed', {}, None)
+        if 'missing' in request.full_url:
+            raise HTTPError(request.full_url, 404, 'Not Found', {}, None)
+        return Response()
+
+    monkeypatch.setattr(images, 'urlopen', urlopen)
+    path = str(tmp_path / 'images.json')
+    checker = images.ImageChecker(path, workers=1)
+    urls = [f'http://dead.example/{i}.png' for i in range(3)] + ['http://live.example/nohead.png', 'http://live.example/missing.png']
+    assert checker.check(urls + urls[:1]) == {url: 'nohead' in url for url in urls}
+    # one timeout marks the host dead, HEAD refused falls back to a ranged GET
+    assert len([url for _, url in requested if 'dead' in url]) == 1
+    assert ('GET', 'http://live.example/nohead.png') in requested
+    checker.close()
+    checker.save()
+
+    # within the ttl everything comes from the saved cache, an unchanged cache isn't saved again
+    requested[:] = []
+    mtime = os.path.getmtime(path)
+    cached = images.ImageChecker(path)
+    assert cached.check(urls + ['http://dead.example/new.png']) == dict({url: 'nohead' in url for url in urls}, **{'http://dead.example/new.png': False})
+    assert requested == []
+    cached.save()
+    assert os.path.getmtime(path) == mtime
+    # past the ttl the urls are checked again
+    assert images.ImageChecker(path, ttl=0).check(['http://live.example/nohead.png']) == {'http://live.example/nohead.png': True}
+    assert len(requested) == 2
+
+    # offline nothing is requested or saved and unknown urls keep their src
+    requested[:] = []
+    offline = images.ImageChecker(str(tmp_path / 'offline.json'), offline=True)
+    assert offline.check(['http://new.example/b.png']) == {'http://new.example/b.png': True}
+    offline.save()
+    assert requested == [] and not os.path.exists(str(tmp_path / 'offline.json'))
+
+
+def test_image_checkers_sharing_a_cache_keep_each_others_urls(tmp_path):
+    import os
+    from gmail_export.images import ImageChecker
+
+    class Checker(ImageChecker):
+        def request(self, url, method, headers=None):
+            return True
+
+    path = str(tmp_path / 'images.json')
+    first, second = Checker(path), Checker(path)
+    first.check(['http://a.example/1.png'])
+    second.check(['http://b.example/2.png'])
+    first.save()
+    second.save()
+    assert sorted(ImageChecker(path).urls) == ['http://a.example/1.png', 'http://b.example/2.png']
+    assert os.listdir(str(tmp_path)) == ['images.json']
+    first.close()
+    second.close()
+
+
+def test_pdf_book_splits_long_books(tmp_path):
+    import os
+    from concurrent.futures import Future
+    from gmail_export.pdf import PdfBook
+
+    submitted = []
+    class Pool(object):
+        def submit_batch(self, paths, write_path, cwd=None):
+            submitted.append((paths, write_path))
+            future = Future()
+            future.set_result(write_path)
+            return future
+
+    book = PdfBook(str(tmp_path / 'label.pdf'), batch=2)
+    for i in range(5):
+        book.add(b'<p>message</p>', sort_key=5 - i)
+    futures = book.close(Pool())
+    assert len(futures) == 3
+    assert [os.path.basename(path) for _, path in submitted] == ['label.pdf', 'label-2.pdf', 'label-3.pdf']
+    assert [len(paths) for paths, _ in submitted] == [2, 2, 1]
+    assert submitted[0][0][0] == '000004.html'
+    assert not os.path.exists(book._dir)
+
+
+def test_metadata_batches_retry_and_skip_deleted_messages(tmp_path):
+    import pytest
+    httplib2 = pytest.importorskip('httplib2')
+    pytest.importorskip('googleapiclient')
+    from googleapiclient.errors import HttpError
+    from gmail_export.fake import FakeGmailAPI, SyntheticMailbox
+
+    mailbox = SyntheticMailbox(messages=150, thread_depth=1, labels=['A'])
+    ids = [mailbox.message_id(idx) for idx in range(150)]
+    gone, flaky = ids[3], ids[120]
+    failures = {flaky: 1}
+    meta = mailbox.meta
+    def failing_meta(message_id, headers=None):
+        if message_id == gone:
+            raise HttpError(httplib2.Response({'status': 404}), b'Not Found')
+        if failures.get(message_id):
+            failures[message_id] -= 1
+            raise HttpError(httplib2.Response({'status': 500}), b'Backend Error')
+        return meta(message_id, headers)
+    mailbox.meta = failing_meta
+
+    gmail_api = FakeGmailAPI(mailbox)
+    batches = []
+    new_batch = gmail_api.service.new_batch_http_request
+    gmail_api.service.new_batch_http_request = lambda callback=None: batches.append(callback) or new_batch(callback)
+    metas = gmail_api.get_messages_meta(ids)
+    # 100 sub-requests per batch, the failed one is retried alone and the deleted one dropped
+    assert len(batches) == 2
+    assert sorted(metas) == sorted(set(ids) - {gone})
+    assert metas[flaky]['id'] == flaky
+    failures[flaky] = 1
+    assert fake_export(tmp_path, mailbox) == {'A': {'messages': 149, 'errors': 0}}
+
+
+def fake_export(export_path, mailbox, formats=('eml',), **options):
+    # one offline export of the synthetic mailbox's labels, returns the summary
+    import os
+    import pytest
+    pytest.importorskip('googleapiclient')
+    pytest.importorskip('pendulum')
+    from gmail_export.cli import ExportCLI
+    from gmail_export.fake import FakeGmailAPI
+
+    answers = {'export_path': str(export_path), 'labels': [label['name'] for label in mailbox.labels], 'formats': list(formats)}
+    answers.update({key: options.pop(key) for key in ['incremental', 'overwrite', 'query'] if key in options})
+    exporter = ExportCLI(answers=answers, gmail_api=FakeGmailAPI(mailbox), offline=True,
+                         image_cache=os.path.join(str(export_path), '.image_cache.json'), **options)
+    return exporter.export_selected_labels()
+
+
+def exported_files(export_path):
+    import os
+    return sorted(os.path.relpath(os.path.join(root, name), str(export_path))
+                  for root, dirs, files in os.walk(str(export_path)) for name in files if not name.startswith('.'))
+
+
+def test_fake_gmail_api_exports_synthetic_mailbox(tmp_path):
+    import os
+    import pytest
+    pytest.importorskip('googleapiclient')
+    pytest.importorskip('pendulum')
+    from gmail_export.cli import ExportCLI
+    from gmail_export.fake import FakeGmailAPI, SyntheticMailbox
+
+    mailbox = SyntheticMailbox(messages=7, thread_depth=3, labels=['Bench'])
+    gmail_api = FakeGmailAPI(mailbox)
+    pages = list(gmail_api.iter_id_pages_for_label(gmail_api.get_labels()[0]))
+    assert [len(page) for page in pages] == [7]
+    answers = {'export_path': str(tmp_path), 'labels': ['Bench'], 'formats': ['eml']}
+    exporter = ExportCLI(answers=answers, gmail_api=gmail_api, cache=False, offline=True, image_cache=None)
+    assert exporter.export_selected_labels() == {'Bench': {'messages': 7, 'errors': 0}}
+    emls = [name for root, dirs, files in os.walk(str(tmp_path)) for name in files if name.endswith('.eml')]
+    assert len(emls) == 7
+    assert mailbox.served > 0
+
+
+def test_metrics_report_and_profile(tmp_path):
+    import json
+    import pytest
+    from gmail_export.metrics import Metrics
+
+    metrics = Metrics()
+    metrics.reset(profile_id='m1')
+    with metrics.timer('write eml', bytes=10):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.timer('write eml') as timing:
+            timing.bytes = 5
+            raise ValueError()
+    metrics.observe('api messages.get', 0.2, units=5)
+    metrics.add('api messages.get', retries=1, bytes=100)
+    metrics.busy('fetch', 3.0)
+    metrics.available('fetch', 4.0)
+    with metrics.profile('m1'):
+        sum(range(10))
+    with metrics.profile('m2'):
+        pass
+    report = metrics.write(str(tmp_path))
+    assert report['stages']['write eml']['calls'] == 2
+    assert report['stages']['write eml']['errors'] == 1
+    assert report['stages']['write eml']['bytes'] == 15
+    api = report['stages']['api messages.get']
+    assert (api['calls'], api['retries'], api['bytes'], api['quota_units'], api['p95']) == (1, 1, 100, 5, 0.25)
+    assert api['buckets']['0.1'] == 0 and api['buckets']['0.25'] == 1 and api['buckets']['+Inf'] == 1
+    assert report['workers']['fetch']['utilization'] == 0.75
+    assert json.loads((tmp_path / 'export_metrics.json').read_text())['stages'].keys() == report['stages'].keys()
+    prom = (tmp_path / 'export_metrics.prom').read_text()
+    assert 'gmail_export_stage_seconds_bucket{stage="api messages.get",le="0.25"} 1' in prom
+    assert 'gmail_export_worker_utilization{pool="fetch"} 0.75' in prom
+    assert (tmp_path / 'export_metrics-m1.prof').exists()
+
+
+def test_incremental_archive_keeps_earlier_entries(tmp_path):
+    import os
+    import zipfile
+    import pytest
+    pytest.importorskip('googleapiclient')
+    from gmail_export.fake import SyntheticMailbox
+
+    mailbox = SyntheticMailbox(messages=6, labels=['A'])
+    assert fake_export(tmp_path, mailbox, archive='zip') == {'A': {'messages': 6, 'errors': 0}}
+    assert not os.path.exists(str(tmp_path / 'A'))
+    with zipfile.ZipFile(str(tmp_path / 'A.zip')) as zf:
+        names = sorted(zf.namelist())
+    assert len(names) == 6
+    fake_export(tmp_path, mailbox, archive='zip', incremental=True)
+    with zipfile.ZipFile(str(tmp_path / 'A.zip')) as zf:
+        assert sorted(zf.namelist()) == names
+    # a message exported again isn't added a second time
+    os.remove(str(tmp_path / '.gmail_export_history.json'))
+    fake_export(tmp_path, mailbox, archive='zip', incremental=True)
+    with zipfile.ZipFile(str(tmp_path / 'A.zip')) as zf:
+        assert sorted(zf.namelist()) == names
+
+    # thread and label pdfs go into the archive too
+    from concurrent.futures import Future
+    from gmail_export.archive import ArchiveSink
+    from gmail_export.pdf import PdfBook
+
+    class Pool(object):
+        def submit_batch(self, paths, write_path, cwd=None):
+            with open(write_path, 'wb') as outfile:
+                outfile.write(b'%PDF')
+            future = Future()
+            future.set_result(write_path)
+            return future
+
+    root = str(tmp_path / 'B')
+    archive = ArchiveSink(root, root, 'zip')
+    book = PdfBook(os.path.join(root, 'B.pdf'))
+    book.add(b'<p>message</p>')
+    book.close(Pool(), archive)
+    assert archive.close() == []
+    assert not os.path.exists(root)
+    with zipfile.ZipFile(archive.path) as zf:
+        assert zf.namelist() == ['B.pdf']
+
+
+def test_pipeline_dedupe_links_stored_messages(tmp_path):
+    import pytest
+    pytest.importorskip('googleapiclient')
+    pytest.importorskip('bs4')
+    from gmail_export.fake import SyntheticMailbox
+
+    mailbox = SyntheticMailbox(messages=6, labels=['A', 'B'])
+    summary = fake_export(tmp_path, mailbox, formats=['eml', 'html'], pipeline=True, dedupe='hardlink')
+    assert summary == {'A': {'messages': 6, 'errors': 0}, 'B': {'messages': 6, 'errors': 0}}
+    files = exported_files(tmp_path)
+    assert len([name for name in files if name.startswith('A/')]) == len([name for name in files if name.startswith('B/')]) == 12
+    # in index mode another run doesn't repeat the label's rows
+    fake_export(tmp_path / 'index', mailbox, dedupe='index')
+    rows = (tmp_path / 'index' / 'B' / 'messages.tsv').read_text()
+    fake_export(tmp_path / 'index', mailbox, dedupe='index')
+    assert (tmp_path / 'index' / 'B' / 'messages.tsv').read_text() == rows
+
+
+def test_dedupe_index_leaves_no_empty_directories(tmp_path):
+    import os
+    from gmail_export.fake import SyntheticMailbox
+
+    mailbox = SyntheticMailbox(messages=6, thread_depth=3, labels=['A', 'B'])
+    fake_export(tmp_path, mailbox, formats=['eml', 'html'], dedupe='index')
+    assert sorted(os.listdir(str(tmp_path / 'A'))) == ['messages.tsv']
+    assert [root for root, dirs, files in os.walk(str(tmp_path)) if not dirs and not files] == []
+
+
+def test_thread_names_come_from_the_first_message(tmp_path):
+    import pytest
+    pytest.importorskip('googleapiclient')
+    from gmail_export.cli import ExportCLI
+    from gmail_export.fake import FakeGmailAPI, SyntheticMailbox
+    from gmail_export.threads import GmailThread
+
+    mailbox = SyntheticMailbox(messages=6, thread_depth=3, labels=['A'])
+    fake_export(tmp_path, mailbox)
+    names = sorted(set(name.split('/')[1] for name in exported_files(tmp_path)))
+    assert len(names) == 2
+    gmail_api = FakeGmailAPI(mailbox)
+    exporter = ExportCLI(answers={'export_path': str(tmp_path), 'labels': ['A']}, gmail_api=gmail_api, cache=False, offline=True, image_cache=None)
+
+    class Reply(object):
+        # only a later reply of the thread is in the label
+        id = mailbox.message_id(4)
+        meta = mailbox.meta(id)
+        internalDate = meta['internalDate']
+        meta['headers'] = meta['payload']['headers']
+
+    thread = GmailThread(mailbox.message_id(3), gmail_api)
+    thread.messages.append(Reply())
+    thread.populate(exporter)
+    assert thread.name == names[1]
+
+
+def test_incremental_export_removes_deleted_messages(tmp_path):
+    import os
+    import pytest
+    pytest.importorskip('googleapiclient')
+    from gmail_export.fake import SyntheticMailbox
+    from gmail_export.manifest import ExportManifest
+    from gmail_export.mailboxes import read_mbox_index
+    from gmail_export.search import SearchIndex
+
+    mailbox = SyntheticMailbox(messages=6, thread_depth=1, labels=['A'])
+    fake_export(tmp_path, mailbox, formats=['eml', 'mbox', 'maildir'], search=True)
+    gone = mailbox.message_id(2)
+    emls = [name for name in exported_files(tmp_path) if name.endswith('.eml')]
+    mailbox.delete(gone)
+    assert fake_export(tmp_path, mailbox, formats=['eml', 'mbox', 'maildir'], search=True, incremental=True) == {'A': {'messages': 0, 'errors': 0}}
+    files = exported_files(tmp_path)
+    assert len([name for name in files if name.endswith('.eml')]) == len(emls) - 1
+    assert len(os.listdir(str(tmp_path / 'A'))) == 5 + 3
+    assert not any(gone in name for name in files)
+    assert sorted(read_mbox_index(str(tmp_path / 'A' / 'A.mbox.index'))) == sorted(mailbox.message_id(idx) for idx in [0, 1, 3, 4, 5])
+    assert ExportManifest(str(tmp_path)).files(gone) == []
+    index = SearchIndex(str(tmp_path))
+    assert len(index) == 5
+    index.close()
+
+
+def test_incremental_query_only_looks_up_new_messages(tmp_path):
+    import pytest
+    pytest.importorskip('googleapiclient')
+    from gmail_export.fake import SyntheticMailbox
+
+    mailbox = SyntheticMailbox(messages=4, thread_depth=1, labels=['A'])
+    assert fake_export(tmp_path, mailbox, query='invoice') == {'A': {'messages': 4, 'errors': 0}}
+    mailbox.append(2)
+    del mailbox.queries[:]
+    assert fake_export(tmp_path, mailbox, query='invoice', incremental=True) == {'A': {'messages': 2, 'errors': 0}}
+    # the additions are checked against the query by Message-ID, the label isn't listed again
+    assert mailbox.queries and all('rfc822msgid:' in query for query in mailbox.queries)
+    # another query hasn't been exported yet, so the whole label is listed
+    assert fake_export(tmp_path, mailbox, query='receipt', incremental=True) == {'A': {'messages': 6, 'errors': 0}}
+    assert mailbox.queries[-1] == 'receipt'
+
+
+def test_search_indexes_streamed_messages_by_headers(tmp_path):
+    import pytest
+    pytest.importorskip('googleapiclient')
+    from gmail_export.fake import SyntheticMailbox
+    from gmail_export.search import SearchIndex
+
+    mailbox = SyntheticMailbox(messages=3, thread_depth=1, labels=['A'], attachment_sizes=[100])
+    fake_export(tmp_path, mailbox, formats=['attachments'], search=True, stream_attachments=True)
+    index = SearchIndex(str(tmp_path))
+    assert len(index.search('subject:synthetic')) == 3
+    assert [result['messageId'] for result in index.search('sender:sender1')] == [mailbox.message_id(1)]
+    # a later headers only add leaves a row with the body alone
+    index.add('b', ['A'], [], 1, {'subject': 'lunch', 'sender': 'bob', 'recipients': '', 'body': 'ramen'})
+    index.add('b', ['B'], [], 1, {'subject': 'lunch', 'sender': 'bob', 'recipients': '', 'body': None})
+    assert len(index.search('ramen')) == 1
+    index.close()
+
+
+def test_pipeline_writes_the_same_files_as_the_serial_export(tmp_path):
+    from gmail_export.fake import SyntheticMailbox
+
+    formats = ['eml', 'html', 'mbox', 'maildir', 'attachments', 'inline']
+    mailbox = SyntheticMailbox(messages=9, thread_depth=3, labels=['A'], attachment_sizes=[100], inline_images=1)
+    serial = fake_export(tmp_path / 'serial', mailbox, formats=formats)
+    pipelined = fake_export(tmp_path / 'pipeline', mailbox, formats=formats, pipeline={'fetchers': 3, 'converters': 2})
+    assert serial == pipelined == {'A': {'messages': 9, 'errors': 0}}
+    assert exported_files(tmp_path / 'serial') == exported_files(tmp_path / 'pipeline')
+
+
+def test_streamed_attachments_come_from_the_raw_message_when_it_is_fetched(tmp_path):
+    from gmail_export.fake import SyntheticMailbox
+
+    formats = ['eml', 'attachments']
+    plain = SyntheticMailbox(messages=3, thread_depth=1, labels=['A'], attachment_sizes=[5000])
+    fake_export(tmp_path / 'plain', plain, formats=formats)
+    streamed = SyntheticMailbox(messages=3, thread_depth=1, labels=['A'], attachment_sizes=[5000])
+    fake_export(tmp_path / 'streamed', streamed, formats=formats, stream_attachments=True)
+    # the attachments aren't downloaded a second time through attachments.get
+    assert streamed.served == plain.served
+    assert exported_files(tmp_path / 'plain') == exported_files(tmp_path / 'streamed')
+
+
+def fake_account_api(account):
+    # builds each orchestrated account's api in its worker process
+    from gmail_export.fake import FakeGmailAPI, SyntheticMailbox
+    return FakeGmailAPI(SyntheticMailbox(messages=account['messages'], thread_depth=1, labels=['A']))
+
+
+def test_orchestrator_exports_accounts_in_parallel(tmp_path):
+    import json
+    import pytest
+    pytest.importorskip('googleapiclient')
+    from gmail_export import FatalException
+    from gmail_export.api import GmailAPI
+    from gmail_export.orchestrator import ExportOrchestrator
+
+    config = {
+        'export_path': str(tmp_path / 'export'),
+        'defaults': {'offline': True, 'labels': ['A']},
+        'accounts': [{'name': name, 'messages': messages, 'cfg_path': str(tmp_path / 'cfg' / name)} for name, messages in [('one', 2), ('two', 3)]]
+    }
+    config_path = tmp_path / 'accounts.json'
+    config_path.write_text(json.dumps(config))
+    ExportOrchestrator(str(config_path), api_factory=fake_account_api).run()
+    with open(str(tmp_path / 'export' / 'export_summary.json')) as jsonfile:
+        report = json.load(jsonfile)
+    assert [(account['account'], account['status'], account['labels']) for account in report['accounts']] == [
+        ('one', 'ok', {'A': {'messages': 2, 'errors': 0}}), ('two', 'ok', {'A': {'messages': 3, 'errors': 0}})]
+    assert len(exported_files(tmp_path / 'export' / 'two')) == 3
+    # headless, a missing token fails instead of waiting on a browser
+    with pytest.raises(FatalException):
+        GmailAPI(token_path=str(tmp_path / 'missing.json'), credentials_path=str(tmp_path / 'credentials.json'), interactive=False)
+
+
+def test_pipeline_failures_release_and_hold_back_history(tmp_path, monkeypatch):
+    import pytest
+    pytest.importorskip('googleapiclient')
+    pytest.importorskip('bs4')
+    from gmail_export.cli import ExportCLI
+    from gmail_export.fake import FakeGmailAPI, SyntheticMailbox
+    from gmail_export.history import HistoryState
+    from gmail_export.messages import GmailMessage
+
+    mailbox = SyntheticMailbox(messages=4, thread_depth=1, labels=['A'])
+    bad = mailbox.message_id(2)
+    render = GmailMessage.render
+    def failing_render(message):
+        if message.id == bad:
+            raise ValueError('render failed')
+        return render(message)
+    monkeypatch.setattr(GmailMessage, 'render', failing_render)
+    exporter = ExportCLI(answers={'export_path': str(tmp_path), 'labels': ['A'], 'formats': ['html']},
+                         gmail_api=FakeGmailAPI(mailbox), offline=True, image_cache=None, pipeline=True)
+    assert exporter.export_selected_labels() == {'A': {'messages': 4, 'errors': 1}}
+    # fetched, failed in convert and never written, but not kept in memory
+    assert exporter.messages[bad].msg is None
+    assert len(exported_files(tmp_path)) == 3
+    assert HistoryState(str(tmp_path)).get('Label_0') is None
+
+
+def test_pipeline_queues_drain_under_pdf_backpressure(tmp_path, monkeypatch):
+    import time
+    import threading
+    import pytest
+    pytest.importorskip('googleapiclient')
+    pytest.importorskip('bs4')
+    import gmail_export.pdf as pdf
+    from gmail_export.cli import ExportCLI
+    from gmail_export.fake import FakeGmailAPI, SyntheticMailbox
+
+    def wkhtmltopdf(inputs, write_path, html=None, cwd=None):
+        time.sleep(0.01)
+        with open(write_path, 'wb') as outfile:
+            outfile.write(b'%PDF')
+        return write_path
+    monkeypatch.setattr(pdf, 'wkhtmltopdf', wkhtmltopdf)
+    mailbox = SyntheticMailbox(messages=12, thread_depth=3, labels=['A'])
+    exporter = ExportCLI(answers={'export_path': str(tmp_path), 'labels': ['A'], 'formats': ['pdf', 'thread pdf']},
+                         gmail_api=FakeGmailAPI(mailbox), offline=True, image_cache=None,
+                         pipeline={'fetchers': 2, 'converters': 2, 'writers': 1, 'queue_size': 1})
+    # one conversion at a time and one waiting, every other submit blocks its writer
+    exporter.pdf_pool = pdf.PdfPool(workers=1, backlog=1)
+    summary = []
+    worker = threading.Thread(target=lambda: summary.append(exporter.export_selected_labels()), daemon=True)
+    worker.start()
+    worker.join(60)
+    assert not worker.is_alive()
+    assert summary == [{'A': {'messages': 12, 'errors': 0}}]
+    assert len([name for name in exported_files(tmp_path) if name.endswith('.pdf')]) == 12 + 4
+
+
+def test_one_gmail_api_is_authenticated_per_run(tmp_path, monkeypatch):
+    import pytest
+    pytest.importorskip('googleapiclient')
+    import gmail_export.api as api
+    from gmail_export.cli import ExportCLI
+    from gmail_export.fake import FakeService, SyntheticMailbox
+
+    class StubCredentials(object):
+        valid = True
+        loads = 0
+        @classmethod
+        def from_authorized_user_file(cls, path, scopes=None):
+            cls.loads += 1
+            return cls()
+    services = []
+    mailbox = SyntheticMailbox(messages=6, thread_depth=3, labels=['A', 'B'])
+    monkeypatch.setattr(api, 'Credentials', StubCredentials)
+    monkeypatch.setattr(api, 'build', lambda *args, **kwargs: services.append(FakeService(mailbox)) or services[-1])
+    token_path = tmp_path / 'token.json'
+    token_path.write_text('{}')
+    gmail_api = api.GmailAPI(token_path=str(token_path), interactive=False)
+    export_path = tmp_path / 'export'
+    exporter = ExportCLI(answers={'export_path': str(export_path), 'labels': ['A', 'B'], 'formats': ['eml']},
+                         gmail_api=gmail_api, offline=True, image_cache=None, pipeline=True)
+    exporter.export_selected_labels()
+    assert len(exported_files(export_path)) == 12
+    assert StubCredentials.loads == 1
+    assert len(services) == 1
+
+
+def test_html_and_pdf_share_one_render(tmp_path, monkeypatch):
+    import pytest
+    pytest.importorskip('googleapiclient')
+    pytest.importorskip('bs4')
+    import gmail_export.pdf as pdf
+    from gmail_export.cli import ExportCLI
+    from gmail_export.fake import FakeGmailAPI, SyntheticMailbox
+    from gmail_export.messages import GmailMessage
+
+    def wkhtmltopdf(inputs, write_path, html=None, cwd=None):
+        with open(write_path, 'wb') as outfile:
+            outfile.write(b'%PDF')
+        return write_path
+    monkeypatch.setattr(pdf, 'wkhtmltopdf', wkhtmltopdf)
+    converted = []
+    convert = GmailMessage.convert
+    monkeypatch.setattr(GmailMessage, 'convert', lambda message: converted.append(message.id) or convert(message))
+    mailbox = SyntheticMailbox(messages=4, thread_depth=2, labels=['A'])
+    gmail_api = FakeGmailAPI(mailbox)
+    single = []
+    get_message_meta = gmail_api.get_message_meta
+    gmail_api.get_message_meta = lambda *args, **kwargs: single.append(args) or get_message_meta(*args, **kwargs)
+    exporter = ExportCLI(answers={'export_path': str(tmp_path), 'labels': ['A'], 'formats': ['html', 'pdf']},
+                         gmail_api=gmail_api, offline=True, image_cache=None)
+    exporter.export_selected_labels()
+    assert len(exported_files(tmp_path)) == 8
+    assert sorted(converted) == sorted(message_id for message_id, _ in mailbox.ids())
+    # convert uses the metadata the label batch loaded
+    assert single == []
+
+
+def test_mime_part_index_matches_walking_the_message(tmp_path):
+    import email
+    import pytest
+    pytest.importorskip('googleapiclient')
+    pytest.importorskip('rfc6266_parser')
+    from email.mime.image import MIMEImage
+    from rfc6266_parser import build_header
+    from gmail_export.fake import FakeGmailAPI, SyntheticMailbox, PNG_HEADER
+    from gmail_export.messages import GmailMessage
+    from gmail_export.threads import GmailThread
+
+    mailbox = SyntheticMailbox(messages=1, attachment_sizes=(16, 32), inline_images=2)
+    message_id = mailbox.message_id(0)
+    msg = email.message_from_bytes(mailbox.raw(message_id))
+    # a bare content id and an image only named in its content type
+    image = MIMEImage(PNG_HEADER, 'png', name='logo.png')
+    image.add_header('Content-ID', 'bare@synthetic')
+    image.add_header('Content-Disposition', 'inline', filename='logo.png')
+    msg.attach(image)
+    gmail_api = FakeGmailAPI(mailbox)
+    message = GmailMessage(message_id, GmailThread(message_id, gmail_api), None, api=gmail_api)
+    message._msg = msg
+
+    def walk(matches):
+        return next((part for part in msg.walk() if matches(part)), None)
+    for content_type in ['text/html', 'image/png', 'application/octet-stream', 'multipart/related', 'text/plain']:
+        assert message.get_part_by_content_type(content_type) is walk(lambda part: part.get_content_type() == content_type)
+    for content_id in ['image0@synthetic', 'image1@synthetic', 'bare@synthetic', 'missing@synthetic']:
+        assert message.get_part_by_content_id(content_id) is walk(lambda part: part['Content-ID'] in (content_id, '<' + content_id + '>'))
+    for name in ['logo.png', 'image0.png']:
+        assert message.get_part_by_content_type_name(name) is walk(lambda part: part.get_param('name', header='Content-Type') == name)
+    for inline, disposition in [(False, 'attachment'), (True, 'inline')]:
+        parts = [part for part in msg.walk() if 'content-disposition' in part and part.get_content_disposition() == disposition]
+        found = message.find_attachments(inline)
+        assert [part for _, part in found] == parts
+        assert [parsed for parsed, _ in found] == [build_header(part.get_filename()) for part in parts]
+
+
+def test_threads_are_named_once_from_their_root_message(tmp_path, monkeypatch):
+    import pytest
+    pytest.importorskip('googleapiclient')
+    from gmail_export.api import GmailAPI
+    from gmail_export.fake import SyntheticMailbox
+    from gmail_export.threads import GmailThread
+
+    named = []
+    generate_name = GmailThread.generate_name
+    monkeypatch.setattr(GmailThread, 'generate_name', lambda thread, export: named.append(thread.id) or generate_name(thread, export))
+    fetched = []
+    get_thread_meta = GmailAPI.get_thread_meta
+    monkeypatch.setattr(GmailAPI, 'get_thread_meta', lambda api, id: fetched.append(id) or get_thread_meta(api, id))
+    mailbox = SyntheticMailbox(messages=6, thread_depth=3, labels=['A', 'B'])
+    fake_export(tmp_path / 'full', mailbox, formats=['eml'])
+    # both labels hold both threads, each is named once from its root's metadata
+    assert sorted(named) == [mailbox.message_id(0), mailbox.message_id(3)]
+    assert fetched == []
+    del named[:]
+    # without the root message gmail is asked for the thread, and the name doesn't change
+    fake_export(tmp_path / 'reply', mailbox, formats=['eml'], query=f'rfc822msgid:{mailbox.message_id(4)}@synthetic')
+    assert named == fetched == [mailbox.message_id(3)]
+    replies = exported_files(tmp_path / 'reply')
+    assert replies and set(replies) <= set(exported_files(tmp_path / 'full'))
+
+
+def test_export_starts_before_the_label_is_listed(tmp_path, monkeypatch):
+    import pytest
+    pytest.importorskip('googleapiclient')
+    import gmail_export.api as api
+    from gmail_export.fake import SyntheticMailbox
+    from gmail_export.messages import GmailMessage
+
+    events = []
+    iter_id_pages_for_label = api.GmailAPI.iter_id_pages_for_label
+    def iter_pages(gmail_api, label, query=None, page_token=None):
+        for page in iter_id_pages_for_label(gmail_api, label, query, page_token):
+            events.append('page')
+            yield page
+    monkeypatch.setattr(api.GmailAPI, 'iter_id_pages_for_label', iter_pages)
+    export_eml = GmailMessage.export_eml
+    monkeypatch.setattr(GmailMessage, 'export_eml', lambda message, *args: events.append('eml') or export_eml(message, *args))
+    # pages of two split the three message threads
+    monkeypatch.setattr(api, 'LIST_PAGE_SIZE', 2)
+    mailbox = SyntheticMailbox(messages=9, thread_depth=3, labels=['A'])
+    for name, pipeline in [('serial', False), ('pipeline', {'queue_size': 1})]:
+        del events[:]
+        assert fake_export(tmp_path / name, mailbox, formats=['eml'], pipeline=pipeline) == {'A': {'messages': 9, 'errors': 0}}
+        assert events.count('page') == 5
+        assert events.index('eml') < len(events) - 1 - events[::-1].index('page')
+        assert len(exported_files(tmp_path / name)) == 9
+    assert exported_files(tmp_path / 'serial') == exported_files(tmp_path / 'pipeline')
+
+
+def test_importing_the_cli_does_not_load_the_google_client():
+    import subprocess
+    import sys
+    code = "import sys, gmail_export.cli; print(sorted(m for m in sys.modules if m.startswith(('googleapiclient', 'gmail_export.api'))))"
+    assert subprocess.check_output([sys.executable, '-c', code], text=True).strip() == '[]'
+
+
+def test_manifest_checksums_come_from_the_written_bytes(tmp_path, monkeypatch):
+    import hashlib
+    import gmail_export.manifest as manifest
+    from gmail_export.fake import SyntheticMailbox
+
+    def file_checksum(path, chunk_size=None):
+        raise AssertionError(f"{path} was read back")
+    monkeypatch.setattr(manifest, 'file_checksum', file_checksum)
+    mailbox = SyntheticMailbox(messages=3, thread_depth=3, labels=['A', 'B'], attachment_sizes=[100])
+    for name, dedupe in [('plain', None), ('linked', 'hardlink')]:
+        export_path = tmp_path / name
+        fake_export(export_path, mailbox, formats=['eml', 'html', 'attachments'], dedupe=dedupe)
+        files = manifest.ExportManifest(str(export_path)).files(mailbox.message_id(1))
+        # three formats in each label
+        assert len(files) == 6
+        for _, _, path, size, sha256 in files:
+            with open(path, 'rb') as infile:
+                data = infile.read()
+            assert (size, sha256) == (len(data), hashlib.sha256(data).hexdigest())